@@ -8,61 +8,65 @@
 ## If unspecified, openSMILE IS13 configure file will be used.
 
 
-import argparse, glob, os, shutil, os.path
+import argparse, os, shutil, os.path, sys, multiprocessing, signal, time
+import numpy as np
 import pandas as pd
-from acousticsLib.transcript_prep import transcript_check
-from acousticsLib.run_programs import run_openSMILE, run_SpeechQuality, run_covarep, run_FA
-from acousticsLib.audio_prep import check_channel, process_stereo, process_mono
-from acousticsLib.data_summary import summarize_measures, summarize_SAD, combine_data
+from acousticsLib.transcript_prep import Transcript
+from acousticsLib.run_programs import run_openSMILE, run_SpeechQuality, run_covarep, run_FA, openSMILE_default_config_location, acoustic_pipeline_location, openSMILE_extractors, openSMILE_backend
+from acousticsLib.audio_prep import AudioSession, check_channel, process_stereo, process_mono
+from acousticsLib.data_summary import summarize_measures, summarize_SAD, SAD_output, combine_data, write_corpus_summary, transcript_segments, lab_segments, write_pause_summary
+from acousticsLib.covarep_worker import CovarepPool, CovarepManager
+from acousticsLib.result_cache import ResultCache, run_cached, print_cache_stats
+from acousticsLib.output_sink import make_sink
+from acousticsLib.corpus_index import CorpusIndex
+from acousticsLib.frame_store import FrameStore, frame_store_file, write_store
+from acousticsLib.scratch_space import make_scratch
+from acousticsLib.audio_split import SplitChannel, n_segments, extract_segments, split_params, frame_step
+from acousticsLib.work_queue import WorkQueue, shard_file, merge_shards
+from acousticsLib.stage_scheduler import Stage, StageScheduler
+from acousticsLib.run_trace import configure_trace, tracing, trace_settings, trace_context, span, print_trace_summary
 
-def main(args):
-    
-    # make a list of input files if the audio file type is given
-    if args.audio_type:
-        filelist = glob.glob(args.input_folder+'/*.'+args.audio_type)	
-    # If audio_type is null, make a list of wav files in the input oflder
+# entry is the index entry of the file (its transcript and earlier output files, see CorpusIndex)
+# channels in skip_channels were already written in an earlier run (see -resume) and are not processed again
+def process_file(file, args, entry, skip_channels=()):
+    print(file, " is being processed...")
+    filename = file.split('/')[-1]
+
+    # work on a private copy of the arguments so that each file gets its own scratch folder
+    args = argparse.Namespace(**vars(args))
+
+    # output rows of the file being processed (channel name and data frame for each channel)
+    rows = []
+
+    # make output dataframes for the file being processed
+    turn_df = pd.DataFrame()
+    SMILEdf = pd.DataFrame()
+    covarep_df = pd.DataFrame()
+    SADdf = pd.DataFrame(columns=['filename','task_start', 'task_end','total_dur', 'totalSpch', 'meanSpch','stdSpch', 'totalPause', 'meanPause','stdPause','numPause'])
+
+    # check if the transcript is in the right format before running any program. 
+    # Note: only transcripts without header and 6 columns (filename, start, end, text, speaker, section) will be processed.
+    # The transcript is read once and shared by all programs.
+    transfile = entry['transcript']
+    transcript = None
+    if transfile:
+        transcript = Transcript(transfile)
     else:
-        filelist = glob.glob(args.input_folder+'/*.wav')
-
-    # define the output file   
-    outputname = args.output_file
-
-    # loop through files in the file list
-    for file in filelist:
-        print(file, " is being processed...")
-        filename = file.split('/')[-1]
-		
-        # make output dataframes for the file being processed
-        turn_df = pd.DataFrame()
-        SMILEdf = pd.DataFrame()
-        covarep_df = pd.DataFrame()
-        SADdf = pd.DataFrame(columns=['filename','task_start', 'task_end','total_dur', 'totalSpch', 'meanSpch','stdSpch', 'totalPause', 'meanPause','stdPause','numPause'])
-    
-        # check if the transcript is in the right format before running any program. 
-        # Note: only transcripts without header and 6 columns (filename, start, end, text, speaker, section) will be processed.
-        if args.trans_folder:
-            transcript_list = glob.glob(args.trans_folder+'/*.txt')
-            transfile = args.trans_folder + '/'+filename.split('.')[0]+'.txt'
-            if transfile in transcript_list:
-                transcript_check(transfile)
-        else: 
-            transcript_list = glob.glob(args.input_folder+'/*.txt')
-            transfile = args.input_folder + '/'+filename.split('.')[0]+'.txt'
-            if transfile in transcript_list:
-                transcript_check(transfile)
-            else:
-                print("No corresponding transcript file is found. The program assumes that there's only one speaker.")
-		
-        # make a temporary folder and copy the audio file that's being processed 
-        # this temp folder will be deleted at the end of the loop
-        os.mkdir(args.input_folder+"/temp")
-        shutil.copy2(file, args.input_folder+'/temp')
-
-        # Check the number of channels in the copied audio file and process the file accordingly
-        if check_channel(args.input_folder+'/temp/'+filename) > 1:
-            status = process_stereo(args.input_folder+'/temp/'+filename)
-        else: 
-            status = process_mono(args.input_folder+'/temp/'+filename)
+        print("No corresponding transcript file is found. The program assumes that there's only one speaker.")
+
+    # make a scratch folder for this file only (in the input folder, or in -scratch_dir if the file fits, see scratch_space.py)
+    # this folder will be deleted at the end of the function, even if a program fails
+    args.temp_folder = make_scratch(file, args)
+    try:
+        with span('preprocess'):
+            # read the audio file once for all preprocessing steps; files are only written to the scratch folder when a program needs them
+            session = AudioSession(file, args.temp_folder)
+
+            # Check the number of channels in the audio file and process the file accordingly
+            if check_channel(session) > 1:
+                status = process_stereo(session)
+            else: 
+                status = process_mono(session)
 
         # Make a new temp file list for processing
         if status == 'processed_stereo':
@@ -71,55 +75,95 @@ def main(args):
             newfilelist = [filename.split('.')[0]+'_mono.wav']
         else:
             newfilelist = [filename]
-        
+
+        # channels that are processed in this run
+        channels = [newfile for newfile in newfilelist if newfile not in skip_channels]
+
+        # long channels are cut into segments that openSMILE, covarep and SAD analyze at the same time (see -split_minutes)
+        splits = {}
+        if n_segments(session.n_frames/session.sample_rate, args.split_minutes) > 1:
+            splits = dict((newfile, SplitChannel(args.split_minutes, transcript)) for newfile in channels)
+        split_cpus = args.split_jobs if splits else 1
+
+        # the programs run as stages of a dependency graph, so that programs that do not depend on each other run at the
+        # same time (see stage_scheduler.py). A preprocessed channel is only written to the scratch folder by the first
+        # stage that needs the file (the speech quality check reads the samples, and SMILExtract may read a named pipe).
+        stages = []
+        for newfile in channels:
+            # SMILExtract reads the channel from a named pipe (see -named_pipes) if it is the only program that needs the file
+            # (the result cache and the split need the file, and the speech quality is checked on the samples in memory)
+            pipe = (args.named_pipes and args.openSMILE and args.openSMILE_backend == 'subprocess' and args.result_cache is None
+                and newfile not in splits and session.streamable(newfile) and session.array(newfile) is not None
+                and not args.covarep and not (args.SAD and transcript is None))
+            ## run covarep
+            if args.covarep:
+                covarep_out = args.input_folder+'/'+newfile.split('/')[-1].split('.')[0]+'.dat'
+                if args.result_cache is not None or covarep_out.split('/')[-1] not in entry['outputs']:
+                    stages.append(Stage('covarep:'+newfile, lambda newfile=newfile: run_covarep_stage(session.path(newfile), args, splits.get(newfile)),
+                        tool='covarep', cpus=split_cpus))
+            ## run openSMILE
+            if args.openSMILE:
+                os_outfile = args.input_folder +'/'+ newfile.split('/')[-1].split('.')[0]+'.csv'
+                # openSMILE in this process only writes the frame store of the output file
+                os_output = os_outfile if args.openSMILE_backend == 'subprocess' else frame_store_file(os_outfile)
+                # with a result cache, the output is taken from the cache only if the audio and the config are unchanged
+                if pipe and os_output.split('/')[-1] not in entry['outputs']:
+                    stages.append(Stage('openSMILE:'+newfile, lambda newfile=newfile: run_openSMILE_pipe(session, newfile, args),
+                        tool='openSMILE'))
+                elif args.result_cache is not None or os_output.split('/')[-1] not in entry['outputs']:
+                    stages.append(Stage('openSMILE:'+newfile, lambda newfile=newfile: run_openSMILE_stage(session.path(newfile), args, splits.get(newfile)),
+                        tool='openSMILE', cpus=split_cpus))
+            ## run SAD
+            # SAD would not run if there's a transcript file from WebTrans (which already has the SAD function)
+            if args.SAD and transcript is None:
+                stages.append(Stage('SAD:'+newfile, lambda newfile=newfile: SAD_output(session.path(newfile), args, splits.get(newfile)),
+                    tool='SAD', cpus=split_cpus if args.SAD_backend == 'ldc' else 1))
+            ## check speech quality
+            stages.append(Stage('quality:'+newfile, lambda newfile=newfile: run_quality_stage(session, newfile),
+                tool='quality'))
+        # run forced-aligner (it reads the original audio file, so it does not wait for preprocessing)
+        # the alignments are written before any channel of the file, so a file with completed channels is already aligned
+        if args.forced_alignment and not skip_channels:
+            stages.append(Stage('forced_alignment', lambda: run_FA(file, transcript, status, args, session),
+                tool='forced_alignment', cpus=args.fa_jobs))
+
+        results = StageScheduler(args.cpu_budget, args.tool_limits).run(stages)
+
+        # summarize the outputs of the programs channel by channel, in the same order as before
         # count number of files in the newfilelist (to prevent summarizing SAD measures in the transcript of stereo files twice)
         count = 0
-        # loop through files in the temp folder
-        for newfile in newfilelist:
+        for newfile in channels:
             temp = pd.DataFrame()
-            ## check speech quality
-            print("Checking the speech quality of "+newfile)
-            snr, nclipped = run_SpeechQuality(args.input_folder+'/temp/'+newfile)
-            print("SNR: ", snr,"dB")
+            snr, nclipped = results['quality:'+newfile]
 
-            ## run openSMILE
             if args.openSMILE:
                 os_outfile = args.input_folder +'/'+ newfile.split('/')[-1].split('.')[0]+'.csv'
-                if not os.path.exists(os_outfile):
-                    run_openSMILE(args.input_folder+'/temp/'+newfile, args)
-                    # copy the output file of openSMILE to the input folder
-                    shutil.copy2(args.input_folder+'/temp/'+os_outfile.split('/')[-1], args.input_folder)
-
                 # summarize the output data and return a df
-                SMILEdf = summarize_measures(os_outfile, transfile, turn_df, SMILEdf, args, openSMILE=True)    
-                
+                with span('summarize_openSMILE', channel=newfile):
+                    # frames extracted in this process are summarized without reading the output file
+                    SMILEdf = summarize_measures(os_outfile, transcript, turn_df, SMILEdf, args, openSMILE=True, frames=results.get('openSMILE:'+newfile))    
+
                 # combine with temp output dataframe
                 temp = combine_data(temp, SMILEdf, args)
-            
-            ## run covarep
+
             if args.covarep:
                 covarep_out = args.input_folder+'/'+newfile.split('/')[-1].split('.')[0]+'.dat'
-                if not os.path.exists(covarep_out):
-                    run_covarep(args.input_folder+'/temp/'+newfile)
-                    # copy output file to the input_folder        
-                    shutil.copy2(args.input_folder+'/temp/'+covarep_out.split('/')[-1], args.input_folder)
-                
-                covarep_df = summarize_measures(covarep_out, transfile, turn_df, covarep_df, args, openSMILE=False)    
+                with span('summarize_covarep', channel=newfile):
+                    covarep_df = summarize_measures(covarep_out, transcript, turn_df, covarep_df, args, openSMILE=False)    
                 # combine with temp output dataframe
                 temp = combine_data(temp, covarep_df, args)        
-                
-            ## run SAD
+
             if args.SAD:
                 count += 1
-                # SAD would not run if there's a transcript file from WebTrans (which already has the SAD function)
-				# If no corresponding transcript, SAD will run and output files will be summarized. 
-                SADdf = summarize_SAD(newfile, transfile, SADdf, args, count) 
+                # If no corresponding transcript, the output file of the SAD stage will be summarized. 
+                with span('summarize_SAD', channel=newfile):
+                    # (the channel file is not written for this: SAD ran in its stage, and a transcript only needs the name)
+                    SADdf = summarize_SAD(args.temp_folder+'/'+newfile, transcript, SADdf, args, count) 
                 # if SAD ran, copy the output file to the input folder (before deleting the temp folder)
-                list_of_lab = glob.glob(args.input_folder+'/temp/*.lab')
-                SADout = newfile.split('.')[0]+'.lab'
-                if SADout in list_of_lab:
-                    shutil.copy2(args.input_folder+'/temp/'+SADout, args.input_folder)
-                
+                SADout = args.temp_folder+'/'+newfile.split('.')[0]+'.lab'
+                if os.path.exists(SADout):
+                    shutil.copy2(SADout, args.input_folder)
+
                 ## if turn-level measures are calculated, SAD measures won't be added to the temp output dataframe.
                 if args.turn_level:
                     pass
@@ -129,38 +173,514 @@ def main(args):
                         temp = pd.merge(temp, SADdf, how='inner', on=['speaker', 'task'])
                     else:
                         temp = SADdf    
-            
-        
+
             # Add SNR and nclipped in the temp output dataframe
-            temp = temp.append({'SNR': snr, 'nClipped': nclipped}, ignore_index=True)
-            out_file = args.input_folder+'/'+outputname
-            # write final results of the file being processed to the output file. 
-            if os.path.exists(out_file):
-                temp.to_csv(args.input_folder+'/'+outputname, index=None, sep='\t', mode='a', header=False)
+            temp = pd.concat([temp, pd.DataFrame([{'SNR': snr, 'nClipped': nclipped}])], ignore_index=True)
+            rows.append((newfile, temp))
+
+    finally:
+        # delete all contents in the scratch folder
+        shutil.rmtree(args.temp_folder)
+
+    return rows
+
+## stages of process_file (each runs in its own thread)
+# check the speech quality of a preprocessed channel
+def run_quality_stage(session, newfile):
+    print("Checking the speech quality of "+newfile)
+    audio = session.array(newfile)
+    if audio is not None:
+        snr, nclipped = run_SpeechQuality(audio=audio)
+    else:
+        snr, nclipped = run_SpeechQuality(session.path(newfile))
+    print("SNR of "+newfile+": ", snr,"dB")
+    return snr, nclipped
+
+# run openSMILE and copy its output file to the input folder
+# in this process (see -openSMILE_backend), the frames are saved as a frame store and returned for the summary
+# if split (a SplitChannel, see -split_minutes) is given, openSMILE runs on the segments of the file at the same time
+def run_openSMILE_stage(audio_file, args, split=None):
+    outfile = args.temp_folder+'/'+audio_file.split('/')[-1].split('.')[0]+'.csv'
+    config = args.openSMILE_config if args.openSMILE_config else openSMILE_default_config_location
+    if args.openSMILE_backend == 'subprocess':
+        if split is None:
+            run_cached(args.result_cache, audio_file, 'openSMILE', [outfile], lambda: run_openSMILE(audio_file, args), config=config)
+        else:
+            run_cached(args.result_cache, audio_file, 'openSMILE', [outfile], lambda: run_openSMILE_segments(split.get(audio_file), outfile, args),
+                config=config, params=split_params(args))
+        shutil.copy2(outfile, args.input_folder)
+        return None
+
+    store_file = frame_store_file(outfile)
+    extractor = openSMILE_extractors[args.openSMILE_backend]
+    extracted = []
+    def extract():
+        if split is None:
+            frame_time, lld = extractor(audio_file, config)
+        else:
+            frame_time, lld = extract_segments(split.get(audio_file), lambda path: extractor(path, config), args.split_jobs)
+        write_store(store_file, lld.columns, frame_time, lld.to_numpy(dtype=np.float32))
+        extracted.append((frame_time, lld))
+    params = [args.openSMILE_backend] + (split_params(args) if split is not None else [])
+    run_cached(args.result_cache, audio_file, 'openSMILE', [store_file], extract, config=config, params=params)
+    shutil.copy2(store_file, args.input_folder)
+    if not extracted:
+        # taken from the cache
+        return FrameStore(store_file, True).frame()
+    # the frames in the layout of the openSMILE output file
+    frame_time, lld = extracted[0]
+    frames = pd.DataFrame({'name': pd.Categorical.from_codes(np.zeros(len(frame_time), dtype=np.int8), ['unknown']), 'frameTime': frame_time})
+    return pd.concat([frames, lld.reset_index(drop=True)], axis=1)
+
+# run SMILExtract on a channel that is written to a named pipe instead of a file (see -named_pipes),
+# and copy its output file to the input folder
+def run_openSMILE_pipe(session, newfile, args):
+    outfile = args.temp_folder+'/'+newfile.split('.')[0]+'.csv'
+    with session.stream(newfile) as pipe:
+        run_openSMILE(pipe, args)
+    os.replace(pipe.split('.')[0]+'.csv', outfile)
+    shutil.copy2(outfile, args.input_folder)
+
+# run covarep and copy its output file to the input folder
+# if split is given, covarep runs on the segments of the file at the same time (as many as the MATLAB sessions allow)
+def run_covarep_stage(audio_file, args, split=None):
+    outfile = args.temp_folder+'/'+audio_file.split('/')[-1].split('.')[0]+'.dat'
+    if split is None:
+        run_cached(args.result_cache, audio_file, 'covarep', [outfile],
+            lambda: run_covarep(audio_file, args.covarep_pool), config=acoustic_pipeline_location+'/feature_extraction2.m')
+    else:
+        run_cached(args.result_cache, audio_file, 'covarep', [outfile], lambda: run_covarep_segments(split.get(audio_file), outfile, args),
+            config=acoustic_pipeline_location+'/feature_extraction2.m', params=split_params(args))
+    shutil.copy2(outfile, args.input_folder)
+
+# run SMILExtract on segments of a file and write the stitched frames to outfile, with the frame times of the file
+def run_openSMILE_segments(segments, outfile, args):
+    def extract(path):
+        run_openSMILE(path, args)
+        frames = pd.read_csv(path.split('.')[0]+'.csv', sep=';')
+        return frames['frameTime'], frames
+    frame_time, frames = extract_segments(segments, extract, args.split_jobs)
+    # as the frame times of the output files (microseconds)
+    frames['frameTime'] = np.round(frame_time, 6)
+    frames.to_csv(outfile, sep=';', index=False)
+
+# run covarep on segments of a file and write the stitched frames to outfile (covarep frames are 10 ms apart)
+def run_covarep_segments(segments, outfile, args):
+    def extract(path):
+        run_covarep(path, args.covarep_pool)
+        frames = pd.read_csv(path.split('.')[0]+'.dat', sep='\t')
+        return np.arange(len(frames))*frame_step, frames
+    frame_time, frames = extract_segments(segments, extract, args.split_jobs)
+    frames.to_csv(outfile, sep='\t', index=False)
+
+# process a file with its name in the trace (see -trace)
+def run_job(job):
+    file, args = job[0], job[1]
+    # worker processes that do not share the trace settings of the main process (e.g. spawned) set them up here
+    if args.trace and not tracing():
+        configure_trace(args.trace, args.trace_run)
+    with trace_context(file=file.split('/')[-1]), span('file'):
+        return process_file(*job)
+
+# worker entry point for the process pool; programs call sys.exit() on bad input, which would kill a pool worker silently
+def process_file_job(job):
+    try:
+        return run_job(job)
+    except SystemExit as err:
+        raise RuntimeError(str(err)) from None
+
+# write the results of a file to the output file and mark the file as done
+def write_rows(sink, file, rows):
+    filename = file.split('/')[-1]
+    with trace_context(file=filename), span('write_output'):
+        for newfile, temp in rows:
+            sink.write(filename, newfile, temp)
+        sink.done(filename)
+
+# claim files from the work queue and process them until all files of the corpus are done (by any worker)
+# at most args.jobs files are claimed at a time, so that the other workers can take the rest.
+# The files are processed by the worker processes of the pipeline, which stops them when it is closed.
+def run_queue(queue, index, sink, pipeline):
+    args = pipeline.args
+    queue.start_heartbeat()
+    pool = pipeline.workers() if args.jobs > 1 else None
+    # files being processed by this worker: (file, result of the pool)
+    running = []
+
+    def finish(file, rows):
+        write_rows(sink, file, rows)
+        queue.complete(file.split('/')[-1])
+
+    # wait for the first running file (it stays in running until it is done, so that its claim is released on errors)
+    def finish_first():
+        file, result = running[0]
+        rows = result.get()
+        running.pop(0)
+        finish(file, rows)
+
+    try:
+        while True:
+            remaining = [file for file in index.audio if not queue.is_done(file.split('/')[-1])]
+            if not remaining:
+                break
+            for file in remaining:
+                name = file.split('/')[-1]
+                if pool is not None:
+                    while len(running) >= args.jobs:
+                        finish_first()
+                if not queue.claim(name):
+                    continue
+                if sink.is_done(name):
+                    # written by this worker before it stopped, but not marked as done in the queue
+                    queue.complete(name)
+                    continue
+                job = (file, args, index.entry(file), sink.completed_channels(name))
+                if pool is not None:
+                    running.append((file, pool.apply_async(process_file_job, (job,))))
+                else:
+                    try:
+                        rows = run_job(job)
+                    except BaseException:
+                        # let another worker try the file
+                        queue.release(name)
+                        raise
+                    finish(file, rows)
+            while running:
+                finish_first()
+            # the other files are claimed by other workers; look again later, in case a worker stopped and its claims expire
+            if any(not queue.is_done(file.split('/')[-1]) for file in remaining):
+                print("Waiting for files claimed by other workers...")
+                time.sleep(min(queue.lease/10, 30))
+    except RuntimeError as err:
+        for file, result in running:
+            queue.release(file.split('/')[-1])
+        sys.exit(str(err))
+    finally:
+        queue.stop_heartbeat()
+
+# the partial summaries of all channels of the corpus (see -corpus_summary), by program
+def corpus_partials(index, args):
+    partials_files = {'openSMILE': [], 'covarep': []}
+    for file in index.audio:
+        stem = args.input_folder+'/'+file.split('/')[-1].split('.')[0]
+        for channel in ['_firstCH', '_secondCH', '_mono', '']:
+            for program, extension in [('openSMILE', '.csv'), ('covarep', '.dat')]:
+                if os.path.exists(stem+channel+extension+'.partials.npz'):
+                    partials_files[program].append(stem+channel+extension+'.partials.npz')
+    return partials_files
+
+# the segment tables of all audio files of the corpus (see -pause_summary): the turns of the transcript,
+# or the segments of the SAD output of each channel if there is no transcript
+def corpus_pause_segments(index, args):
+    segments = []
+    for file in index.audio:
+        transfile = index.entry(file)['transcript']
+        if transfile:
+            segments.append(transcript_segments(Transcript(transfile), file.split('/')[-1]))
+            continue
+        stem = file.split('/')[-1].split('.')[0]
+        for channel in ['_firstCH', '_secondCH', '_mono', '']:
+            if os.path.exists(args.input_folder+'/'+stem+channel+'.lab'):
+                segments.append(lab_segments(args.input_folder+'/'+stem+channel+'.lab', stem+channel+'.wav'))
+    return segments
+
+# the pipeline as a Python object, e.g. in another program:
+#   with Pipeline('/data/corpus', openSMILE=True, SAD=True, jobs=4) as pipeline:
+#       for record in pipeline.run(files):
+#           ...
+# options are the command line options without the dash (the others keep their defaults), or args, the parsed options.
+# The pipeline keeps its worker processes, MATLAB sessions (covarep) and openSMILE objects (-openSMILE_backend python)
+# between files until it is closed, so that later files do not pay their start-up time again.
+# Every file gives a result record: {'file': path, 'rows': [(channel, data frame), ...], 'error': None or message}.
+class Pipeline:
+    def __init__(self, input_folder=None, args=None, **options):
+        if args is None:
+            args = make_parser().parse_args(['-output_file', '', '-input_folder', input_folder])
+            for name, value in options.items():
+                if not hasattr(args, name):
+                    raise TypeError("Unknown pipeline option: "+name)
+                setattr(args, name, value)
+        self.args = args
+        # files processed (or waiting in the worker processes) at a time; later files wait until one is done
+        self.max_pending = args.max_pending if args.max_pending else 2*args.jobs
+        self.pool = None
+        self.manager = None
+
+        # record the time and resources of every stage and program in a trace file
+        args.trace_run = None
+        if args.trace:
+            configure_trace(args.trace)
+            args.trace_run = trace_settings['run']
+
+        # keep the outputs of the programs in a cache shared by all runs
+        args.result_cache = None
+        if args.cache_dir:
+            args.result_cache = ResultCache(args.cache_dir, int(args.cache_size*1024**3))
+            self.cache_stats = args.result_cache.stats()
+
+        # start MATLAB for covarep once per run instead of once per file (at most covarep_workers sessions at a time)
+        args.covarep_pool = None
+        if args.covarep and args.covarep_workers > 0:
+            if args.jobs > 1:
+                # the pool lives in a manager process and is shared by all worker processes
+                self.manager = CovarepManager()
+                self.manager.start()
+                args.covarep_pool = self.manager.CovarepPool(args.covarep_workers, timeout=args.covarep_timeout)
             else:
-                temp.to_csv(args.input_folder+'/'+outputname, index=None, sep='\t', mode='a')
+                args.covarep_pool = CovarepPool(args.covarep_workers, timeout=args.covarep_timeout)
 
-        # run forced-aligner
-        if args.forced_alignment:
-            run_FA(file, transcript_list, transfile, status, args)
-        
-        # delete all contents in the temp folder
-        shutil.rmtree(args.input_folder+'/temp')
-					
+        # openSMILE in this process, if the backend is available
+        if args.openSMILE:
+            args.openSMILE_backend = openSMILE_backend(args.openSMILE_backend)
 
-if __name__ == '__main__':
+        # CPUs used by the programs of one file at a time (the CPUs are shared by the files processed in parallel)
+        if not args.cpu_budget:
+            args.cpu_budget = max(1, (os.cpu_count() or 1) // args.jobs)
+        # maximum number of stages of a program running at the same time for one file, e.g. covarep=1 (MATLAB licences)
+        tool_limits = {'covarep': max(args.covarep_workers, 1)}
+        for item in args.tool_limits or []:
+            tool, _, limit = item.partition('=')
+            if not limit.isdigit() or int(limit) < 1:
+                sys.exit("Please give tool limits as program=number, e.g. covarep=1: "+item)
+            tool_limits[tool] = int(limit)
+        args.tool_limits = tool_limits
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # stop the worker processes and MATLAB
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        if self.args.covarep_pool is not None:
+            self.args.covarep_pool.close()
+            self.args.covarep_pool = None
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+    # the worker processes, started with the first file that needs them
+    # (Ctrl+C only reaches the main process, which stops the workers when the pipeline is closed)
+    def workers(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.args.jobs, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+        return self.pool
+
+    # process audio files (paths) and yield their records in the order of the files
+    # index is the CorpusIndex of the input folder (made if not given), and skip_channels(file) the channels to skip (see -resume)
+    def run(self, files, index=None, skip_channels=None):
+        if index is None:
+            index = CorpusIndex(self.args.input_folder, self.args.trans_folder, self.args.audio_type)
+        # files sent to the worker processes: (file, result)
+        running = []
+        for file in files:
+            job = (file, self.args, index.entry(file), skip_channels(file) if skip_channels else ())
+            if self.args.jobs > 1:
+                while len(running) >= self.max_pending:
+                    yield self.record(*running.pop(0))
+                running.append((file, self.workers().apply_async(process_file_job, (job,))))
+            else:
+                yield self.record(file, None, job)
+        while running:
+            yield self.record(*running.pop(0))
+
+    # process audio files as they arrive in the input folder, and yield their records as they are done (until interrupted).
+    # A file is taken once its size and modification time have not changed for a full interval (it may still be copied),
+    # and at most max_pending files at a time: newer files wait in the folder until a file is done. Files for which is_done(name) is True are skipped,
+    # and files that failed are tried again if they change.
+    def watch(self, is_done=None, interval=2):
+        extension = '.'+(self.args.audio_type if self.args.audio_type else 'wav')
+        # size and modification time of the files at the last look (with the time they were first seen with them),
+        # and of the files that failed
+        last = {}
+        failed = {}
+        taken = set()
+        # files sent to the worker processes: (file, result)
+        running = []
+        while True:
+            finished = [item for item in running if item[1].ready()]
+            for item in finished:
+                running.remove(item)
+                record = self.record(*item, errors=Exception)
+                if record['error'] is not None:
+                    name = record['file'].split('/')[-1]
+                    failed[name] = last[name][0]
+                    taken.discard(name)
+                yield record
+
+            ready = []
+            if len(running) < self.max_pending:
+                for entry in sorted(os.scandir(self.args.input_folder), key=lambda entry: entry.name):
+                    name = entry.name
+                    if not name.endswith(extension) or name in taken or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    state = (stat.st_size, stat.st_mtime_ns)
+                    if failed.get(name) == state:
+                        continue
+                    if is_done is not None and is_done(name):
+                        taken.add(name)
+                    elif name in last and last[name][0] == state:
+                        if time.monotonic() - last[name][1] >= interval:
+                            ready.append(entry.path)
+                    else:
+                        last[name] = (state, time.monotonic())
+            if ready:
+                # the transcripts of the new files
+                index = CorpusIndex(self.args.input_folder, self.args.trans_folder, self.args.audio_type)
+            for file in ready[:self.max_pending - len(running)]:
+                name = file.split('/')[-1]
+                taken.add(name)
+                job = (file, self.args, index.entry(file), ())
+                if self.args.jobs > 1:
+                    running.append((file, self.workers().apply_async(process_file_job, (job,))))
+                else:
+                    record = self.record(file, None, job, errors=Exception)
+                    if record['error'] is not None:
+                        failed[name] = last[name][0]
+                        taken.discard(name)
+                    yield record
+            if not finished and not ready:
+                time.sleep(interval)
+
+    # the record of a file, from the result of a worker process or by processing the job in this process
+    # programs call sys.exit() on bad input, which fails the file only (errors: other exceptions that fail the file only)
+    def record(self, file, result, job=None, errors=RuntimeError):
+        try:
+            rows = result.get() if result is not None else process_file_job(job)
+            error = None
+        except (SystemExit, RuntimeError, errors) as err:
+            rows = []
+            error = str(err)
+        return {'file': file, 'rows': rows, 'error': error}
+
+def main(args):
+
+    # the corpus summary is combined from the partial summaries of the streaming summaries
+    if args.corpus_summary and not args.stream_frames:
+        sys.exit("Please give -stream_frames with -corpus_summary.")
+    if args.watch and args.queue:
+        sys.exit("Please give only one of -watch and -queue.")
+    corpus_summary = args.input_folder+'/'+args.corpus_summary if args.corpus_summary else None
+    pause_summary = args.input_folder+'/'+args.pause_summary if args.pause_summary else None
+
+    # list the input files (of the audio type if given, wav files otherwise), the transcripts and earlier outputs once
+    index = CorpusIndex(args.input_folder, args.trans_folder, args.audio_type)
+    filelist = index.audio
+
+    # define the output file; with -resume, files and channels that are already in the output file are skipped
+    out_file = args.input_folder+'/'+args.output_file
+    queue_dir = args.queue_dir if args.queue_dir else args.input_folder+'/.queue'
+    if args.merge:
+        # combine the output shards of the workers (see -queue) into the output file
+        try:
+            merge_shards(out_file, args.output_format, queue_dir)
+        except FileExistsError as err:
+            sys.exit(str(err))
+        if corpus_summary:
+            write_corpus_summary(corpus_summary, corpus_partials(index, args))
+        if pause_summary:
+            write_pause_summary(pause_summary, corpus_pause_segments(index, args))
+        return
+    queue = None
+    if args.queue:
+        # with a work queue, each worker writes its own output shard, which is kept between runs of the same worker
+        queue = WorkQueue(queue_dir, args.worker_id, args.lease)
+        out_file = shard_file(out_file, queue.worker_id)
+        print("Worker ", queue.worker_id, " writes to ", out_file)
+    # with -watch, files that are already in the output file are skipped, as with -resume
+    sink = make_sink(out_file, args.output_format, args.resume or args.queue or args.watch)
+    if args.resume:
+        filelist = [file for file in filelist if not sink.is_done(file.split('/')[-1])]
+
+    with Pipeline(args=args) as pipeline:
+        # process files one after another, or send them to the worker processes of the pipeline.
+        # Only the main process writes to the output file, so rows from different workers never interleave.
+        if queue is not None:
+            run_queue(queue, index, sink, pipeline)
+        elif args.watch:
+            watch_folder(pipeline, sink, args)
+        else:
+            skip_channels = (lambda file: sink.completed_channels(file.split('/')[-1])) if args.resume else None
+            for record in pipeline.run(filelist, index, skip_channels):
+                if record['error'] is not None:
+                    sys.exit(record['error'])
+                write_rows(sink, record['file'], record['rows'])
+
+    # with a work queue, the corpus summary is written when the shards are merged
+    if corpus_summary and queue is None:
+        write_corpus_summary(corpus_summary, corpus_partials(index, args))
+    if pause_summary and queue is None:
+        write_pause_summary(pause_summary, corpus_pause_segments(index, args))
+    if args.result_cache is not None:
+        print_cache_stats(pipeline.cache_stats, args.result_cache.stats())
+    if args.trace:
+        print_trace_summary()
+
+# process new audio files in the input folder as they arrive (see -watch) until interrupted (Ctrl+C)
+# a file that fails is reported and skipped, so that the other files go on
+def watch_folder(pipeline, sink, args):
+    print("Watching ", args.input_folder, " for new audio files (press Ctrl+C to stop)...")
+    try:
+        for record in pipeline.watch(sink.is_done, args.watch_interval):
+            if record['error'] is not None:
+                print("WARNING: "+record['file']+" could not be processed: "+record['error'])
+                continue
+            write_rows(sink, record['file'], record['rows'])
+    except KeyboardInterrupt:
+        print("Stopped watching ", args.input_folder)
+
+# the command line options of the pipeline
+def make_parser():
     parser = argparse.ArgumentParser(description='Extract acoustic features from audio files.')
     parser.add_argument('-output_file', type=str, required=True, help='Name the output file')
     parser.add_argument('-input_folder', type=str, required=True, help='Folder containing input wav files')
     parser.add_argument('-audio_type', type=str, required=False, help='The audio file type for processing, e.g., wav or flac')
     parser.add_argument('-openSMILE', type=bool, required=False, help='Boolean for running openSMILE')
+    parser.add_argument('-openSMILE_backend', type=str, default='subprocess', help='How openSMILE runs: subprocess (SMILExtract), or python (in this process, with the opensmile package)')
     parser.add_argument('-openSMILE_config', type=str, required=False, help='Configuration file name for openSMILE')
     parser.add_argument('-SAD', type=bool, required=False, help='Boolean for running the SAD program')
+    parser.add_argument('-SAD_backend', type=str, default='ldc', choices=['ldc', 'energy'], help='SAD program: ldc (the LDC HMM script), or energy (a fast energy-based detector that runs in the pipeline)')
     parser.add_argument('-covarep', type=bool, required=False, help='Boolean for running the covarep program')
     parser.add_argument('-forced_alignment', type=bool, required=False, help='Boolean for running the forced_aligner')
     parser.add_argument('-trans_folder', type=str, required=False, help='Folder with transcripts')
     parser.add_argument('-turn_level', type=bool, required=False, help='Boolean for summarizing measures at the turn level')
-    args = parser.parse_args()
+    parser.add_argument('-output_format', type=str, default='tsv', choices=['tsv', 'parquet'], help='Format of the output file: tsv, or parquet (a folder of Parquet files)')
+    parser.add_argument('-resume', type=bool, required=False, help='Boolean for skipping files and channels that are already in the output file')
+    parser.add_argument('-jobs', type=int, default=1, help='Number of files to process in parallel')
+    parser.add_argument('-cache_dir', type=str, required=False, help='Folder for caching the output files of the programs across runs')
+    parser.add_argument('-cache_size', type=float, default=10, help='Maximum size of the cache in GB')
+    parser.add_argument('-fa_jobs', type=int, default=4, help='Number of turns aligned in parallel by the forced aligner')
+    parser.add_argument('-covarep_workers', type=int, default=1, help='Maximum number of MATLAB sessions kept open for covarep (0 starts MATLAB for every file)')
+    parser.add_argument('-covarep_timeout', type=float, default=7200, help='Seconds a MATLAB session may take for one file before it is stopped and replaced (see -covarep_workers)')
+    parser.add_argument('-frame_store', type=bool, required=False, help='Boolean for keeping the frames of the openSMILE and covarep outputs in binary files that are read as memory-mapped arrays')
+    parser.add_argument('-stream_frames', type=int, required=False, help='Summarize the openSMILE and covarep outputs in chunks of this many frames, so that memory does not grow with the length of a recording')
+    parser.add_argument('-corpus_summary', type=str, required=False, help='Name of a tsv file with summaries by task, by audio file and over the whole corpus (needs -stream_frames)')
+    parser.add_argument('-pause_summary', type=str, required=False, help='Name of a tsv file with the speech and pause measures of every audio file, speaker and task of the corpus, from the transcripts or SAD outputs')
+    parser.add_argument('-split_minutes', type=float, required=False, help='Cut channels longer than this many minutes into segments of about this length (at pauses) that openSMILE, covarep and SAD analyze at the same time')
+    parser.add_argument('-split_jobs', type=int, default=4, help='Number of segments of a channel analyzed at the same time (see -split_minutes)')
+    parser.add_argument('-scratch_dir', type=str, required=False, help='Folder for the intermediate files (e.g. /dev/shm); files that do not fit are processed on the local disk (default: a folder in the input folder)')
+    parser.add_argument('-scratch_budget', type=float, required=False, help='Maximum size in GB of the intermediate files in -scratch_dir, shared by all runs using it (default: its free space)')
+    parser.add_argument('-named_pipes', type=bool, required=False, help='Boolean for streaming preprocessed channels to SMILExtract through named pipes instead of writing them as files')
+    parser.add_argument('-watch', type=bool, required=False, help='Boolean for processing new audio files as they arrive in the input folder, until stopped with Ctrl+C')
+    parser.add_argument('-watch_interval', type=float, default=2, help='Seconds between looks at the input folder with -watch; a file is processed once it has not changed for this long')
+    parser.add_argument('-max_pending', type=int, required=False, help='Maximum number of files being processed or waiting for a worker at a time (default: twice -jobs)')
+    parser.add_argument('-cpu_budget', type=int, required=False, help='Number of CPUs the programs of one file may use at the same time (default: number of CPUs divided by -jobs)')
+    parser.add_argument('-tool_limits', type=str, nargs='*', help='Maximum number of running stages of a program for one file, e.g. covarep=1 openSMILE=2')
+    parser.add_argument('-trace', type=str, required=False, help='JSON-lines file for the time and resources used by every stage and program')
+    parser.add_argument('-queue', type=bool, required=False, help='Boolean for claiming files from a work queue shared with other runs (workers), e.g. on other machines')
+    parser.add_argument('-queue_dir', type=str, required=False, help='Folder of the work queue (default: input_folder/.queue)')
+    parser.add_argument('-worker_id', type=str, required=False, help='Name of this worker and its output shard (default: host name and process id)')
+    parser.add_argument('-lease', type=float, default=600, help='Seconds after which the claims of a worker that stopped are taken over by other workers')
+    parser.add_argument('-merge', type=bool, required=False, help='Boolean for merging the output shards of the workers into the output file')
+    return parser
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
     
     main(args)
 
@@ -1,92 +1,218 @@
 ### This script includes functions for audio preprocessing.
+import os, subprocess, threading, time, wave
+from contextlib import contextmanager
+import numpy as np
 import sox
+from scipy.io import wavfile
+from acousticsLib.run_trace import span, wait_command
+
+# An audio file that is read (memory-mapped) once and shared by all preprocessing steps.
+# wav files are memory-mapped in place; other formats are decoded by sox once into a wav file in the scratch folder.
+# Channels are handed out as views of the same array, and the intermediate files (e.g. '_firstCH.wav') are
+# only written to the scratch folder when a program asks for their path.
+class AudioSession:
+    def __init__(self, audio_file, scratch_folder):
+        self.audio_file = audio_file
+        self.scratch_folder = scratch_folder
+        self.filename = audio_file.split('/')[-1]
+        try:
+            if not audio_file.lower().endswith('.wav'):
+                raise ValueError("not a wav file")
+            self.source = audio_file
+            self.sample_rate, self.samples = wavfile.read(audio_file, mmap=True)
+            # integer wav files (except 8-bit files, which are unsigned) are signed pcm
+            self.pcm = self.samples.dtype.kind == 'i'
+        except ValueError:
+            # other formats, and wav encodings that cannot be memory-mapped (e.g. mu-law or 24 bits)
+            # are decoded to 16-bit pcm, which can be memory-mapped; all outputs are 16 bits, and the stereo check
+            # compares the channels on the same sample scale as for 16-bit wav files
+            self.source = scratch_folder+'/'+self.filename.split('.')[0]+'_decoded.wav'
+            with span('decode'):
+                tfm = sox.Transformer()
+                tfm.set_output_format(file_type='wav', encoding='signed-integer', bits=16)
+                tfm.build_file(input_filepath=audio_file, output_filepath=self.source)
+            self.sample_rate, self.samples = wavfile.read(self.source, mmap=True)
+            # the original file is not a pcm wav file (e.g. flac), so it is converted like before
+            self.pcm = False
+        # always frames x channels
+        self.data = self.samples.reshape(len(self.samples), -1)
+        self.channels = self.data.shape[1]
+        self.n_frames = self.data.shape[0]
+        # outputs for the programs: name -> (array, convert, remix)
+        self.outputs = {}
+        # one lock per output, so that programs running at the same time write an output file only once
+        self.locks = {}
+
+    # zero-copy view of one channel
+    def channel(self, i):
+        return self.data[:, i]
+
+    # register an output file; convert=True resamples it to 16KHz, 16 bits, mono, pcm (remix=True mixes the channels first)
+    def add_output(self, name, array, convert=True, remix=False):
+        # nothing needs to be resampled if the audio is already in the output format
+        if convert and self.sample_rate == 16000 and array.dtype == np.int16:
+            convert = False
+        self.outputs[name] = (array, convert, remix)
+        self.locks[name] = threading.Lock()
+
+    # the samples of an output, if they are exactly what the written file contains (otherwise None)
+    def array(self, name):
+        array, convert, remix = self.outputs[name]
+        if convert or remix:
+            return None
+        return self.sample_rate, array
+
+    # the path of an output file; the file is written the first time it is asked for (other callers wait until it is written)
+    def path(self, name):
+        path = self.scratch_folder+'/'+name
+        with self.locks[name]:
+            if not os.path.exists(path):
+                array, convert, remix = self.outputs[name]
+                if array is self.samples:
+                    # the original file is used unchanged
+                    os.symlink(os.path.abspath(self.source), path)
+                else:
+                    write_blocks(path, array, self.sample_rate, convert, remix)
+        return path
+
+    # True if an output can be streamed to a program through a named pipe (see stream); the original file is only linked
+    def streamable(self, name):
+        array, convert, remix = self.outputs[name]
+        return not convert and array is not self.samples and hasattr(os, 'mkfifo')
+
+    # the path of a named pipe from which a program reads an output once, from start to end, instead of a file
+    # (see -named_pipes); the samples are written to the pipe by a thread while the program reads them.
+    # Only outputs that need no conversion can be streamed (see streamable).
+    @contextmanager
+    def stream(self, name):
+        array, convert, remix = self.outputs[name]
+        path = self.scratch_folder+'/pipe_'+name
+        os.mkfifo(path)
+        writer = threading.Thread(target=write_pipe, args=(path, array, self.sample_rate, remix), daemon=True)
+        writer.start()
+        try:
+            yield path
+        finally:
+            # if the program stopped before reading everything (or did not open the pipe), read the rest, so that the writer ends
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                while writer.is_alive():
+                    try:
+                        if not os.read(fd, 1048576):
+                            writer.join(0.01)
+                    except BlockingIOError:
+                        writer.join(0.01)
+            finally:
+                os.close(fd)
+                os.remove(path)
+
+# write an output to a named pipe
+def write_pipe(path, array, sample_rate, remix):
+    try:
+        with open(path, 'wb') as outFile:
+            write_wav(outFile, array, sample_rate, remix)
+    except OSError:
+        # the reader stopped early (wave then also fails to correct the header, as a pipe cannot seek)
+        pass
+
+# write an array to a 16KHz, 16 bits, mono, pcm wav file block by block, so that only one block is in memory at a time
+# if convert is True, the blocks are streamed through sox for resampling (remix=True mixes the first two channels);
+# otherwise the array is already 16KHz/16 bits and is written directly (the channels are averaged if remix is True)
+def write_blocks(path, array, sample_rate, convert, remix, chunk_frames=1048576):
+    if convert:
+        # describe the raw samples for sox
+        encoding = {'i': 'signed-integer', 'u': 'unsigned-integer', 'f': 'floating-point'}[array.dtype.kind]
+        channels = array.shape[1] if array.ndim > 1 else 1
+        command = ['sox', '-t', 'raw', '-r', str(sample_rate), '-e', encoding, '-b', str(array.dtype.itemsize*8), '-c', str(channels), '-',
+            '-t', 'wav', '-r', '16000', '-b', '16', '-c', '1', '-e', 'signed-integer', path]
+        if remix:
+            # remix the channels into one
+            command.extend(['remix', '1,2'])
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        for first in range(0, len(array), chunk_frames):
+            process.stdin.write(np.ascontiguousarray(array[first:first+chunk_frames]).tobytes())
+        process.stdin.close()
+        if wait_command(process, command, start) != 0:
+            raise RuntimeError("sox could not convert "+path)
+    else:
+        write_wav(path, array, sample_rate, remix, chunk_frames)
+
+# write 16KHz/16 bits samples to a mono wav file (a path or a file object) block by block, averaging the channels if remix is True
+# the number of frames is written in the header first, so that the file can also be written to a pipe
+def write_wav(path, array, sample_rate, remix, chunk_frames=1048576):
+    with wave.open(path, 'wb') as outFile:
+        outFile.setnchannels(1)
+        outFile.setsampwidth(2)
+        outFile.setframerate(sample_rate)
+        outFile.setnframes(len(array))
+        for first in range(0, len(array), chunk_frames):
+            block = array[first:first+chunk_frames]
+            if remix:
+                block = block.mean(axis=1).astype(np.int16)
+            outFile.writeframes(np.ascontiguousarray(block, dtype='<i2').tobytes())
+
+# compare the two channels block by block: the absolute difference between the signals, normalized by the number of frames
+# returns True if the difference is above the threshold. Only one block of each channel is in memory at a time.
+def channels_differ(first_ch, second_ch, threshold, chunk_frames=1048576):
+    n_frame = len(first_ch)
+    total = 0.0
+    for first in range(0, n_frame, chunk_frames):
+        total += np.sum(first_ch[first:first+chunk_frames], dtype=np.float64) - np.sum(second_ch[first:first+chunk_frames], dtype=np.float64)
+    return abs(total) > threshold*n_frame
 
 # checking if an audio file is stero or mono
-def check_channel(audio_file):
-    ch = sox.file_info.channels(audio_file)
-    return ch
+def check_channel(session):
+    return session.channels
 
 
 # split stereo channels into two mono wav files if the two channels are different
 # this will merge the channels (by remixing) if the channels are similar or identical
-def process_stereo(audio_file):
-    # check sampling rate and number of frames 
-    sp = sox.file_info.sample_rate(input_filepath=audio_file)
-    n_frame = sox.file_info.num_samples(input_filepath=audio_file)
-        
-    # initiate a sox transformer class
-    tfm = sox.Transformer()
-        
-    # read audio as arrays
-    array_out = tfm.build_array(input_filepath=audio_file)
-        
-    # compare the two channels -- this line calculates absolute differences between the signals and normalized the diff by the number of frames
-    first_ch = array_out[:, 0]
-    second_ch = array_out[:, 1]
-    result = abs(sum(first_ch - second_ch)/n_frame)
-    
-    # set the output format in advance (16KHz, 16 bits, mono, pcm)
-    tfm.set_output_format(file_type='wav', rate=16000, bits=16, channels=1, encoding='signed-integer')
+def process_stereo(session):
+    # compare the two channels -- absolute differences between the signals, normalized by the number of frames
+    first_ch = session.channel(0)
+    second_ch = session.channel(1)
+
+    # split channels' names will be audio_file +'_firstCH.wav' or '_secondCH.wav'
+    # the merged file name will be audio_file+'_mono.wav'
+    filename = session.filename.split('.')[0]
 
     # if the two channels are different, split the channels and save them separately.
-    if result > 0.13: ## check out the threshold value (0.13) and modify it if necessary.
-        # split channels' names will be audio_file +'_firstCH.wav' or '_secondCH.wav'
-        filename = audio_file.split('.')[0]
-        # save each channel separately
-        tfm.build_file(input_array=array_out[:, 0], output_filepath=filename+'_firstCH.wav', sample_rate_in=sp)
-        tfm.build_file(input_array=array_out[:, 1], output_filepath=filename+'_secondCH.wav', sample_rate_in=sp)
+    if channels_differ(first_ch, second_ch, 0.13): ## check out the threshold value (0.13) and modify it if necessary.
+        session.add_output(filename+'_firstCH.wav', first_ch)
+        session.add_output(filename+'_secondCH.wav', second_ch)
         # Return a value for further analysis
         return 'processed_stereo'
     # if the two channels are similar or identical, merge them and convert to mono (pcm)
     else:
-        # The new file name will be audio_file+'_mono.wav'
-        filename = audio_file.split('.')[0]
-        # remix the channels into one
-        tfm.remix(remix_dictionary={1:[1,2]})
-        tfm.build_file(input_array=array_out, output_filepath=filename+'_mono.wav', sample_rate_in=sp)
+        session.add_output(filename+'_mono.wav', session.data[:, :2], remix=True)
         # Return a value for further analysis
         return 'merged_stereo'
 
 # process single channel files
-def process_mono(audio_file):
-    # check sampling rate and number of frames 
-    sp = sox.file_info.sample_rate(input_filepath=audio_file)
-    n_frame = sox.file_info.num_samples(input_filepath=audio_file)
-    
-    # check the encoding of the audio file
-    file_type_dict = sox.file_info.info(audio_file)
-
+def process_mono(session):
     # if the file is not in pcm, conver to pcm for acoustic measurements (some programs do not run on non-linear wav files...)
-    if file_type_dict['encoding'] != 'Signed Integer PCM':
-        # initiate a sox transformer class
-        tfm = sox.Transformer()
-        # set output format
-        tfm.set_output_format(file_type='wav', rate=16000, bits=16, channels=1, encoding='signed-integer')
-        # The new file name will be audio_file+'_pcm.wav'
-        filename = audio_file.split('.')[0]
-        # save as a pcm wav file
-        tfm.build_file(input_filepath=audio_file, output_filepath=filename+'_mono.wav', sample_rate_in=sp)
-
+    if not session.pcm:
+        # The new file name will be audio_file+'_mono.wav'
+        session.add_output(session.filename.split('.')[0]+'_mono.wav', session.samples)
         # Return a value for further analysis
         return 'processed_mono'
     else:
+        session.add_output(session.filename, session.samples, convert=False)
         return 'mono'
 
-# combine stereo files for forced-alignment
-def combine_channel(audio_file, args):
-    # check sampling rate and number of frames 
-    sp = sox.file_info.sample_rate(input_filepath=audio_file)
-    # initiate a sox transformer class
-    tfm = sox.Transformer()
-    # read audio as arrays
-    array_out = tfm.build_array(input_filepath=audio_file) 
-
-    # set the output format in advance (16KHz, 16 bits, mono, pcm)
-    tfm.set_output_format(file_type='wav', rate=16000, bits=16, channels=1, encoding='signed-integer')
-
-    # The new file name will be audio_file+'_mono.wav'
-    filename = audio_file.split('/')[-1].split('.')[0]
-    # remix the channels into one
-    tfm.remix(remix_dictionary={1:[1, 2]})
-    tfm.build_file(input_array=array_out, output_filepath=args.input_folder+'/temp/'+filename+'_mono.wav', sample_rate_in=sp)
-    
+# read an audio file once as an array (frames x channels for multi-channel files)
+# wav files are memory-mapped; other formats are decoded by sox
+def read_audio(audio_file):
+    if audio_file.lower().endswith('.wav'):
+        sp, array_out = wavfile.read(audio_file, mmap=True)
+    else:
+        sp = sox.file_info.sample_rate(input_filepath=audio_file)
+        array_out = sox.Transformer().build_array(input_filepath=audio_file)
+    return int(sp), array_out
+
+# write a turn (or any part of the audio) for forced-alignment as a 16KHz, 16 bits, mono, pcm wav file,
+# the format the aligner was always given; the channels of a stereo turn are combined into one
+def write_turn(path, array_out, sample_rate):
+    convert = not (sample_rate == 16000 and array_out.dtype == np.int16)
+    write_blocks(path, array_out, sample_rate, convert, remix=array_out.ndim > 1)
@@ -0,0 +1,141 @@
+## this script cuts a long channel into segments that a program analyzes at the same time (see -split_minutes),
+## and stitches the outputs of the segments back together. Cuts are made in pauses between the turns of the transcript,
+## or at the quietest point near the planned cut if there is no transcript, always on the 10 ms frame grid of openSMILE
+## and covarep. Each segment file has split_context seconds of audio before and after its part, so that the frames
+## near a cut are computed from the same audio as in one pass over the channel, and only the frames of its own part
+## are kept from each segment: every frame of the channel comes from exactly one segment, at its time in the channel.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.io import wavfile
+from acousticsLib.run_trace import in_context
+from acousticsLib.run_programs import frame_energy
+
+# seconds between frames of openSMILE and covarep
+frame_step = 0.01
+# seconds of audio before and after the part of a segment
+split_context = 2.0
+
+# a segment file and the frames of the channel it stands for: offset is the frame of the channel at which the file
+# starts, and first and last the first frame of its part and the first frame after it (None: to the end of the channel)
+class Segment:
+    def __init__(self, path, offset, first, last):
+        self.path = path
+        self.offset = offset
+        self.first = first
+        self.last = last
+
+    # which frames of the segment output (frame numbers in the segment file) belong to the part, and their frame numbers in the channel
+    def keep(self, frames):
+        index = self.offset + np.asarray(frames, dtype=np.int64)
+        selected = index >= self.first
+        if self.last is not None:
+            selected &= index < self.last
+        return selected, index[selected]
+
+# number of segments of a channel of duration seconds (1: the channel is not split)
+def n_segments(duration, split_minutes):
+    if not split_minutes:
+        return 1
+    return max(1, int(round(duration/(split_minutes*60))))
+
+# the segments of a channel, cut the first time a program asks for them (programs of the channel run in parallel threads)
+class SplitChannel:
+    def __init__(self, split_minutes, transcript=None):
+        self.split_minutes = split_minutes
+        self.transcript = transcript
+        self.lock = threading.Lock()
+        self.segments = None
+
+    def get(self, audio_file):
+        with self.lock:
+            if self.segments is None:
+                self.segments = split_channel(audio_file, self.split_minutes, self.transcript)
+        return self.segments
+
+# parameters of the split, for the result cache (outputs of split channels can differ slightly from one pass)
+def split_params(args):
+    return ['split', args.split_minutes, split_context]
+
+# cut a channel (a wav file) into segments of about split_minutes and write the segment files next to it
+def split_channel(audio_file, split_minutes, transcript=None):
+    FS, X = wavfile.read(audio_file, mmap=True)
+    step = round(frame_step*FS)
+    n_frames = len(X)//step
+    n = n_segments(len(X)/FS, split_minutes)
+    # planned cuts at equal distances, moved to a pause within a quarter of a segment
+    window = split_minutes*60/4
+    cuts = [0]
+    for k in range(1, n):
+        cut = cut_frame(X, FS, n_frames*frame_step*k/n, window, transcript)
+        if cuts[-1] < cut < n_frames:
+            cuts.append(cut)
+    context = round(split_context/frame_step)
+    segments = []
+    for k, first in enumerate(cuts):
+        last = cuts[k+1] if k+1 < len(cuts) else None
+        offset = max(0, first - context)
+        end = None if last is None else (last + context)*step
+        path = audio_file.split('.')[0]+'_part'+str(k)+'.wav'
+        wavfile.write(path, FS, X[offset*step:end])
+        segments.append(Segment(path, offset, first, last))
+    return segments
+
+# the frame of a cut near time: the middle of the pause between turns closest to time, or the frame with the lowest
+# energy (averaged over 200 ms) within window seconds of time
+def cut_frame(X, FS, time, window, transcript=None):
+    if transcript is not None and len(transcript) > 1:
+        order = np.argsort(transcript.start, kind='stable')
+        start = transcript.start[order]
+        # end of the speech before each turn (turns can overlap)
+        speech_end = np.maximum.accumulate(transcript.end[order])
+        pause = start[1:] > speech_end[:-1]
+        middle = (start[1:][pause] + speech_end[:-1][pause])/2
+        middle = middle[np.abs(middle - time) <= window]
+        if len(middle):
+            return int(round(middle[np.argmin(np.abs(middle - time))]/frame_step))
+    step = round(frame_step*FS)
+    first = max(0, int((time - window)/frame_step))
+    samples = X[first*step:int((time + window)/frame_step)*step]
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    MS = frame_energy(samples, step, step)
+    if len(MS) == 0:
+        return int(round(time/frame_step))
+    smooth = round(0.2/frame_step)
+    MS = np.convolve(MS, np.ones(smooth)/smooth, mode='same')
+    return first + int(np.argmin(MS))
+
+# run a program on every segment, jobs segments at a time; run is called with the path of a segment file
+def run_segments(segments, run, jobs):
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return list(executor.map(in_context(lambda segment: run(segment.path)), segments))
+
+# run extract on every segment (it returns the frame times and the frames of a segment file as a data frame) and
+# return the frame times in the channel and the frames of the channel
+def extract_segments(segments, extract, jobs):
+    times, frames = [], []
+    for segment, (frame_time, df) in zip(segments, run_segments(segments, extract, jobs)):
+        selected, index = segment.keep(np.round(np.asarray(frame_time, dtype=np.float64)/frame_step))
+        times.append(index*frame_step)
+        frames.append(df.iloc[np.flatnonzero(selected)])
+    return np.concatenate(times), pd.concat(frames, ignore_index=True)
+
+# stitch the SAD outputs of the segments (start, end and label of each segment in seconds of the segment file):
+# segments are moved to the time of the channel and cut at the ends of the part, and the same labels on both
+# sides of a cut are joined
+def stitch_labels(segments, labels):
+    parts = []
+    for segment, df in zip(segments, labels):
+        shift = segment.offset*frame_step
+        first = segment.first*frame_step
+        last = np.inf if segment.last is None else segment.last*frame_step
+        df = pd.DataFrame({'start': np.clip(df['start'] + shift, first, last), 'end': np.clip(df['end'] + shift, first, last), 'segment': df['segment']})
+        parts.append(df[df['end'] > df['start']])
+    df = pd.concat(parts, ignore_index=True)
+    # a new row starts wherever the label changes
+    new = np.concatenate([[True], df['segment'].to_numpy()[1:] != df['segment'].to_numpy()[:-1]])
+    group = np.cumsum(new) - 1
+    return pd.DataFrame({'start': df['start'][new].to_numpy(), 'end': df.groupby(group)['end'].max().to_numpy(), 'segment': df['segment'][new].to_numpy()})
@@ -0,0 +1,76 @@
+## this script builds an index of the corpus once per run: the audio files, their transcripts and the output files
+## of earlier runs. Each folder is listed once, and the listing is saved with the modification time of the folder,
+## so that a later run only lists the folders that changed. The listing is saved outside the input folder
+## (in index_dir, by default the cache folder of the user), since writing it into the folder would change the
+## modification time that it is checked against.
+
+import hashlib, json, os, socket
+
+# folder of the saved listings if no index_dir is given
+default_index_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'acoustic_pipeline')
+# the output files of the programs that are saved in the input folder
+output_extensions = ['.csv', '.dat', '.lab', '.word', '.align', '.csv.frames']
+# name endings of the preprocessed channels (see process_stereo and process_mono)
+channel_suffixes = ['', '_firstCH', '_secondCH', '_mono']
+
+class CorpusIndex:
+    def __init__(self, input_folder, trans_folder=None, audio_type=None, index_dir=None):
+        self.input_folder = input_folder
+        # one saved listing per input folder
+        key = hashlib.sha1(os.path.abspath(input_folder).encode()).hexdigest()[:16]
+        self.index_file = (index_dir if index_dir else default_index_dir)+'/corpus_index_'+key+'.json'
+        self.listings = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r') as inFile:
+                    self.listings = json.load(inFile)
+            except ValueError:
+                pass
+
+        input_names = self.list_folder(input_folder)
+        # make a list of input files of the audio type (wav if not given)
+        extension = '.'+(audio_type if audio_type else 'wav')
+        self.audio = [input_folder+'/'+name for name in input_names if name.endswith(extension)]
+        # transcripts by the name of the audio file without extension
+        trans_folder = trans_folder if trans_folder else input_folder
+        self.transcripts = {}
+        for name in self.list_folder(trans_folder):
+            if name.endswith('.txt'):
+                self.transcripts[name[:-4]] = trans_folder+'/'+name
+        # output files of earlier runs in the input folder
+        self.outputs = set(name for name in input_names if any(name.endswith(extension) for extension in output_extensions))
+
+        self.save()
+
+    # names of the files in a folder, from the saved listing if the folder has not changed since
+    def list_folder(self, folder):
+        mtime = os.stat(folder).st_mtime_ns
+        listing = self.listings.get(os.path.abspath(folder))
+        if listing is None or listing['mtime'] != mtime:
+            names = sorted(entry.name for entry in os.scandir(folder) if not entry.name.startswith('.') and entry.is_file())
+            listing = {'mtime': mtime, 'names': names}
+            self.listings[os.path.abspath(folder)] = listing
+        return listing['names']
+
+    def save(self):
+        # write to a temporary file and rename, so that runs reading the index at the same time never see a partial file
+        # (the name includes the host, since runs on several machines can share the index folder)
+        temp_file = self.index_file+'.'+socket.gethostname()+'.'+str(os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            with open(temp_file, 'w') as outFile:
+                json.dump(self.listings, outFile)
+            os.replace(temp_file, self.index_file)
+        except OSError:
+            # the index is only a speed-up (e.g. the index folder is read-only)
+            pass
+
+    # the transcript and the earlier outputs of an audio file
+    def entry(self, file):
+        stem = file.split('/')[-1].split('.')[0]
+        outputs = set()
+        for suffix in channel_suffixes:
+            for extension in output_extensions:
+                if stem+suffix+extension in self.outputs:
+                    outputs.add(stem+suffix+extension)
+        return {'transcript': self.transcripts.get(stem), 'outputs': outputs}
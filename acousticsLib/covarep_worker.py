@@ -0,0 +1,155 @@
+## this script keeps MATLAB sessions open for covarep, so that MATLAB starts once per worker instead of once per file.
+## A worker runs covarep_worker.m, which reads one audio file path per line from stdin and answers with a marker line.
+## Any program that speaks the same protocol (e.g. a small stub script) can be used instead of MATLAB by passing its command.
+## A file on which covarep raises an error fails on its own, and a session that dies or does not answer in time
+## is stopped and replaced by a new one for the next file.
+
+import queue, subprocess, threading, time
+from multiprocessing.managers import BaseManager
+from acousticsLib.run_programs import acoustic_pipeline_location
+from acousticsLib.run_trace import wait_command
+
+covarep_worker_command = ['matlab', '-nodisplay', '-nosplash', '-nodesktop', '-r', 'covarep_worker']
+ready_marker = 'COVAREP_READY'
+done_marker = 'COVAREP_DONE'
+failed_marker = 'COVAREP_FAILED'
+# seconds to wait for MATLAB to start (load the paths)
+start_timeout = 600
+
+# one long-lived covarep session
+# timeout: seconds to wait for the answer to one file (None: no limit)
+class CovarepWorker:
+    def __init__(self, command=None, cwd=None, timeout=None):
+        if command is None:
+            command = covarep_worker_command
+        if cwd is None:
+            cwd = acoustic_pipeline_location
+        self.command = command
+        self.timeout = timeout
+        self.start = time.perf_counter()
+        self.process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        # the output lines of the session are read in a thread, so that waiting for them can time out
+        # (None marks the end of the output)
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read_output, daemon=True).start()
+        # wait until the paths are loaded
+        try:
+            self.wait_for(ready_marker, start_timeout)
+        except RuntimeError:
+            self.kill()
+            raise
+
+    def read_output(self):
+        for line in self.process.stdout:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    # read the output of the session until a line starts with the marker (or the failed marker)
+    # and return the line; the session is stopped if it does not answer within timeout seconds
+    def wait_for(self, marker, timeout=None):
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=None if deadline is None else max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                self.kill()
+                raise RuntimeError("The covarep worker did not answer within "+str(timeout)+" seconds.")
+            if line is None:
+                raise RuntimeError("The covarep worker exited unexpectedly.")
+            line = line.strip()
+            if line.startswith(marker) or line.startswith(failed_marker):
+                return line
+
+    # analyse one file; the output .dat file is written next to the audio file as with run_covarep
+    # an error of covarep on the file is raised as a CovarepError (the session can go on with other files)
+    def run(self, file):
+        self.process.stdin.write(file+'\n')
+        self.process.stdin.flush()
+        line = self.wait_for(done_marker, self.timeout)
+        if line.startswith(failed_marker):
+            raise CovarepError("covarep failed on "+line[len(failed_marker):].strip())
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.write('exit\n')
+                self.process.stdin.close()
+                # the trace gets the run time, CPU time and peak memory of the whole session
+                wait_command(self.process, self.command, self.start, timeout=60)
+            except (OSError, subprocess.TimeoutExpired):
+                self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+# covarep raised an error on a file (see covarep_worker.m)
+class CovarepError(RuntimeError):
+    pass
+
+# a pool of at most max_workers covarep sessions (e.g. the number of MATLAB licences)
+# sessions are started when they are first needed and reused for the following files
+# timeout: seconds a session may take for one file before it is stopped (None: no limit)
+class CovarepPool:
+    def __init__(self, max_workers=1, command=None, cwd=None, timeout=None):
+        self.max_workers = max_workers
+        self.command = command
+        self.cwd = cwd
+        self.timeout = timeout
+        self.idle = []
+        self.started = 0
+        self.changed = threading.Condition()
+
+    # take an idle session, start a new one if the cap allows it, or wait for one to be returned
+    def acquire(self):
+        with self.changed:
+            while not self.idle and self.started >= self.max_workers:
+                self.changed.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return CovarepWorker(self.command, self.cwd, self.timeout)
+        except Exception:
+            self.release(None)
+            raise
+
+    def release(self, worker):
+        with self.changed:
+            if worker is not None and worker.alive():
+                self.idle.append(worker)
+            else:
+                # a crashed session frees its slot so that a new one can be started
+                self.started -= 1
+            self.changed.notify()
+
+    def run(self, file):
+        worker = self.acquire()
+        try:
+            worker.run(file)
+        except CovarepError:
+            # the session is still running and is returned for the next file
+            raise
+        except (RuntimeError, OSError) as err:
+            # MATLAB crashed or hung on this file (e.g. the file is too large); the session is stopped,
+            # and a new one is started for the next file
+            print("WARNING: covarep crashed while analysing "+file+": "+str(err))
+            worker.close()
+            raise RuntimeError("covarep crashed while analysing "+file+": "+str(err)) from None
+        finally:
+            self.release(worker)
+
+    def close(self):
+        with self.changed:
+            while self.idle:
+                self.idle.pop().close()
+
+# a manager process holds one pool for all pipeline processes when files are processed in parallel (-jobs),
+# so that the cap on MATLAB sessions applies to the whole run
+class CovarepManager(BaseManager):
+    pass
+
+CovarepManager.register('CovarepPool', CovarepPool)
@@ -1,64 +1,110 @@
 ## This script includes functions for data conversion and summarization.
 
+import os
 import pandas as pd
 import numpy as np
 from scipy.io import loadmat
-import glob, os.path
-from acousticsLib.run_programs import run_SAD
+from acousticsLib.run_programs import run_SAD, SAD_params
+from acousticsLib.result_cache import run_cached
+from acousticsLib.streaming_stats import QuantileSketch, BucketQuantile, FramePartials
+from acousticsLib.frame_store import load_store
+from acousticsLib.audio_split import run_segments, stitch_labels, split_params
 
 
 ## functions for openSMILE measures
+# turn of every frame (-1 for frames that are not matched) and the duration of the turns in 10 ms frames
+# each frame is labelled with the last turn that started at or before its frameTime, found by a binary search over the turn starts
+def frame_turns(transcript, frame_time):
+    # calculate duration of speech segments in 10 ms frames
+    dur = (transcript.end - transcript.start) / 0.01
+    # turns shorter than one frame (10 ms) never label any frame
+    turns = np.flatnonzero(dur >= 1)
+    turns = turns[np.argsort(transcript.start[turns], kind='stable')]
+    # turn of every frame (frames before the first turn are not matched)
+    turn_idx = np.searchsorted(transcript.start[turns], frame_time, side='right') - 1
+    turn_idx = np.where(turn_idx >= 0, turns[np.maximum(turn_idx, 0)], -1)
+    return turn_idx, dur
+
 # merge transcript and outputs
 def merge_transcript(transcript, df):
-    # calculate duration of speech segments in milliseconds
-    transcript['dur'] = (transcript['end'] - transcript['start']) / 0.01
-    # repeat the row by the duration of speech segments (rounded)
-    transcript_new = transcript.loc[transcript.index.repeat(transcript.dur)].reset_index()
-    # rename the start time for merging
-    transcript_new.rename(columns={'start':'frameTime'}, inplace=True)
-    # merge the transcript and openSMILE output file 
-    merged_df = pd.merge_asof(df, transcript_new, on='frameTime')
-    return merged_df
+    turn_idx, dur = frame_turns(transcript, df['frameTime'].to_numpy())
+    # merge the transcript and openSMILE output file; unmatched frames get NaN
+    # (the columns are added at once: output frames can have one block per column, which pandas warns about on every insert)
+    turns = pd.DataFrame({'transcript': np.where(turn_idx >= 0, transcript.text[turn_idx], np.nan),
+        'speaker': transcript.speaker_names(turn_idx), 'task': transcript.task_names(turn_idx),
+        'dur': np.where(turn_idx >= 0, dur[turn_idx], np.nan)}, index=df.index)
+    return pd.concat([df, turns], axis=1)
 
 # calculate global stat values of low-level descriptors
-def calculate_statistics(df, features, feature_names, openSMILE=False):
-    # initiate a temporary list <- this will be added as a new row in the output dataframe.
-    temp = []
-    for feature in features:
-        if openSMILE:
-            # for pitch features, normalize the values
-            if feature == "F0final_sma" or feature== "F0final_sma_de":
-                # remove all frames when pitch = 0 Hz 
-                df = df[df.F0final_sma > 0]
-                # remove all frames with low voicing probability
-                df = df[df.voicingFinalUnclipped_sma > 0.5]
-                ## Normalize pitch values
-                df.F0final_sma = np.log2(df.F0final_sma / df.F0final_sma.quantile(0.1))*12
-        else:
-            df = df[df['VUV'] > 0.5]
-    
-        ## calculate statistical functionals for each feature
-        mean = df[feature].mean()
-        sd = df[feature].std()
-        median = df[feature].median()
-        iqr = df[feature].quantile(0.75) - df[feature].quantile(0.25)
-        # add to the temp list
-        temp.extend([mean, sd, median, iqr])
-    temp = pd.DataFrame([temp], columns=feature_names)
+# all features of all groups are summarized in one grouped pass; returns one row per group with feature_names and the keys as columns
+def calculate_statistics(df, keys, features, feature_names, openSMILE=False):
+    features = list(features)
+    grouped = df.groupby(keys, sort=True)
+    # group number of each frame (NaN for frames that are not in any group, e.g. frames before the first turn)
+    group = grouped.ngroup()
+    in_group = group.notna().to_numpy()
+    group = group[in_group].astype(int).to_numpy()
+    # one float matrix (frames x features) for the frames that are in a group
+    values = df.loc[in_group, features].to_numpy(dtype=np.float64, copy=True)
+
+    if openSMILE:
+        # pitch features are summarized over voiced frames only. As in the original per-feature loop, every time a
+        # pitch feature is reached, frames with pitch <= 0 (after any earlier normalization) or low voicing probability 
+        # are masked for that feature and all features after it, and the pitch values are normalized again.
+        pitch = [i for i, feature in enumerate(features) if feature == "F0final_sma" or feature == "F0final_sma_de"]
+        if pitch:
+            f0 = df.loc[in_group, 'F0final_sma'].to_numpy(dtype=np.float64)
+            voicing = df.loc[in_group, 'voicingFinalUnclipped_sma'].to_numpy()
+            keep = np.ones(len(f0), dtype=bool)
+            for first, last in zip(pitch, pitch[1:] + [len(features)]):
+                keep &= (f0 > 0) & (voicing > 0.5)
+                ## Normalize pitch values (semitones relative to the 10th percentile of the group)
+                floor = pd.Series(np.where(keep, f0, np.nan)).groupby(group).quantile(0.1)
+                # unvoiced frames (pitch = 0) are masked below, so their log values do not matter
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    f0 = np.log2(f0 / floor.reindex(group).to_numpy())*12
+                if features[first] == "F0final_sma":
+                    values[:, first] = f0
+                values[~keep, first:last] = np.nan
+    else:
+        # covarep features are summarized over voiced frames only
+        values[~(df.loc[in_group, 'VUV'].to_numpy() > 0.5), :] = np.nan
+
+    ## calculate statistical functionals for each feature
+    grouped_values = pd.DataFrame(values).groupby(group)
+    mean = grouped_values.mean().to_numpy()
+    sd = grouped_values.std().to_numpy()
+    median = grouped_values.median().to_numpy()
+    iqr = grouped_values.quantile(0.75).to_numpy() - grouped_values.quantile(0.25).to_numpy()
+    # interleave as feature_mean, feature_sd, feature_median, feature_iqr
+    stats = np.stack([mean, sd, median, iqr], axis=2).reshape(len(mean), -1)
+    temp = pd.DataFrame(stats, columns=feature_names)
+    # include information in the key
+    group_keys = grouped.size().index
+    for i, key in enumerate(keys):
+        temp[key] = group_keys.get_level_values(i)
     return temp
 
 # summarize output files 
-def summarize_measures(file, transfile, turn_df, speaker_df, args, openSMILE=False):
-    if openSMILE:
+# frames are the frames of the output file if a program that runs in this process handed them over (see -openSMILE_backend)
+def summarize_measures(file, transcript, turn_df, speaker_df, args, openSMILE=False, frames=None):
+    # with -stream_frames, the output file is read and summarized in chunks of frames, so that memory stays bounded
+    if args.stream_frames:
+        # only the header is read here
+        features = (frames if frames is not None else read_frames(file, openSMILE, args, nrows=0)).columns
+        if openSMILE:
+            features = features[2:]
+
+    elif openSMILE:
         # open openSMILE output file as a pd data frame
-        df = pd.read_csv(file, sep=";")
+        df = frames if frames is not None else read_frames(file, True, args)
         # check the names of features
         features = df.columns 
         features = features[2:]
 
     else:
         # open covarep output file as a pd data frame
-        df = pd.read_csv(file, sep="\t")
+        df = read_frames(file, False, args)
         # check the names of features
         features = df.columns 
         df['frameTime'] = df.index * 0.01
@@ -84,50 +130,39 @@ def summarize_measures(file, transfile, turn_df, speaker_df, args, openSMILE=Fal
     else:
         pass
 
-    # check if a transcript file exists
-    if os.path.exists(transfile):
-        # open transcript file 
-        transcript = pd.read_csv(transfile, sep='\t', names=['file','start','end','transcript','speaker', 'task'])
-        # merge it with the openSMILE output file
-        merged_df = merge_transcript(transcript, df)
-    
-    # if transcript does not exist, it assumes there's only one speaker and summarizes the entire file.
-    else:
+    if transcript is None:
         print("WARNING: There's no matching transcript file. The program assumes that there's one speaker.")
-        merged_df = df
-        # add NaN values for transcript headers so that the following codes can run
-        merged_df['task'] = np.nan
-        merged_df['speaker'] = np.nan
-
-    # make the columns as string type so that transcripts can be processed. 
-    merged_df['task'] = merged_df['task'].astype(str)
-    merged_df['transcript'] = merged_df['transcript'].astype(str)
-    merged_df['speaker'] = merged_df['speaker'].astype(str)
-    merged_df['filename'] = file.split('.')[0]
-    
-    # intermediate data frames
-    interDf = pd.DataFrame()
-    interDf2 = pd.DataFrame()
-    # loop through groupby objects for turn-level
-    for key, grouped_df in merged_df.groupby(['speaker', 'task', 'transcript', 'dur', 'filename']):
-        temp = calculate_statistics(grouped_df, features, feature_names, openSMILE)
-        # include information in the key
-        temp['speaker'] = key[0] 
-        temp['task'] = key[1] 
-        temp['transcript'] = key[2] 
-        temp['dur'] = key[3] 
-        temp['filename'] = key[4]
+
+    if args.stream_frames:
+        # turn-level and speaker-level summaries from one scan of the file
+        interDf, interDf2, speaker_partials = stream_statistics(file, transcript, features, feature_names, openSMILE, args, frames)
+
+    else:
+        # check if a transcript file exists
+        if transcript is not None:
+            # merge it with the openSMILE output file
+            merged_df = merge_transcript(transcript, df)
         
-        interDf = pd.concat([interDf, temp], sort=False)
+        # if transcript does not exist, it assumes there's only one speaker and summarizes the entire file.
+        else:
+            # add NaN values for transcript headers so that the following codes can run
+            merged_df = pd.concat([df, pd.DataFrame({'task': np.nan, 'speaker': np.nan}, index=df.index)], axis=1)
+
+        # make the columns as string type so that transcripts can be processed. 
+        merged_df['task'] = merged_df['task'].astype(str)
+        merged_df['transcript'] = merged_df['transcript'].astype(str)
+        merged_df['speaker'] = merged_df['speaker'].astype(str)
+        merged_df = pd.concat([merged_df, pd.DataFrame({'filename': file.split('.')[0]}, index=merged_df.index)], axis=1)
+        
+        # turn-level summary
+        interDf = calculate_statistics(merged_df, ['speaker', 'task', 'transcript', 'dur', 'filename'], features, feature_names, openSMILE)
     
     # drop speakers who were not on the channel for stereo files
-    include_speaker = []
-    for key, grouped_df in interDf.groupby('speaker'):
-        # drop the speaker if the values in the first column contains NaN value 50% of the time.
-        if grouped_df.iloc[:, 1].isna().sum() > (0.5 * len(grouped_df)):
-            pass
-        else:
-            include_speaker.append(key)
+    # drop the speaker if the values in the first column contains NaN value 50% of the time.
+    nan_share = interDf.iloc[:, 1].isna().groupby(interDf['speaker']).mean()
+    include_speaker = nan_share[nan_share <= 0.5].index.tolist()
+    if args.stream_frames and args.corpus_summary:
+        save_partials(file, features, speaker_partials, include_speaker)
     
     # if turn_level is true, return turn-level summarized df (only for speakers that were on the channel)
     if args.turn_level:
@@ -139,13 +174,8 @@ def summarize_measures(file, transfile, turn_df, speaker_df, args, openSMILE=Fal
         
     # if not, return speaker-level summarized df
     else: 
-        # loop through groupby objects.
-        for key, grouped_df in merged_df.groupby(['speaker', 'task', 'filename']):
-            temp2 = calculate_statistics(grouped_df, features, feature_names, openSMILE)
-            temp2['speaker'] = key[0] 
-            temp2['task'] = key[1] 
-            temp2['filename'] = key[2]
-            interDf2 = pd.concat([interDf2, temp2], sort=False)
+        if not args.stream_frames:
+            interDf2 = calculate_statistics(merged_df, ['speaker', 'task', 'filename'], features, feature_names, openSMILE)
         
         # return a df for speakers who were on the channel
         if include_speaker:
@@ -154,51 +184,272 @@ def summarize_measures(file, transfile, turn_df, speaker_df, args, openSMILE=Fal
             speaker_df = pd.concat([speaker_df, interDf2])
         return speaker_df
 
-## summarize SAD outputs
-def summarize_SAD(file, transfile, SADdf, args, count):
-    # look up where the transcript file is.. 
-    if args.trans_folder:
-        list_of_trans = glob.glob(args.trans_folder+'/*.txt')
-        
+# read an openSMILE or covarep output file, from its frame store with -frame_store (see frame_store.py)
+def read_frames(file, openSMILE, args, nrows=None):
+    if use_store(file, openSMILE, args):
+        return load_store(file, openSMILE).frame(last=nrows)
+    return pd.read_csv(file, sep=";" if openSMILE else "\t", nrows=nrows)
+
+# programs that run in this process only write a frame store, not the text output file (see -openSMILE_backend)
+def use_store(file, openSMILE, args):
+    return args.frame_store or not os.path.exists(file) or (openSMILE and args.openSMILE_backend != 'subprocess')
+
+## streaming summaries (see -stream_frames)
+# read an openSMILE or covarep output file in chunks of frames; yields each chunk with the time of its frames
+# frames are the frames of the file if they are already in memory
+def read_chunks(file, openSMILE, chunk_frames, args, usecols=None, frames=None):
+    if frames is not None:
+        for first in range(0, len(frames), chunk_frames):
+            chunk = frames.iloc[first:first+chunk_frames]
+            yield (chunk if usecols is None else chunk[usecols]), chunk['frameTime'].to_numpy(dtype=np.float64)
+        return
+    if use_store(file, openSMILE, args):
+        store = load_store(file, openSMILE)
+        for first in range(0, store.n_frames, chunk_frames):
+            yield store.frame(first, first+chunk_frames, usecols), store.frame_time[first:first+chunk_frames]
+        return
+    first = 0
+    for chunk in pd.read_csv(file, sep=";" if openSMILE else "\t", chunksize=chunk_frames, usecols=usecols):
+        if openSMILE:
+            frame_time = chunk['frameTime'].to_numpy(dtype=np.float64)
+        else:
+            # covarep frames are 10 ms apart
+            frame_time = (first + np.arange(len(chunk))) * 0.01
+        first += len(chunk)
+        yield chunk, frame_time
+
+# units of the frames of a file: one per turn and one for the frames without a turn. Frames are summarized by unit,
+# and the units are rolled up into the turn-level and speaker-level groups (see stream_statistics).
+# Returns the keys of the groups and the group of every unit (-1: left out) for both levels
+def stream_groupings(transcript):
+    if transcript is not None:
+        # speaker, task, text and duration of every turn
+        speakers = np.asarray(transcript.speaker_names(), dtype=object).astype(str)
+        tasks = np.asarray(transcript.task_names(), dtype=object).astype(str)
+        texts = transcript.text.astype(str)
+        dur = (transcript.end - transcript.start) / 0.01
     else:
-        list_of_trans = glob.glob(args.input_folder+'/*.txt')
-       
+        speakers = tasks = texts = dur = []
 
-    if transfile in list_of_trans:
+    # turn level: turns with the same speaker, task, text and duration are one group; frames without a turn are left out
+    turn_keys = {}
+    turn_of = [turn_keys.setdefault((speakers[t], tasks[t], texts[t], dur[t]), len(turn_keys)) for t in range(len(speakers))] + [-1]
+    # speaker level: frames without a turn are a group of their own ('nan' speaker and task)
+    speaker_keys = {}
+    speaker_of = [speaker_keys.setdefault((speakers[t], tasks[t]), len(speaker_keys)) for t in range(len(speakers))]
+    speaker_of.append(speaker_keys.setdefault(('nan', 'nan'), len(speaker_keys)))
+    return [(list(turn_keys), np.array(turn_of)), (list(speaker_keys), np.array(speaker_of))]
+
+# pitch after each normalization and the voiced frames of each pitch feature (as in calculate_statistics), with the
+# floors (10th percentile of pitch) of the groups; the last floor of each level is NaN, for frames without a group (-1)
+def pitch_levels(f0, voicing, floors, group):
+    levels = [f0]
+    keeps = [(f0 > 0) & (voicing > 0.5)]
+    for floor in floors:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f0 = np.log2(f0 / floor[group])*12
+        levels.append(f0)
+        keeps.append(keeps[-1] & (f0 > 0) & (voicing > 0.5))
+    return levels, keeps
+
+# passes over the pitch columns of an openSMILE output: the exact floors of every group for the first n_floors
+# normalizations, which normalize F0final_sma and decide the voiced frames of the pitch features after the first one;
+# one list of floors per grouping. Each floor takes two passes: a sketch of the pitch finds the buckets that hold the
+# 10th percentile, and only the pitch values of those buckets are kept in the second pass (see BucketQuantile).
+def pitch_floors(file, frame_units, groupings, n_floors, args, frames=None):
+    floors = [[] for grouping in groupings]
+
+    # the groups and the voiced pitch (at the current level) of every frame of a chunk, by grouping
+    def pitch_chunks():
+        for chunk, frame_time in read_chunks(file, True, args.stream_frames, args, usecols=['frameTime', 'F0final_sma', 'voicingFinalUnclipped_sma'], frames=frames):
+            unit = frame_units(frame_time)
+            f0 = chunk['F0final_sma'].to_numpy(dtype=np.float64)
+            voicing = chunk['voicingFinalUnclipped_sma'].to_numpy()
+            pitch = []
+            for (keys, group_of), grouping_floors in zip(groupings, floors):
+                group = group_of[unit]
+                selected = group >= 0
+                levels, keeps = pitch_levels(f0[selected], voicing[selected], grouping_floors, group[selected])
+                pitch.append((group[selected], np.where(keeps[-1], levels[-1], np.nan)))
+            yield pitch
+
+    for level in range(n_floors):
+        sketches = [QuantileSketch(len(keys), 1) for keys, group_of in groupings]
+        for pitch in pitch_chunks():
+            for (group, values), sketch in zip(pitch, sketches):
+                sketch.add(group, values[:, None])
+        selectors = [BucketQuantile(sketch, 0.1) for sketch in sketches]
+        for pitch in pitch_chunks():
+            for (group, values), selector in zip(pitch, selectors):
+                selector.add(group, values)
+        for selector, grouping_floors in zip(selectors, floors):
+            grouping_floors.append(np.append(selector.quantile(), np.nan))
+    return floors
+
+# mean, sd, median and IQR of partials (groups x features each); the sketch of the pitch column (if any) has the pitch
+# (or its ratio to the floor of the speaker, see save_partials), which is summarized in semitones above floor
+def partial_statistics(partials, pitch_column, floor=1):
+    mean, sd, median, iqr = partials.statistics()
+    if pitch_column >= 0:
+        q25, q50, q75 = [partials.sketch.quantile(q)[:, pitch_column]/floor for q in (0.25, 0.5, 0.75)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            median[:, pitch_column] = np.log2(q50)*12
+            iqr[:, pitch_column] = (np.log2(q75) - np.log2(q25))*12
+    return mean, sd, median, iqr
+
+# one row per group with frames (as calculate_statistics), sorted by the keys; columns are the features to include
+def partial_summary(partials, pitch_column, feature_names, key_names, keys, columns=None, floor=1):
+    mean, sd, median, iqr = partial_statistics(partials, pitch_column, floor)
+    columns = list(range(partials.n_columns)) if columns is None else columns
+    stats = np.stack([mean, sd, median, iqr], axis=2)[:, columns].reshape(partials.n_groups, 4*len(columns))
+    present = partials.frames > 0
+    temp = pd.DataFrame(stats[present], columns=[feature_names[4*c + i] for c in columns for i in range(4)])
+    for i, key in enumerate(key_names):
+        temp[key] = [group_keys[i] for group_keys, has_frames in zip(keys, present) if has_frames]
+    return temp.sort_values(key_names, kind='stable').reset_index(drop=True)
+
+# summarize an openSMILE or covarep output file chunk by chunk.
+# The frames are read once into mergeable partial summaries by unit (turn, and for openSMILE, how many pitch features
+# the frame is voiced for at each level), which are rolled up into the turn-level and speaker-level summaries.
+# Returns both summaries (None if not needed) and the speaker-level partials (see save_partials).
+# Means and sds are exact (the floors of the pitch, which decide the voiced frames, are found exactly before, see
+# pitch_floors); medians and IQRs are estimated within 1%.
+def stream_statistics(file, transcript, features, feature_names, openSMILE, args, frames=None):
+    features = list(features)
+    groupings = stream_groupings(transcript)
+    n_units = len(groupings[0][1])
+
+    def frame_units(frame_time):
+        if transcript is None:
+            return np.full(len(frame_time), n_units - 1)
+        turn_idx = frame_turns(transcript, frame_time)[0]
+        return np.where(turn_idx >= 0, turn_idx, n_units - 1)
+
+    # pitch features split the features into segments; frames are summarized for the features of segment j if they are
+    # voiced for the first j+1 pitch features (depth > j), which depends on the floors of the level (turn or speaker)
+    pitch = [i for i, feature in enumerate(features) if feature == "F0final_sma" or feature == "F0final_sma_de"] if openSMILE else []
+    segment = np.searchsorted(pitch, np.arange(len(features)), side='right') - 1
+    # F0final_sma is normalized with the floor of its level once (it comes before its delta in openSMILE outputs)
+    pitch_column = features.index("F0final_sma") if "F0final_sma" in features and pitch else -1
+    depths = len(pitch) + 1
+    n_classes = depths**2 if pitch else 1
+    # (the first floor of each level also normalizes F0final_sma)
+    floors = pitch_floors(file, frame_units, groupings, max(len(pitch) - 1, 1), args, frames) if pitch else None
+
+    partials = FramePartials(n_units*n_classes, len(features))
+    for chunk, frame_time in read_chunks(file, openSMILE, args.stream_frames, args, frames=frames):
+        unit = frame_units(frame_time)
+        # openSMILE files start with name and frameTime
+        values = chunk.iloc[:, 2:] if openSMILE else chunk
+        values = values.to_numpy(dtype=np.float64, copy=True)
+        sketch_values = None
+        group = unit*n_classes
+        if pitch:
+            f0 = chunk['F0final_sma'].to_numpy(dtype=np.float64)
+            voicing = chunk['voicingFinalUnclipped_sma'].to_numpy()
+            for (keys, group_of), grouping_floors, scale in zip(groupings, floors, [depths, 1]):
+                levels, keeps = pitch_levels(f0, voicing, grouping_floors, group_of[unit])
+                group += np.sum(keeps, axis=0)*scale
+            if pitch_column >= 0:
+                # moments of the pitch in semitones (shifted by the floor of each group later), and a sketch of the pitch
+                sketch_values = values.copy()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    values[:, pitch_column] = np.where(f0 > 0, np.log2(f0)*12, np.nan)
+        elif not openSMILE:
+            # covarep features are summarized over voiced frames only
+            values[~(chunk['VUV'].to_numpy() > 0.5), :] = np.nan
+        partials.add(group, values, sketch_values)
+
+    # roll the units up into the groups of a level (0: turn, 1: speaker), for the given features only;
+    # returns the partials and the pitch floor of every group
+    def rollup(level, columns=None):
+        keys, group_of = groupings[level]
+        units = np.arange(partials.n_groups)
+        depth = units % n_classes // depths if level == 0 else units % depths
+        keep = np.ones((partials.n_groups, len(features)), dtype=bool)
+        if pitch:
+            keep &= depth[:, None] > segment[None, :]
+        if columns is not None:
+            keep[:, [c for c in range(len(features)) if c not in columns]] = False
+        result = partials.rollup(group_of[units // n_classes], len(keys), keep)
+        floor = np.ones(len(keys))
+        if pitch_column >= 0:
+            # normalize pitch: semitones above the floor of the group
+            floor = floors[level][0][:-1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result.moments.mean[:, pitch_column] -= np.log2(floor)*12
+        return result, floor
+
+    filename = file.split('.')[0]
+    # without -turn_level, the turn-level summary is only used to find the speakers of the channel (first feature)
+    columns = None if args.turn_level else [0]
+    turn_partials, floor = rollup(0, columns)
+    interDf = partial_summary(turn_partials, pitch_column, feature_names, ['speaker', 'task', 'transcript', 'dur'], groupings[0][0], columns, floor)
+    interDf['filename'] = filename
+    speaker_partials = None
+    interDf2 = None
+    if not args.turn_level or args.corpus_summary:
+        speaker_partials, floor = rollup(1)
+        interDf2 = partial_summary(speaker_partials, pitch_column, feature_names, ['speaker', 'task'], groupings[1][0], floor=floor)
+        interDf2['filename'] = filename
+        speaker_partials = (speaker_partials, floor, groupings[1][0], pitch_column)
+    return interDf, interDf2, speaker_partials
+
+# save the speaker-level partials of the speakers on the channel next to the output file of the program
+# (output_file.partials.npz), for the corpus summary (see -corpus_summary)
+def save_partials(file, features, speaker_partials, include_speaker):
+    partials, floor, keys, pitch_column = speaker_partials
+    if pitch_column >= 0:
+        # the speakers of the corpus have different floors, so the pitch is pooled as a ratio to the floor
+        partials.sketch.scale(pitch_column, 1/floor)
+    selected = np.array([(not include_speaker or speaker in include_speaker) for speaker, task in keys], dtype=bool) & (partials.frames > 0)
+    group_of = np.where(selected, np.cumsum(selected) - 1, -1)
+    partials.rollup(group_of, int(selected.sum())).save(file+'.partials.npz', features=np.array(list(features), dtype=str),
+        speaker=np.array([key[0] for key, keep in zip(keys, selected) if keep], dtype=str),
+        task=np.array([key[1] for key, keep in zip(keys, selected) if keep], dtype=str),
+        filename=np.array([file.split('.')[0]]*int(selected.sum()), dtype=str), pitch_column=pitch_column)
+
+# combine the speaker-level partials of all channels (see save_partials) into summaries by task, by audio file and over
+# the whole corpus, without reading the frames again; partials_files has the partials files of every program
+def write_corpus_summary(out_file, partials_files):
+    summary = None
+    for program, files in partials_files.items():
+        loaded = [FramePartials.load(path) for path in files]
+        if not loaded:
+            continue
+        features = list(loaded[0][1]['features'])
+        same = [(part, info) for part, info in loaded if list(info['features']) == features]
+        if len(same) < len(loaded):
+            print("WARNING: ", len(loaded) - len(same), program+" output files have other features than the first one and are not in the corpus summary.")
+        partials = FramePartials.concat([part for part, info in same])
+        pitch_column = int(same[0][1]['pitch_column'])
+        feature_names = [feature+stat for feature in features for stat in ['_mean', '_sd', '_median', '_iqr']]
+        levels = []
+        for level, key in [('task', 'task'), ('file', 'filename'), ('corpus', None)]:
+            names = np.concatenate([info[key] for part, info in same]) if key else np.full(partials.n_groups, 'all')
+            groups, group_of = np.unique(names, return_inverse=True)
+            temp = partial_summary(partials.rollup(group_of, len(groups)), pitch_column, feature_names, ['group'], [(group,) for group in groups])
+            temp.insert(0, 'level', level)
+            temp.insert(1, 'group', temp.pop('group'))
+            levels.append(temp)
+        temp = pd.concat(levels, ignore_index=True)
+        summary = temp if summary is None else pd.merge(summary, temp, how='outer', on=['level', 'group'])
+    if summary is None:
+        print("WARNING: There are no partial summaries for the corpus summary.")
+        return
+    summary.to_csv(out_file, sep='\t', index=False)
+    print("The corpus summary is saved in ", out_file)
+
+## summarize SAD outputs
+def summarize_SAD(file, transcript, SADdf, args, count):
+    # transcript is None if there is no transcript for the file
+    if transcript is not None:
         # do not summarize measures repeatedly for stereo files
         if count < 2:
-            # read transcript file
-            df = pd.read_csv(transfile, names=['filename', 'start', 'end', 'transcripts','speaker','task'], sep='\t')
-            # change the data type of task in case it's NaN
-            df['task'] = df['task'].astype(str)
-            # calculate speech segment duration
-            df['dur'] = df['end'] - df['start']
-            # shift the end time of previous speech segment duration to calculate pause duration between two speech segments
-            df['pause_end'] = df['end'].shift(1)
-            df['prev_pause'] = df['start'] - df['pause_end']
-            # in case of overlapping speech (when prev pause duration is negative), assume the pause duration is 0
-            df.loc[df.prev_pause < 0,'prev_pause'] = 0
-            # get task start and end time for total time
-            task_start = df.groupby(by=['task'])['start'].min()
-            task_end = df.groupby(by=['task'])['end'].max()
-            total_dur = df.groupby(by=['speaker','task'])['prev_pause'].agg([np.sum])+ df.groupby(by=['speaker','task'])['dur'].agg([np.sum])
-            # calculate speech segment related measures
-            spch = df.groupby(by=['speaker','task'])['dur'].agg([np.sum, np.mean, np.std])
-            # calculate pause segment related measures
-            nonspch = df.groupby(by=['speaker','task'])['prev_pause'].agg([np.sum, np.mean, np.std])
-            # percent_spch = (df.groupby(by=['speaker','task'])['dur'].sum() / total_dur)
-		    # get number of pauses and calculate pause rate per minute
-            numPause = df.groupby(by=['speaker','task'])['prev_pause'].count()
-            # concat all measures 
-            temp = pd.concat([total_dur, spch, nonspch, numPause], axis=1)
-            # add column names
-            temp.columns = ['total_dur', 'totalSpch', 'meanSpch','stdSpch', 'totalPause', 'meanPause','stdPause', 'numPause']
-            # calculate other measures
-            temp['pause_rate'] = (temp.numPause / temp.total_dur ) *60
-            temp['task_start'] = task_start[0]
-            temp['task_end'] = task_end[0]
-            #temp['filename'] = file.split('/')[-1]
-            temp = temp.reset_index()
+            # measures by speaker and task, with the start and end time of each task
+            temp = summarize_pauses(transcript_segments(transcript, file.split('/')[-1]))
+            # the file name is left out, as before
+            temp = temp.drop(columns=['filename'])
             
             # concat with the large data frame
             SADdf = pd.concat([SADdf, temp], sort=False)
@@ -210,31 +461,115 @@ def summarize_SAD(file, transfile, SADdf, args, count):
             return SADdf
     else:
         # if no transcript, run SAD
-        run_SAD(file, args)
-        # open SAD output file
-        SAD_outfile = file.split('.')[0]+'.lab'
-        df = pd.read_csv(SAD_outfile, names=['start','end','segment'], sep=" ")
-        # measure duration of each segment
-        df['dur'] = df['end'] - df['start']
-        total_dur = df['end'].max()
-        # calculate measures 
-        spch = pd.DataFrame(df[df.segment=="speech"]['dur'].agg([np.sum, np.mean, np.std])).T
-        nonspch = pd.DataFrame(df[df.segment=="nonspeech"]['dur'].agg([np.sum, np.mean, np.std])).T
-        pause_rate = (len(df[df.segment=="nonspeech"]) / total_dur) * 60
-        # concat each df and name the columns
-        temp = pd.concat([spch, nonspch], axis=1)
-        temp.columns = ['totalSpch', 'meanSpch','stdSpch', 'totalPause', 'meanPause','stdPause']
-        # add more information
-        temp['total_dur'] = total_dur
-        temp['pause_rate'] = pause_rate
-        temp['filename'] = file.split('/')[-1]
-        # include placeholders for the final output file later.
-        temp['speaker'] = 'nan'
-        temp['task'] = 'nan'
+        SAD_outfile = SAD_output(file, args)
+        # measures over the whole file; the speaker and task are placeholders for the final output file later
+        temp = summarize_pauses(lab_segments(SAD_outfile, file.split('/')[-1]))
+        temp = temp.drop(columns=['task_start', 'task_end'])
         # concat with the large data frame
         SADdf = pd.concat([SADdf, temp])
         return SADdf
 
+# segment table of a transcript: one row per turn, with the turn duration (speech) and the pause between the end of
+# the previous turn and the turn (pause; 0 for overlapping speech, NaN for the first turn)
+def transcript_segments(transcript, filename):
+    prev_end = np.concatenate([[np.nan], transcript.end[:-1]])
+    return pd.DataFrame({'filename': filename,
+        'speaker': np.asarray(transcript.speaker_names(), dtype=object), 'task': np.asarray(transcript.task_names(), dtype=object),
+        'start': transcript.start, 'end': transcript.end,
+        'speech': transcript.end - transcript.start, 'pause': np.maximum(transcript.start - prev_end, 0)})
+
+# segment table of a SAD output file: one row per speech or nonspeech segment (speech and pause are NaN for the other
+# kind of segment); speaker and task are 'nan'
+def lab_segments(SAD_outfile, filename):
+    df = pd.read_csv(SAD_outfile, names=['start','end','segment'], sep=" ")
+    start, end = df['start'].to_numpy(dtype=np.float64), df['end'].to_numpy(dtype=np.float64)
+    dur = end - start
+    return pd.DataFrame({'filename': filename, 'speaker': 'nan', 'task': 'nan', 'start': start, 'end': end,
+        'speech': np.where(df['segment'] == 'speech', dur, np.nan), 'pause': np.where(df['segment'] == 'nonspeech', dur, np.nan)})
+
+# speech and pause measures of every file x speaker x task of a segment table (e.g. the segment tables of all files
+# of a corpus, stacked with pd.concat), in one pass over the table. Rows are sorted by file, speaker and task.
+# total_dur is the speech and pause time of the group, and task_start and task_end are the first and last time of its task.
+def summarize_pauses(segments):
+    keys = ['filename', 'speaker', 'task']
+    codes, names = zip(*[pd.factorize(segments[key], sort=True) for key in keys])
+    # rows with a missing key are left out, as groupby does
+    valid = np.all([code >= 0 for code in codes], axis=0)
+    # one number for each file x speaker x task, and for each file x task
+    cell = np.zeros(len(segments), dtype=np.int64)
+    for code, name in zip(codes, names):
+        cell = cell*len(name) + code
+    task_cell = codes[0].astype(np.int64)*len(names[2]) + codes[2]
+    cells, group = np.unique(cell[valid], return_inverse=True)
+    n_groups = len(cells)
+
+    spch = group_moments(group, n_groups, segments['speech'].to_numpy(dtype=np.float64)[valid])
+    nonspch = group_moments(group, n_groups, segments['pause'].to_numpy(dtype=np.float64)[valid])
+
+    # task start and end time by file x task (turns of a task by any speaker)
+    task_cells, task_group = np.unique(task_cell[valid], return_inverse=True)
+    task_start = np.full(len(task_cells), np.inf)
+    task_end = np.full(len(task_cells), -np.inf)
+    np.minimum.at(task_start, task_group, segments['start'].to_numpy(dtype=np.float64)[valid])
+    np.maximum.at(task_end, task_group, segments['end'].to_numpy(dtype=np.float64)[valid])
+
+    # names of the groups
+    task_code = cells % len(names[2])
+    speaker_code = cells // len(names[2]) % len(names[1])
+    file_code = cells // (len(names[2])*len(names[1]))
+    task_of = np.searchsorted(task_cells, file_code*len(names[2]) + task_code)
+
+    temp = pd.DataFrame({'filename': np.asarray(names[0], dtype=object)[file_code],
+        'speaker': np.asarray(names[1], dtype=object)[speaker_code], 'task': np.asarray(names[2], dtype=object)[task_code],
+        'total_dur': spch[1] + nonspch[1],
+        'totalSpch': spch[1], 'meanSpch': spch[2], 'stdSpch': spch[3],
+        'totalPause': nonspch[1], 'meanPause': nonspch[2], 'stdPause': nonspch[3], 'numPause': nonspch[0]})
+    with np.errstate(invalid='ignore', divide='ignore'):
+        temp['pause_rate'] = (temp.numPause / temp.total_dur) *60
+    temp['task_start'] = task_start[task_of]
+    temp['task_end'] = task_end[task_of]
+    return temp
+
+# count, sum, mean and sample standard deviation of x by group (NaN values are skipped)
+def group_moments(group, n_groups, x):
+    valid = ~np.isnan(x)
+    group, x = group[valid], x[valid]
+    count = np.bincount(group, minlength=n_groups)
+    total = np.bincount(group, weights=x, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total/count, np.nan)
+        sd = np.sqrt(np.bincount(group, weights=(x - mean[group])**2, minlength=n_groups)/(count - 1))
+    return count, total, mean, np.where(count > 1, sd, np.nan)
+
+# write the speech and pause measures of the segment tables of a corpus (see -pause_summary)
+def write_pause_summary(out_file, segments):
+    if len(segments) == 0:
+        print("WARNING: There are no transcripts or SAD outputs for the pause summary.")
+        return
+    summarize_pauses(pd.concat(segments, ignore_index=True)).to_csv(out_file, sep='\t', index=False)
+    print("The pause summary is saved in ", out_file)
+
+# run SAD on a file (through the result cache) and return the path of its output file in the scratch folder
+# SAD is not run again if the output file is already there (e.g. SAD ran as a separate stage of the pipeline)
+# if split (a SplitChannel, see -split_minutes) is given, the LDC SAD runs on the segments of the file at the same time
+# (the energy-based SAD sets its threshold on the whole file and is fast enough without splitting)
+def SAD_output(file, args, split=None):
+    SAD_outfile = args.temp_folder+'/'+file.split('/')[-1].split('.')[0]+'.lab'
+    if not os.path.exists(SAD_outfile):
+        if split is not None and args.SAD_backend == 'ldc':
+            run_cached(args.result_cache, file, 'SAD', [SAD_outfile], lambda: run_SAD_segments(file, split.get(file), SAD_outfile, args),
+                params=SAD_params(args)+split_params(args))
+        else:
+            run_cached(args.result_cache, file, 'SAD', [SAD_outfile], lambda: run_SAD(file, args), params=SAD_params(args))
+    return SAD_outfile
+
+# run SAD on the segments of a file and write the stitched segments to SAD_outfile
+def run_SAD_segments(file, segments, SAD_outfile, args):
+    def run(path):
+        run_SAD(path, args)
+        return pd.read_csv(args.temp_folder+'/'+path.split('/')[-1].split('.')[0]+'.lab', names=['start','end','segment'], sep=" ")
+    stitch_labels(segments, run_segments(segments, run, args.split_jobs)).to_csv(SAD_outfile, sep=' ', header=False, index=False)
+
 def combine_data(temp, df, args):
     if len(temp) != 0:
         # if turn-level is true, combine data frames by transcript * speaker * task
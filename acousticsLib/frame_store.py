@@ -0,0 +1,126 @@
+## this script keeps the frames of an openSMILE or covarep output file in a binary file (frame store, output_file.frames),
+## so that the text output is parsed once and later summaries read the frames as memory-mapped arrays (see -frame_store).
+## A frame store has a format line and a JSON line (feature names, number of frames), padded to 64 bytes,
+## followed by the frame times (float64) and one float32 column per feature.
+
+import json, os
+import numpy as np
+import pandas as pd
+
+store_format = b'acoustic_pipeline frames 1\n'
+
+def frame_store_file(file):
+    return file+'.frames'
+
+# the frame store of an output file; it is made (again) if it is missing or older than the output file
+# (programs that run in this process only write the frame store, see -openSMILE_backend)
+def load_store(file, openSMILE):
+    store_file = frame_store_file(file)
+    if os.path.exists(file) and (not os.path.exists(store_file) or os.path.getmtime(store_file) < os.path.getmtime(file)):
+        convert(file, openSMILE, store_file)
+    return FrameStore(store_file, openSMILE)
+
+# write frames that are already in memory (frame times, and values as frames x features) to a frame store
+def write_store(store_file, features, frame_time, values):
+    temp_file = store_file+'.tmp'
+    with open(temp_file, 'wb') as outFile:
+        outFile.write(header_bytes(list(features), len(frame_time)))
+        outFile.write(np.asarray(frame_time, dtype=np.float64).tobytes())
+        # column by column
+        outFile.write(np.asarray(values, dtype=np.float32).T.tobytes())
+    os.replace(temp_file, store_file)
+
+# convert a text output file to a frame store, chunk_frames frames at a time (the file is not read into memory at once)
+def convert(file, openSMILE, store_file, chunk_frames=100000):
+    # frame times and the rows of features are written to temp files first, as the number of frames is not known yet
+    times_file, rows_file = store_file+'.times.tmp', store_file+'.rows.tmp'
+    n_frames = 0
+    features = None
+    try:
+        with open(times_file, 'wb') as times_out, open(rows_file, 'wb') as rows_out:
+            for chunk in pd.read_csv(file, sep=";" if openSMILE else "\t", chunksize=chunk_frames):
+                if openSMILE:
+                    # openSMILE files start with name and frameTime
+                    times = chunk['frameTime'].to_numpy(dtype=np.float64)
+                    chunk = chunk.iloc[:, 2:]
+                else:
+                    # covarep frames are 10 ms apart
+                    times = (n_frames + np.arange(len(chunk))) * 0.01
+                features = list(chunk.columns)
+                times_out.write(times.tobytes())
+                rows_out.write(chunk.to_numpy(dtype=np.float32).tobytes())
+                n_frames += len(chunk)
+        if features is None:
+            # a file without frames: only the header
+            features = list(pd.read_csv(file, sep=";" if openSMILE else "\t", nrows=0).columns)
+            features = features[2:] if openSMILE else features
+
+        header = header_bytes(features, n_frames)
+        temp_file = store_file+'.tmp'
+        with open(temp_file, 'wb') as outFile:
+            outFile.write(header)
+            with open(times_file, 'rb') as inFile:
+                outFile.write(inFile.read())
+            outFile.truncate(len(header) + 8*n_frames + 4*n_frames*len(features))
+        if n_frames > 0 and features:
+            # transpose the rows into columns, one chunk of frames at a time
+            rows = np.memmap(rows_file, dtype=np.float32, mode='r', shape=(n_frames, len(features)))
+            columns = np.memmap(temp_file, dtype=np.float32, mode='r+', offset=len(header) + 8*n_frames, shape=(len(features), n_frames))
+            for first in range(0, n_frames, chunk_frames):
+                columns[:, first:first+chunk_frames] = rows[first:first+chunk_frames].T
+            columns.flush()
+            del rows, columns
+        # replace the store at once, so that a store is never read half-written
+        os.replace(temp_file, store_file)
+    finally:
+        for temp in [times_file, rows_file, store_file+'.tmp']:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+def header_bytes(features, n_frames):
+    header = store_format + json.dumps({'features': features, 'frames': n_frames}).encode('utf-8') + b'\n'
+    return header + b' '*(-len(header) % 64)
+
+class FrameStore:
+    def __init__(self, store_file, openSMILE):
+        self.openSMILE = openSMILE
+        with open(store_file, 'rb') as inFile:
+            if inFile.readline() != store_format:
+                raise ValueError("Not a frame store: "+store_file)
+            info = json.loads(inFile.readline())
+            offset = inFile.tell()
+        offset += -offset % 64
+        self.features = info['features']
+        self.n_frames = info['frames']
+        if self.n_frames > 0:
+            self.frame_time = np.memmap(store_file, dtype=np.float64, mode='r', offset=offset, shape=(self.n_frames,))
+            self.columns = np.memmap(store_file, dtype=np.float32, mode='r', offset=offset + 8*self.n_frames, shape=(len(self.features), self.n_frames))
+        else:
+            self.frame_time = np.zeros(0)
+            self.columns = np.zeros((len(self.features), 0), dtype=np.float32)
+
+    # frames first to last as a data frame with the columns of the text output file (or only the columns in usecols);
+    # the feature columns are one block of pandas, a view of the memory-mapped store (the store keeps the columns in
+    # the layout of a pandas block), so that columns can be added to the frame without fragmenting it
+    def frame(self, first=0, last=None, usecols=None):
+        names = (['name', 'frameTime'] if self.openSMILE else []) + self.features
+        if usecols is not None:
+            names = [name for name in names if name in usecols]
+        frame_time = self.frame_time[first:last]
+        data = {}
+        for name in names[:2]:
+            if name == 'name':
+                # the instance name of openSMILE is not kept
+                data[name] = pd.Categorical.from_codes(np.zeros(len(frame_time), dtype=np.int8), ['unknown'])
+            elif name == 'frameTime':
+                data[name] = frame_time
+        features = [name for name in names if name not in data]
+        if features == self.features:
+            values = self.columns[:, first:last]
+        else:
+            position = dict((feature, i) for i, feature in enumerate(self.features))
+            values = self.columns[[position[name] for name in features], first:last]
+        frames = pd.DataFrame(values.T, columns=features, copy=False)
+        if not data:
+            return frames
+        return pd.concat([pd.DataFrame(data, copy=False), frames], axis=1)
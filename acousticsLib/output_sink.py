@@ -0,0 +1,175 @@
+## this script includes the writers of the final output file.
+## TsvSink appends rows to a tab-separated file (the default), and ParquetSink writes a folder of Parquet files.
+## Both keep the columns of the first rows they write as a fixed schema, and both keep a manifest of the
+## completed (file, channel) units, so that a run that stopped can continue with -resume without rerunning
+## or duplicating the units that were already written. Without -resume, a run starts a new manifest.
+
+import json, os
+
+# the units of a manifest in the order they were written
+def read_manifest(manifest):
+    units = []
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as inFile:
+            for line in inFile:
+                try:
+                    units.append(json.loads(line))
+                except ValueError:
+                    # the last line can be incomplete if the run was killed while writing it
+                    continue
+    return units
+
+class OutputSink:
+    def __init__(self, out_file, resume=False):
+        self.out_file = out_file
+        self.manifest = out_file+'.manifest'
+        self.resume = resume
+        # completed channels by file, and files that are done (all channels and forced alignment)
+        self.channels = {}
+        self.files = set()
+        # where the output ended after the last completed unit (size of the tsv file, or name of the last Parquet part)
+        self.last_size = None
+        self.last_part = None
+        # the manifest of an earlier run is only used with -resume
+        if resume:
+            for unit in read_manifest(self.manifest):
+                if 'size' in unit:
+                    self.last_size = unit['size']
+                if 'part' in unit:
+                    self.last_part = unit['part']
+                if 'file' not in unit:
+                    # the position of the output when the manifest was started
+                    continue
+                if unit.get('done'):
+                    self.files.add(unit['file'])
+                else:
+                    self.channels.setdefault(unit['file'], set()).add(unit['channel'])
+
+    # start a new manifest (without -resume) with the position of the output before this run,
+    # so that a later -resume removes what this run wrote for a unit it did not complete
+    def start_manifest(self):
+        if not self.resume or not os.path.exists(self.manifest):
+            with open(self.manifest, 'w') as outFile:
+                outFile.write(json.dumps(self.position())+'\n')
+                outFile.flush()
+                os.fsync(outFile.fileno())
+
+    # add a line to the manifest; it is flushed to disk so that it survives a crash
+    def record(self, unit):
+        with open(self.manifest, 'a') as outFile:
+            outFile.write(json.dumps(unit)+'\n')
+            outFile.flush()
+            os.fsync(outFile.fileno())
+
+    def completed_channels(self, file):
+        return self.channels.get(file, set())
+
+    def is_done(self, file):
+        return file in self.files
+
+    # write the rows of one channel of a file; units that were already written are skipped
+    def write(self, file, channel, temp):
+        if channel in self.completed_channels(file):
+            return
+        self.write_rows(temp)
+        self.channels.setdefault(file, set()).add(channel)
+        self.record(dict({'file': file, 'channel': channel}, **self.position()))
+
+    # where the output file ends after a unit, saved in the manifest
+    def position(self):
+        return {}
+
+    # mark a file as done
+    def done(self, file):
+        self.files.add(file)
+        self.record({'file': file, 'done': True})
+
+    # make the rows fit the fixed columns: missing columns are left empty and unknown columns are dropped
+    def conform(self, temp, columns):
+        extra = [column for column in temp.columns if column not in columns]
+        if extra:
+            print("WARNING: these columns are not in the output file and are dropped: ", extra)
+        return temp.reindex(columns=columns)
+
+# tab-separated output file; the header of the file is the fixed schema
+class TsvSink(OutputSink):
+    def __init__(self, out_file, resume=False):
+        OutputSink.__init__(self, out_file, resume)
+        # remove rows of a unit that was being written when the last run stopped
+        if resume and self.last_size is not None and os.path.exists(out_file) and os.path.getsize(out_file) > self.last_size:
+            os.truncate(out_file, self.last_size)
+        self.columns = None
+        if os.path.exists(out_file) and os.path.getsize(out_file) > 0:
+            with open(out_file, 'r') as inFile:
+                self.columns = inFile.readline().rstrip('\n').split('\t')
+        self.start_manifest()
+
+    def write_rows(self, temp):
+        # write final results of the file being processed to the output file.
+        if self.columns is None:
+            temp.to_csv(self.out_file, index=None, sep='\t', mode='a')
+            self.columns = list(temp.columns)
+        else:
+            self.conform(temp, self.columns).to_csv(self.out_file, index=None, sep='\t', mode='a', header=False)
+
+    def position(self):
+        return {'size': os.path.getsize(self.out_file) if os.path.exists(self.out_file) else 0}
+
+# folder of Parquet files (one file and row group per unit), readable as one table with pandas.read_parquet(folder)
+# the schema of the first unit is saved in the _common_metadata file of the folder
+class ParquetSink(OutputSink):
+    def __init__(self, out_file, resume=False):
+        # pyarrow is only needed for this output format
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow. Please install it (pip install pyarrow) or use -output_format tsv.")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        OutputSink.__init__(self, out_file, resume)
+        os.makedirs(out_file, exist_ok=True)
+        self.schema_file = out_file+'/_common_metadata'
+        self.schema = None
+        if os.path.exists(self.schema_file):
+            self.schema = self.pq.read_schema(self.schema_file)
+        parts = sorted(name for name in os.listdir(out_file) if name.startswith('part-') and name.endswith('.parquet'))
+        # remove parts of units that were not completed when the last run stopped (written after the last part in the manifest),
+        # and temporary files of parts that were being written
+        if resume and os.path.exists(self.manifest):
+            for name in parts:
+                if self.last_part is None or name > self.last_part:
+                    os.remove(out_file+'/'+name)
+            for name in os.listdir(out_file):
+                if name.startswith('.part-') and name.endswith('.tmp'):
+                    os.remove(out_file+'/'+name)
+            parts = [name for name in parts if self.last_part is not None and name <= self.last_part]
+        self.last_part = parts[-1] if parts else None
+        # number of the next part
+        self.parts = int(parts[-1][len('part-'):-len('.parquet')]) + 1 if parts else 0
+        self.start_manifest()
+
+    def write_rows(self, temp):
+        if self.schema is None:
+            schema = self.pa.Schema.from_pandas(temp, preserve_index=False)
+            # columns without any value in the first unit are stored as text
+            for i, field in enumerate(schema):
+                if field.type == self.pa.null():
+                    schema = schema.set(i, field.with_type(self.pa.string()))
+            self.schema = schema.remove_metadata()
+            self.pq.write_metadata(self.schema, self.schema_file)
+        table = self.pa.Table.from_pandas(self.conform(temp, self.schema.names), schema=self.schema, preserve_index=False)
+        # write to a temporary name and rename, so that a crash never leaves a partial Parquet file
+        # (names starting with '.' are ignored when the folder is read)
+        name = 'part-'+str(self.parts).zfill(6)+'.parquet'
+        self.pq.write_table(table, self.out_file+'/.'+name+'.tmp')
+        os.replace(self.out_file+'/.'+name+'.tmp', self.out_file+'/'+name)
+        self.last_part = name
+        self.parts += 1
+
+    def position(self):
+        return {'part': self.last_part}
+
+def make_sink(out_file, output_format, resume=False):
+    if output_format == 'parquet':
+        return ParquetSink(out_file, resume)
+    return TsvSink(out_file, resume)
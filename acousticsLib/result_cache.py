@@ -0,0 +1,150 @@
+## this script includes a content-addressed cache for the output files of the acoustic programs.
+## An entry is keyed by a hash of the preprocessed audio file, the program, its configuration file and parameters,
+## so that a rerun only runs the programs whose inputs changed. The cache is kept under a size limit by removing
+## the least recently used entries, and hit/miss counts are kept in the cache folder (shared by all processes).
+
+import hashlib, json, os, shutil, fcntl, tempfile
+from contextlib import contextmanager
+
+class ResultCache:
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        # maximum size of all entries in bytes
+        self.max_size = max_size
+        self.entry_dir = cache_dir+'/entries'
+        self.stats_file = cache_dir+'/stats.json'
+        os.makedirs(self.entry_dir, exist_ok=True)
+        # hashes of files already read in this process, by (path, size, mtime)
+        self.file_hashes = {}
+
+    # hash the contents of a file, reading it in blocks
+    def hash_file(self, file):
+        info = os.stat(file)
+        key = (file, info.st_size, info.st_mtime_ns)
+        if key not in self.file_hashes:
+            h = hashlib.blake2b()
+            with open(file, 'rb') as inFile:
+                for block in iter(lambda: inFile.read(1048576), b''):
+                    h.update(block)
+            self.file_hashes[key] = h.hexdigest()
+        return self.file_hashes[key]
+
+    # make the key of a program run on an audio file
+    # config is a file (e.g. the openSMILE config or a transcript) whose contents change the output; params are any other settings
+    def key(self, audio_file, tool, config=None, params=()):
+        h = hashlib.blake2b()
+        h.update(tool.encode())
+        h.update(self.hash_file(audio_file).encode())
+        if config and os.path.exists(config):
+            h.update(self.hash_file(config).encode())
+        h.update(json.dumps([str(param) for param in params]).encode())
+        return h.hexdigest()
+
+    # hold the cache lock while reading or changing the stats or removing entries
+    @contextmanager
+    def locked(self):
+        with open(self.cache_dir+'/lock', 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def read_stats(self):
+        if os.path.exists(self.stats_file):
+            with open(self.stats_file, 'r') as inFile:
+                return json.load(inFile)
+        return {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0, 'tools': {}}
+
+    def write_stats(self, stats):
+        with open(self.stats_file+'.tmp', 'w') as outFile:
+            json.dump(stats, outFile)
+        os.replace(self.stats_file+'.tmp', self.stats_file)
+
+    def record(self, tool, result):
+        with self.locked():
+            stats = self.read_stats()
+            stats[result] += 1
+            tool_stats = stats['tools'].setdefault(tool, {'hits': 0, 'misses': 0})
+            tool_stats[result] += 1
+            self.write_stats(stats)
+
+    def stats(self):
+        with self.locked():
+            return self.read_stats()
+
+    # copy the cached output files to their destinations; returns False if the entry is not (or no longer) in the cache
+    def get(self, key, outputs, tool):
+        entry = self.entry_dir+'/'+key
+        try:
+            for output in outputs:
+                shutil.copyfile(entry+'/'+os.path.basename(output), output)
+            # mark the entry as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            self.record(tool, 'misses')
+            return False
+        self.record(tool, 'hits')
+        return True
+
+    # store output files under key and remove old entries if the cache is too large
+    def put(self, key, outputs):
+        entry = self.entry_dir+'/'+key
+        # copy into a private folder first and rename it, so that other processes never see a partial entry
+        staging = tempfile.mkdtemp(dir=self.entry_dir, prefix='.staging_')
+        size = 0
+        for output in outputs:
+            shutil.copyfile(output, staging+'/'+os.path.basename(output))
+            size += os.path.getsize(output)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(staging)
+            return
+        with self.locked():
+            stats = self.read_stats()
+            stats['size'] += size
+            if stats['size'] > self.max_size:
+                self.evict(stats)
+            self.write_stats(stats)
+
+    # remove the least recently used entries until the cache fits into max_size (called with the lock held)
+    def evict(self, stats):
+        entries = []
+        for item in os.scandir(self.entry_dir):
+            if item.is_dir() and not item.name.startswith('.'):
+                size = sum(f.stat().st_size for f in os.scandir(item.path))
+                entries.append((item.stat().st_mtime, size, item.path))
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            stats['evictions'] += 1
+        stats['size'] = total
+
+# run a program through the cache: copy its outputs from the cache if the same audio, program, config and params
+# were seen before, otherwise run it and store its outputs. Without a cache, the program just runs.
+def run_cached(cache, audio_file, tool, outputs, run, config=None, params=()):
+    if cache is None:
+        run()
+        return
+    key = cache.key(audio_file, tool, config, params)
+    if cache.get(key, outputs, tool):
+        return
+    run()
+    # only store complete results (e.g. not when a program crashed)
+    if all(os.path.exists(output) for output in outputs):
+        cache.put(key, outputs)
+
+# print hit/miss counts of this run (difference between the stats at the start and at the end of the run)
+def print_cache_stats(before, after):
+    hits = after['hits'] - before['hits']
+    misses = after['misses'] - before['misses']
+    print("Cache: ", hits, " hits, ", misses, " misses, ", after['evictions'] - before['evictions'], " evictions, ", round(after['size']/1048576, 1), "MB in use")
+    for tool, tool_stats in sorted(after['tools'].items()):
+        tool_before = before['tools'].get(tool, {'hits': 0, 'misses': 0})
+        print("  ", tool, ": ", tool_stats['hits'] - tool_before['hits'], " hits, ", tool_stats['misses'] - tool_before['misses'], " misses")
@@ -1,21 +1,95 @@
 ## this script includes functions for running various acoustic programs, 
 ## including speech activity detector, openSMILE, covarep, speech quality checking, forced-alignment 
 
-import subprocess, os, sys
+import importlib.util, sys, threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
 from scipy.io import wavfile
-from acousticsLib.audio_prep import combine_channel
+from acousticsLib.audio_prep import write_turn, read_audio
 from acousticsLib.transcript_prep import get_transcripts_only
+from acousticsLib.result_cache import run_cached
+from acousticsLib.run_trace import run_command, in_context
 
 SAD_location = "/usr/local/src/ldc_sad_hmm-1.0.9/perform_sad.py"
 openSMILE_default_config_location = "/usr/local/src/opensmile/config/is09-13/IS13_ComParE.conf"
 acoustic_pipeline_location = "./acoustic_pipeline"
 forced_alignment_location = "/usr/local/aligner_v02/segment.py"
 
-# run SAD
+# settings of the energy-based SAD: a frame is speech if its energy is above the noise floor (15th percentile, in dB)
+# by threshold times the range between the 15th and 85th percentiles (at least min_margin dB); speech continues for
+# hangover seconds after the energy drops, pauses shorter than min_nonspeech and speech shorter than min_speech are dropped
+energy_SAD_settings = {'threshold': 0.4, 'min_margin': 3.0, 'hangover': 0.2, 'min_nonspeech': 0.15, 'min_speech': 0.1}
+
+# run SAD with the backend chosen with -SAD_backend (see SAD_backends)
+# every backend writes the speech and nonspeech segments of the audio file to the scratch folder (audio_file.lab)
 def run_SAD(audio_file, args):
-	subprocess.run(['python3', SAD_location,"--nonspeech","0.15","-L", args.input_folder, audio_file])
+    SAD_backends[args.SAD_backend](audio_file, args)
+
+# parameters of the SAD backend, for the result cache
+def SAD_params(args):
+    if args.SAD_backend == 'energy':
+        return ['energy', sorted(energy_SAD_settings.items())]
+    return [SAD_location]
+
+# run the LDC HMM SAD script
+def run_SAD_ldc(audio_file, args):
+	run_command(['python3', SAD_location,"--nonspeech","0.15","-L", args.temp_folder, audio_file])
     #subprocess.run(['python3',"/Users/csunghye/Documents/ldc_sad_hmm-1.0.9/perform_sad.py","--nonspeech","0.15","-L", args.input_folder, audio_file])
+
+# energy-based SAD in this process, on the frames of run_SpeechQuality (25 ms windows every 10 ms)
+def run_SAD_energy(audio_file, args):
+    FS, X = wavfile.read(audio_file, mmap=True)
+    if X.ndim > 1:
+        X = X.mean(axis=1)
+    speech = energy_SAD(FS, X)
+    duration = len(X)/FS
+    # segments of frames with the same label; the last segment ends at the end of the file
+    bounds, labels = label_runs(speech)
+    times = bounds*0.01
+    if len(times):
+        times[-1] = duration
+    else:
+        times, labels = np.array([0, duration]), np.array([False])
+    outfile = args.temp_folder+'/'+audio_file.split('/')[-1].split('.')[0]+'.lab'
+    with open(outfile, 'w') as outFile:
+        outFile.writelines('%.2f %.2f %s\n' % (start, end, 'speech' if label else 'nonspeech') for start, end, label in zip(times[:-1], times[1:], labels))
+
+# speech (True) or nonspeech (False) for every 10 ms frame of the samples X
+def energy_SAD(FS, X, settings=energy_SAD_settings):
+    MS = frame_energy(X, round(0.025*FS), round(0.01*FS))
+    if len(MS) == 0:
+        return np.zeros(0, dtype=bool)
+    dB = 10*np.log10(np.maximum(MS, 1e-10))
+    Q15, Q85 = np.quantile(dB, [0.15, 0.85])
+    active = dB > Q15 + max(settings['min_margin'], settings['threshold']*(Q85 - Q15))
+    # hangover: frames within hangover frames after the last active frame are speech
+    index = np.arange(len(active))
+    last_active = np.maximum.accumulate(np.where(active, index, -len(active) - 1))
+    speech = index - last_active <= round(settings['hangover']/0.01)
+    # bridge short pauses between speech segments, then drop short speech segments
+    speech = relabel_short(speech, False, round(settings['min_nonspeech']/0.01))
+    speech = relabel_short(speech, True, round(settings['min_speech']/0.01))
+    return speech
+
+# first frame of every run of equal labels (and the number of frames at the end), and the label of every run
+def label_runs(labels):
+    if len(labels) == 0:
+        return np.zeros(0, dtype=int), labels
+    bounds = np.concatenate([[0], np.flatnonzero(labels[1:] != labels[:-1]) + 1, [len(labels)]])
+    return bounds, labels[bounds[:-1]]
+
+# flip runs of label shorter than min_frames (pauses at the start or end of the file are kept)
+def relabel_short(labels, label, min_frames):
+    bounds, run_labels = label_runs(labels)
+    lengths = np.diff(bounds)
+    short = (run_labels == label) & (lengths < min_frames)
+    if not label and len(short):
+        short[0] = short[-1] = False
+    return np.repeat(np.where(short, ~run_labels, run_labels), lengths)
+
+# the SAD backends by name (see -SAD_backend)
+SAD_backends = {'ldc': run_SAD_ldc, 'energy': run_SAD_energy}
 # run openSMILE
 def run_openSMILE(audio_file, args):
     # define the name of the output file
@@ -23,100 +97,192 @@ def run_openSMILE(audio_file, args):
     # if a specific openSMILE config file is listed, run the config file 
     # See the openSMILE doc for various config files
     if args.openSMILE_config:
-        subprocess.run(["SMILExtract","-C", args.openSMILE_config, "-I", audio_file, "-D", outfilename, "-instname", audio_file])
+        run_command(["SMILExtract","-C", args.openSMILE_config, "-I", audio_file, "-D", outfilename, "-instname", audio_file])
     # if not, Interspeech 2013 version will be used 
     else:
-        subprocess.run(["SMILExtract","-C", openSMILE_default_config_location,"-I", audio_file, "-D", outfilename, "-instname", audio_file])
+        run_command(["SMILExtract","-C", openSMILE_default_config_location,"-I", audio_file, "-D", outfilename, "-instname", audio_file])
+
+# openSMILE extractors that run in this process, by name (see -openSMILE_backend). An extractor is called with the
+# audio file and the config file and returns the frame times and the LLD features (a data frame, frames x features).
+# Other extractors can be added to openSMILE_extractors, e.g. a fake one (see benchmarks/run_benchmarks.py).
+def extract_opensmile_python(audio_file, config):
+    # the openSMILE objects of a config are made once and kept for later files (one set per running extraction)
+    with smile_lock:
+        idle = smile_pool.setdefault(config, [])
+        smiles = idle.pop() if idle else None
+    if smiles is None:
+        smiles = make_smiles(config)
+    try:
+        # the features of all levels side by side, frame by frame
+        lld = pd.concat([smile.process_file(audio_file) for smile in smiles], axis=1)
+    finally:
+        with smile_lock:
+            smile_pool[config].append(smiles)
+    return lld.index.get_level_values('start').total_seconds().to_numpy(), lld.reset_index(drop=True)
+
+# the openSMILE objects that extract the features of a config
+def make_smiles(config):
+    import opensmile
+    if config == openSMILE_default_config_location:
+        # the default SMILExtract config (IS13_ComParE.conf) has no lld output; the ComParE feature set of the package
+        # has the same LLDs, and their deltas (_de) at a level of their own, which SMILExtract writes after the LLDs
+        return [opensmile.Smile(feature_set=opensmile.FeatureSet.ComParE_2016, feature_level=level)
+            for level in [opensmile.FeatureLevel.LowLevelDescriptors, opensmile.FeatureLevel.LowLevelDescriptors_Deltas]]
+    return [opensmile.Smile(feature_set=config, feature_level='lld')]
+
+# openSMILE objects that are not in use, by config
+smile_pool = {}
+smile_lock = threading.Lock()
+
+openSMILE_extractors = {'python': extract_opensmile_python}
+
+# the openSMILE backend to use: subprocess (SMILExtract), or an extractor of openSMILE_extractors;
+# without the opensmile package, the python backend falls back to SMILExtract
+def openSMILE_backend(name):
+    if name == 'subprocess':
+        return name
+    if name not in openSMILE_extractors:
+        sys.exit("Unknown openSMILE backend: "+name+". Please use subprocess or one of: "+', '.join(openSMILE_extractors))
+    if name == 'python':
+        if importlib.util.find_spec('opensmile') is None:
+            print("WARNING: The opensmile package is not installed (pip install opensmile). openSMILE runs as a separate program (SMILExtract).")
+            return 'subprocess'
+    return name
+
+# calculate the mean-square energy of Hamming-windowed frames in one vectorized pass per block of frames
+# frames start every incrN samples, as long as a full window fits before the last window position (nsamples - windowN)
+# X can be a memory-mapped array: only chunk_frames frames are read and windowed at a time
+def frame_energy(X, windowN, incrN, chunk_frames=4096):
+    H2 = np.hamming(windowN)**2
+    lastsamp = len(X) - windowN
+    nrms = len(range(0, lastsamp, incrN))
+    MS = np.zeros(nrms)
+    for first in range(0, nrms, chunk_frames):
+        last = min(first + chunk_frames, nrms)
+        # strided (frames x window) view of the block, no copy of the samples
+        block = X[first*incrN:(last-1)*incrN+windowN]
+        frames = np.lib.stride_tricks.sliding_window_view(block, windowN)[::incrN]
+        # sum((x*h)^2) == (x^2) @ h^2
+        MS[first:last] = (np.square(frames, dtype=np.float64) @ H2) / windowN
+    return MS
+
+# count samples at full scale (+/-1), reading the signal block by block
+def count_clipped(X, chunk_samples=1048576):
+    nclipped = 0
+    for first in range(0, len(X), chunk_samples):
+        block = X[first:first+chunk_samples]
+        nclipped += np.count_nonzero((block == 1) | (block == -1))
+    return nclipped
 
 # this function calculates a pseudo SNR value and the number of clipped frames
-def run_SpeechQuality(file):
+# the samples can be given directly as audio=(FS, X), e.g. a channel of an AudioSession; otherwise the file is read
+def run_SpeechQuality(file=None, audio=None):
     windowT=0.025
     incrT = 0.01
-    FS, X = wavfile.read(file)
+    if audio is not None:
+        FS, X = audio
+    else:
+        # memory-map the file instead of loading it
+        FS, X = wavfile.read(file, mmap=True)
     windowN = round(windowT*FS)
     incrN = round(incrT*FS)
-    
-    H = np.hamming(windowN)
-    nsamples=len(X)
-    lastsamp = nsamples-windowN
-    nrms = len(np.arange(0,lastsamp, incrN))
-    MS = np.zeros((nrms,1))
-    count=0
-    for s in np.arange(0,lastsamp, incrN):
-        Sig = X[s:(s+windowN)]*H
-        MS[count] = (np.conj(Sig)@Sig)/windowN
-        count += 1
-        
+
+    MS = frame_energy(X, windowN, incrN)
+
     Q15 = 10*np.log10(np.quantile(MS,0.15))
     Q85 = 10*np.log10(np.quantile(MS,0.85))
-    aX = abs(X)
-    nclipped = sum(aX== 1)
+    nclipped = count_clipped(X)
     return Q85 - Q15, nclipped
 
 # run covarep 
-def run_covarep(file):
-    cwd = os.getcwd()
-    os.chdir(acoustic_pipeline_location)
+# if a pool of running MATLAB sessions is given (see covarep_worker.py), the file is sent to one of them;
+# otherwise MATLAB is started for this file only
+def run_covarep(file, pool=None):
+    if pool is not None:
+        pool.run(file)
+        return
     ## make a command first for matlab 
     command = 'matlab -nodisplay -nosplash -nodesktop -r "feature_extraction2('+"'"+file+"'"+');exit;"'
-    subprocess.run(command, shell=True)
-    os.chdir(cwd)
+    # MATLAB runs in the pipeline folder; the working directory of this process is not changed,
+    # because other stages may run at the same time in other threads
+    run_command(command, shell=True, cwd=acoustic_pipeline_location)
 
 # run forced-alignment (only English version is available for now)
-def run_FA(file, transcript_list, transfile, status, args):
-    # check if a file is steroe
-    if status == "processed_stereo":
-        # combine channels for forced alignment
-        combine_channel(file, args)
-        audio_file = args.input_folder+'/temp/'+file.split('/')[-1].split('.')[0]+'_mono.wav'
-    else:
-        audio_file = file
-    
-    if transfile in transcript_list:
+# the audio is read once and each turn is cut from memory; turns are aligned concurrently (args.fa_jobs at a time)
+# in their own scratch files, and the output files are written once at the end in transcript order
+# if the audio file is already open in an AudioSession, its samples are used instead of reading the file again
+def run_FA(file, transcript, status, args, session=None):
+    if transcript is not None:
         # define the final output file names
         wordfile = file.split('.')[0]+'.word'
         alignfile = file.split('.')[0]+'.align'
-        # open transcript and loop through lines
-        with open(transfile, 'r') as inFile:
-            for line in inFile:
-                data = line.rstrip('\n').split('\t')
-                start = float(data[1])
-                end = data[2]
-                dur = float(end) - start
 
-                # define temporary files for turn-level alignments
-                temp_text = open(args.input_folder+'/temp/x.txt', 'w')
-                temp_text.writelines(data[3]+'\n')
-                temp_text.close()
+        # align all turns and write the alignments of the file to the scratch folder
+        temp_wordfile = args.temp_folder+'/'+wordfile.split('/')[-1]
+        temp_alignfile = args.temp_folder+'/'+alignfile.split('/')[-1]
+        def align_file():
+            # read the audio file once
+            if session is not None:
+                sp, audio = session.sample_rate, session.samples
+            else:
+                sp, audio = read_audio(file)
+            # turns of the transcript
+            turns = list(zip(transcript.start, transcript.end, transcript.text))
 
-                temp_text = args.input_folder + '/temp/x.txt'
-                temp_wav = args.input_folder + '/temp/x.wav'
-                temp_word =  args.input_folder + '/temp/x.word'
-                temp_align =  args.input_folder + '/temp/x.align'
+            # align one turn and return the alignments with correct timestamps
+            def align_turn(i):
+                start, end, text = turns[i]
+                # define temporary files for turn-level alignments
+                temp_text = args.temp_folder + '/x'+str(i)+'.txt'
+                temp_wav = args.temp_folder + '/x'+str(i)+'.wav'
+                temp_word =  args.temp_folder + '/x'+str(i)+'.word'
+                temp_align =  args.temp_folder + '/x'+str(i)+'.align'
+                with open(temp_text, 'w') as outFile:
+                    outFile.writelines(text+'\n')
 
-                # trim the audio file based on timestamps in transcripts
-                subprocess.run(['sox', audio_file, temp_wav, 'trim', str(start), str(dur)])
+                # trim the audio based on timestamps in transcripts
+                # (written as 16KHz, 16 bits, mono, with the channels of a stereo file combined)
+                write_turn(temp_wav, audio[round(start*sp):round(end*sp)], sp)
                 # run turn-level forced-alignment
-                subprocess.run(['python', forced_alignment_location, temp_wav, temp_text, temp_align, temp_word])
-        
+                run_command(['python', forced_alignment_location, temp_wav, temp_text, temp_align, temp_word])
+
                 #add_start generates correct timestamps in the final output files
-                add_start(wordfile, temp_word, start)
-                add_start(alignfile, temp_align, start)
+                return add_start(temp_word, start), add_start(temp_align, start)
+
+            with ThreadPoolExecutor(max_workers=args.fa_jobs) as executor:
+                aligned = list(executor.map(in_context(align_turn), range(len(turns))))
+
+            with open(temp_wordfile, 'w') as outFile:
+                outFile.write(''.join(word for word, align in aligned))
+            with open(temp_alignfile, 'w') as outFile:
+                outFile.write(''.join(align for word, align in aligned))
+
+        # the alignments only change with the audio, the transcript and the channel setup
+        run_cached(args.result_cache, file, 'forced_alignment', [temp_wordfile, temp_alignfile], align_file,
+            config=transcript.path, params=[status, forced_alignment_location])
+
+        # add the alignments to the final output files
+        with open(temp_wordfile, 'r') as inFile, open(wordfile, 'a') as outFile:
+            outFile.write(inFile.read())
+        with open(temp_alignfile, 'r') as inFile, open(alignfile, 'a') as outFile:
+            outFile.write(inFile.read())
 
     else:
         sys.exit("No transcript file is found. Please check again.")	
 
 # add start time for the alignment files
-def add_start(file, tempfile, start):
-    # open temp alignment files and final output files
-    with open(tempfile, 'r') as inFile, open(file, 'a') as outFile:
+# returns the lines of the temp alignment file with timestamps shifted by the start of the turn
+def add_start(tempfile, start):
+    lines = []
+    with open(tempfile, 'r') as inFile:
         for line in inFile:
             data = line.rstrip('\n').split()
             if len(data) > 2:
                 if tempfile.endswith('.word'):
-                    outFile.writelines(str(float(data[0])+start)+'\t'+str(float(data[1])+start)+'\t'+data[2]+'\n')
+                    lines.append(str(float(data[0])+start)+'\t'+str(float(data[1])+start)+'\t'+data[2]+'\n')
                 else:
-                    outFile.writelines(str(float(data[0])+(start*10000000))+'\t'+str(float(data[1])+(start*10000000))+'\t')
+                    lines.append(str(float(data[0])+(start*10000000))+'\t'+str(float(data[1])+(start*10000000))+'\t')
                     for item in data[2:]:
-                        outFile.writelines(item+'\t')
-                    outFile.writelines('\n')
+                        lines.append(item+'\t')
+                    lines.append('\n')
+    return ''.join(lines)
@@ -0,0 +1,159 @@
+## this script records where the time of a run goes (see -trace).
+## Every stage of the pipeline (e.g. preprocessing, a program, a summary) and every external program call is written
+## as one JSON line to the trace file: wall time, CPU time and peak memory, with the audio file and channel.
+## External programs are waited for with os.wait4, so that their own CPU time and peak memory are known even when
+## several programs run at the same time. At the end of a run, a summary of the slowest stages and outliers is printed.
+
+import contextvars, json, os, resource, subprocess, threading, time
+from contextlib import contextmanager
+
+# the trace file of this run (None: no trace is written) and the id of the run (all lines of a run have the same id)
+trace_settings = {'file': None, 'run': None}
+# file, channel and stage of the code that is running (kept per thread, see in_context)
+trace_info = contextvars.ContextVar('trace_info', default={})
+# one open trace file per process (worker processes open their own)
+trace_handle = {'pid': None, 'file': None}
+trace_lock = threading.Lock()
+
+def configure_trace(trace_file, run=None):
+    trace_settings['file'] = trace_file
+    trace_settings['run'] = run if run else time.strftime('%Y%m%d-%H%M%S')+'-'+str(os.getpid())
+
+def tracing():
+    return trace_settings['file'] is not None
+
+# add one line to the trace file
+def record(line):
+    if not tracing():
+        return
+    line = dict(trace_info.get(), run=trace_settings['run'], pid=os.getpid(), **line)
+    with trace_lock:
+        if trace_handle['pid'] != os.getpid():
+            trace_handle['file'] = open(trace_settings['file'], 'a')
+            trace_handle['pid'] = os.getpid()
+        # one write per line, so that lines of different processes are not mixed
+        trace_handle['file'].write(json.dumps(line)+'\n')
+        trace_handle['file'].flush()
+
+# the file and channel that the lines written inside this block belong to
+@contextmanager
+def trace_context(**info):
+    token = trace_info.set(dict(trace_info.get(), **info))
+    try:
+        yield
+    finally:
+        trace_info.reset(token)
+
+# record a stage of the pipeline: wall time, CPU time of this thread, and the peak memory of this process so far
+@contextmanager
+def span(stage, **info):
+    start = time.time()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    ok = False
+    with trace_context(stage=stage, **info):
+        try:
+            yield
+            ok = True
+        finally:
+            record({'type': 'stage', 'start': start, 'wall': time.perf_counter() - wall, 'cpu': time.thread_time() - cpu,
+                'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'ok': ok})
+
+# wrap fn so that it runs with the trace context of the caller in another thread (e.g. in a thread pool)
+def in_context(fn):
+    info = trace_info.get()
+    def run(*args, **kwargs):
+        token = trace_info.set(info)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            trace_info.reset(token)
+    return run
+
+# name of the program of a command (the script for python commands, e.g. perform_sad.py)
+def program_name(command):
+    if isinstance(command, str):
+        command = command.split()
+    name = os.path.basename(command[0])
+    if name.startswith('python') and len(command) > 1:
+        name = os.path.basename(command[1])
+    return name
+
+# wait for a started program and record its run time, CPU time and peak memory; returns the exit code
+# start is the time.perf_counter() value when the program was started
+def wait_command(process, command, start, timeout=None):
+    try:
+        if timeout is None:
+            pid, status, usage = os.wait4(process.pid, 0)
+        else:
+            deadline = time.perf_counter() + timeout
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            while pid == 0:
+                if time.perf_counter() > deadline:
+                    raise subprocess.TimeoutExpired(command, timeout)
+                time.sleep(0.05)
+                pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+    except ChildProcessError:
+        # the program was already waited for
+        return process.wait()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    record({'type': 'command', 'program': program_name(command), 'wall': time.perf_counter() - start,
+        'user': usage.ru_utime, 'sys': usage.ru_stime, 'maxrss_kb': usage.ru_maxrss, 'returncode': process.returncode})
+    return process.returncode
+
+# run an external program like subprocess.run (without capturing its output) and record its resource use
+def run_command(command, **kwargs):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, **kwargs)
+    try:
+        returncode = wait_command(process, command, start)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    return subprocess.CompletedProcess(command, returncode)
+
+# summary of the lines of a run: time by stage and by program, and the slowest outliers
+def trace_summary(trace_file, run):
+    stages = {}
+    commands = {}
+    with open(trace_file, 'r') as inFile:
+        for line in inFile:
+            try:
+                line = json.loads(line)
+            except ValueError:
+                continue
+            if line.get('run') != run:
+                continue
+            if line['type'] == 'stage':
+                # stages of the same kind on different channels (e.g. 'openSMILE:a_firstCH.wav') are counted together
+                stages.setdefault(line['stage'].split(':')[0], []).append(line)
+            elif line['type'] == 'command':
+                commands.setdefault(line['program'], []).append(line)
+    return stages, commands
+
+def print_trace_summary(trace_file=None, run=None):
+    trace_file = trace_file if trace_file else trace_settings['file']
+    run = run if run else trace_settings['run']
+    stages, commands = trace_summary(trace_file, run)
+    print("Time by stage (count, total, mean, max wall time; CPU time of the pipeline itself):")
+    for name, lines in sorted(stages.items(), key=lambda item: -sum(line['wall'] for line in item[1])):
+        walls = [line['wall'] for line in lines]
+        print("  %-22s %5d  %9.2fs  %8.2fs  %8.2fs  cpu %8.2fs" % (name, len(lines), sum(walls), sum(walls)/len(walls), max(walls), sum(line['cpu'] for line in lines)))
+    print("Time by program (count, total wall time, CPU time, CPU/wall, peak memory):")
+    for name, lines in sorted(commands.items(), key=lambda item: -sum(line['wall'] for line in item[1])):
+        wall = sum(line['wall'] for line in lines)
+        cpu = sum(line['user'] + line['sys'] for line in lines)
+        # a low CPU/wall share means the program mostly waited (e.g. for disk, or while starting up)
+        print("  %-22s %5d  %9.2fs  %8.2fs  %5.2f  %8.1fMB" % (name, len(lines), wall, cpu, cpu/wall if wall else 0, max(line['maxrss_kb'] for line in lines)/1024))
+    # stages that took more than three times the median of their kind
+    outliers = []
+    for name, lines in stages.items():
+        walls = sorted(line['wall'] for line in lines)
+        median = walls[len(walls)//2]
+        outliers.extend(line for line in lines if len(lines) > 2 and line['wall'] > 3*median and line['wall'] > 1)
+    if outliers:
+        print("Outliers (more than 3 times the median of the stage):")
+        for line in sorted(outliers, key=lambda line: -line['wall'])[:10]:
+            print("  ", line['stage'], line.get('file', ''), line.get('channel', ''), " %.2fs" % line['wall'])
+    print("The trace is saved in ", trace_file)
@@ -0,0 +1,95 @@
+## this script chooses where the scratch folder of an audio file is made (see -scratch_dir). The intermediate files
+## (preprocessed channels, segments, turns, and the outputs of the programs before they are copied to the input folder)
+## can be kept on a RAM disk (e.g. /dev/shm) within a size budget shared by all runs that use the folder. A file whose
+## intermediate files would not fit gets its scratch folder on the local disk instead (the temp folder of the system),
+## so that the input folder (often on a network volume) only receives the final outputs.
+## Each scratch folder reserves the space its file may need (.reserved), and reservations are made under a lock,
+## so that parallel runs see each other's use of the budget.
+
+import fcntl, json, os, shutil, socket, tempfile, wave
+from contextlib import contextmanager
+import sox
+
+scratch_prefix = 'temp_'
+# bytes per second of audio of the files in a scratch folder: every channel at 16 kHz, 16 bits, written once as a
+# channel and once more as segments (see -split_minutes), and the openSMILE output (about 130 features every 10 ms, as text)
+channel_bytes_per_second = 2*16000*2
+openSMILE_bytes_per_second = 160000
+
+# make the scratch folder of an audio file: in the input folder (as before) if no scratch_dir is given, in the scratch_dir
+# if the space the file needs fits in the budget, and in the temp folder of the system otherwise
+def make_scratch(file, args):
+    if not args.scratch_dir:
+        return tempfile.mkdtemp(prefix=scratch_prefix, dir=args.input_folder)
+    need = scratch_need(file, args)
+    with locked(args.scratch_dir):
+        budget = args.scratch_budget*1024**3 if args.scratch_budget else None
+        if fits(args.scratch_dir, need, budget):
+            folder = tempfile.mkdtemp(prefix=scratch_prefix, dir=args.scratch_dir)
+            with open(folder+'/.reserved', 'w') as outFile:
+                json.dump({'bytes': need, 'host': socket.gethostname(), 'pid': os.getpid()}, outFile)
+            return folder
+    print("WARNING: The intermediate files of "+file.split('/')[-1]+" (about "+str(round(need/1024**2))+" MB) do not fit in "+args.scratch_dir+". They are kept on the local disk.")
+    return tempfile.mkdtemp(prefix=scratch_prefix)
+
+# hold the lock of the scratch folder while reading or making reservations
+@contextmanager
+def locked(scratch_dir):
+    with open(scratch_dir+'/.scratch_lock', 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+# True if need bytes fit in the free space of scratch_dir and in the budget (minus the reservations of the other files)
+def fits(scratch_dir, need, budget=None):
+    if need > shutil.disk_usage(scratch_dir).free:
+        return False
+    return budget is None or reserved(scratch_dir) + need <= budget
+
+# bytes reserved by the scratch folders in scratch_dir; folders left behind by runs on this machine that stopped
+# (e.g. killed) are removed
+def reserved(scratch_dir):
+    total = 0
+    for entry in os.scandir(scratch_dir):
+        if not entry.name.startswith(scratch_prefix) or not entry.is_dir():
+            continue
+        try:
+            with open(entry.path+'/.reserved', 'r') as inFile:
+                reservation = json.load(inFile)
+        except (FileNotFoundError, ValueError):
+            # being made (the reservation is written under the lock) or not made by the pipeline
+            continue
+        if reservation['host'] == socket.gethostname() and not running(reservation['pid']):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        total += reservation['bytes']
+    return total
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# estimated bytes of the intermediate files of an audio file
+def scratch_need(file, args):
+    try:
+        with wave.open(file, 'rb') as inFile:
+            duration = inFile.getnframes()/inFile.getframerate()
+            channels = inFile.getnchannels()
+        # a copy of the file at most (e.g. a wav file that is converted)
+        need = os.path.getsize(file)
+    except (wave.Error, EOFError):
+        # other formats (and wav encodings that wave cannot read) are decoded to a wav file in the scratch folder first
+        duration = sox.file_info.duration(file)
+        channels = sox.file_info.channels(file)
+        need = duration*sox.file_info.sample_rate(file)*channels*4
+    need += duration*channels*channel_bytes_per_second
+    if args.openSMILE:
+        need += duration*channels*openSMILE_bytes_per_second
+    return int(need)
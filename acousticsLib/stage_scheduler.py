@@ -0,0 +1,95 @@
+## this script runs the steps (stages) of the pipeline for one audio file as a dependency graph.
+## A stage starts as soon as the stages it depends on are done, so that independent programs (e.g. openSMILE, covarep,
+## SAD and forced alignment) run at the same time. The number of stages of a program that run at the same time can be
+## limited (e.g. by the number of MATLAB licences), and all running stages together use at most cpu_budget CPUs.
+
+import os, threading
+from concurrent.futures import ThreadPoolExecutor
+from acousticsLib.run_trace import span, in_context
+
+# one step of the pipeline: run is called without arguments once all stages named in after are done
+# tool is the program the stage runs (for the per-program limits), and cpus the number of CPUs it keeps busy
+class Stage:
+    def __init__(self, name, run, after=(), tool=None, cpus=1):
+        self.name = name
+        self.run = run
+        self.after = list(after)
+        self.tool = tool
+        self.cpus = cpus
+
+class StageScheduler:
+    def __init__(self, cpu_budget=None, tool_limits=None):
+        self.cpu_budget = cpu_budget if cpu_budget else (os.cpu_count() or 1)
+        # maximum number of running stages by tool; tools that are not listed are only limited by the CPU budget
+        self.tool_limits = dict(tool_limits) if tool_limits else {}
+
+    # run all stages and return their return values by stage name
+    # stages are started in the order they are given whenever they are ready, so long stages should be given first.
+    # If a stage fails, no new stage is started, and the error is raised once the running stages are done.
+    def run(self, stages):
+        stages = list(stages)
+        names = set(stage.name for stage in stages)
+        for stage in stages:
+            for name in stage.after:
+                if name not in names:
+                    raise ValueError("The stage "+stage.name+" depends on an unknown stage: "+name)
+
+        results = {}
+        pending = list(stages)
+        # running stages by tool, CPUs in use, and the first error
+        tools = {}
+        state = {'running': 0, 'cpus': 0, 'error': None}
+        changed = threading.Condition()
+
+        # a stage that needs more CPUs than the budget runs alone
+        def cpus(stage):
+            return min(stage.cpus, self.cpu_budget)
+
+        def fits(stage):
+            if stage.tool in self.tool_limits and tools.get(stage.tool, 0) >= self.tool_limits[stage.tool]:
+                return False
+            return state['cpus'] + cpus(stage) <= self.cpu_budget
+
+        def work(stage):
+            try:
+                with span(stage.name, tool=stage.tool):
+                    result = stage.run()
+                error = None
+            except BaseException as err:
+                # also catch SystemExit (programs call sys.exit() on bad input), so that it reaches the caller
+                result = None
+                error = err
+            with changed:
+                if error is None:
+                    results[stage.name] = result
+                elif state['error'] is None:
+                    state['error'] = error
+                state['running'] -= 1
+                state['cpus'] -= cpus(stage)
+                tools[stage.tool] -= 1
+                changed.notify()
+
+        with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+            with changed:
+                while pending and state['error'] is None:
+                    started = False
+                    for stage in list(pending):
+                        if all(name in results for name in stage.after) and fits(stage):
+                            pending.remove(stage)
+                            state['running'] += 1
+                            state['cpus'] += cpus(stage)
+                            tools[stage.tool] = tools.get(stage.tool, 0) + 1
+                            # the stage is traced with the file of the caller
+                            executor.submit(in_context(work), stage)
+                            started = True
+                    if not started:
+                        if state['running'] == 0:
+                            raise ValueError("These stages depend on each other and cannot run: "+', '.join(stage.name for stage in pending))
+                        changed.wait()
+                # wait for the running stages
+                while state['running'] > 0:
+                    changed.wait()
+
+        if state['error'] is not None:
+            raise state['error']
+        return results
@@ -0,0 +1,278 @@
+## this script includes accumulators for summarizing frame-level features chunk by chunk (see -stream_frames),
+## so that the memory used does not grow with the length of a recording.
+## RunningMoments keeps the count, mean and sum of squared deviations of every group and feature (exact mean and sd).
+## QuantileSketch keeps a histogram with logarithmic buckets (as DDSketch), so that quantiles (median, IQR)
+## are estimated within a relative error of alpha.
+## Both can be combined: FramePartials keeps them for small groups of frames (e.g. turns), and rolls them up into
+## larger groups (speakers, tasks, files, a corpus) without reading the frames again.
+## BucketQuantile finds exact quantiles in a second pass over the values, keeping only the values of the buckets
+## of a sketch that hold the quantile.
+
+import numpy as np
+
+# exact mean and standard deviation by group and column, updated chunk by chunk (parallel form of Welford's algorithm)
+class RunningMoments:
+    def __init__(self, n_groups, n_columns):
+        self.n_columns = n_columns
+        self.count = np.zeros((n_groups, n_columns))
+        self.mean = np.zeros((n_groups, n_columns))
+        self.m2 = np.zeros((n_groups, n_columns))
+
+    # group: group number of each frame; values: frames x columns (NaN values are skipped)
+    def add(self, group, values):
+        n_groups = self.count.shape[0]
+        rows, cols = np.nonzero(~np.isnan(values))
+        x = values[rows, cols]
+        idx = group[rows]*self.n_columns + cols
+        size = n_groups*self.n_columns
+        # moments of this chunk
+        count = np.bincount(idx, minlength=size)
+        total = np.bincount(idx, weights=x, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total/count, 0)
+        m2 = np.bincount(idx, weights=(x - mean[idx])**2, minlength=size)
+        count, mean, m2 = count.reshape(n_groups, self.n_columns), mean.reshape(n_groups, self.n_columns), m2.reshape(n_groups, self.n_columns)
+        # combine with the earlier chunks
+        new_count = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean
+            self.mean = np.where(new_count > 0, self.mean + delta*count/new_count, 0)
+            self.m2 = np.where(new_count > 0, self.m2 + m2 + delta**2*self.count*count/new_count, 0)
+        self.count = new_count
+
+    # combine groups: group_of is the new group of every group (-1: left out), and keep (groups x columns, optional)
+    # tells which columns of a group are included
+    def rollup(self, group_of, n_groups, keep=None):
+        selected = (group_of[:, None] >= 0) & (self.count > 0)
+        if keep is not None:
+            selected &= keep
+        rows, cols = np.nonzero(selected)
+        idx = group_of[rows]*self.n_columns + cols
+        size = n_groups*self.n_columns
+        count, mean, m2 = self.count[rows, cols], self.mean[rows, cols], self.m2[rows, cols]
+        new_count = np.bincount(idx, weights=count, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_mean = np.where(new_count > 0, np.bincount(idx, weights=count*mean, minlength=size)/new_count, 0)
+        new_m2 = np.bincount(idx, weights=m2 + count*(mean - new_mean[idx])**2, minlength=size)
+        result = RunningMoments(n_groups, self.n_columns)
+        result.count, result.mean, result.m2 = new_count.reshape(n_groups, self.n_columns), new_mean.reshape(n_groups, self.n_columns), new_m2.reshape(n_groups, self.n_columns)
+        return result
+
+    def means(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    # sample standard deviation (ddof=1, as pandas)
+    def sds(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2/(self.count - 1)), np.nan)
+
+# quantiles by group and column from histograms with logarithmic buckets: a value v > 0 goes to bucket
+# ceil(log(v)/log(gamma)), and the bucket is represented by a value within a relative error of alpha of v.
+# Negative values use mirrored buckets, and values closer to 0 than min_value are counted as 0.
+# Only buckets with values are stored, so the size depends on the spread of the values, not on the number of frames.
+class QuantileSketch:
+    def __init__(self, n_groups, n_columns, alpha=0.01, min_value=1e-6, max_value=1e9):
+        self.n_groups = n_groups
+        self.n_columns = n_columns
+        self.alpha = alpha
+        self.max_value = max_value
+        self.gamma = (1 + alpha)/(1 - alpha)
+        self.log_gamma = np.log(self.gamma)
+        self.min_key = int(np.ceil(np.log(min_value)/self.log_gamma))
+        self.max_key = int(np.ceil(np.log(max_value)/self.log_gamma))
+        # buckets of one column: negative (largest first), zero, positive
+        self.n_keys = self.max_key - self.min_key + 1
+        self.n_buckets = 2*self.n_keys + 1
+        # occupied buckets (group, column and bucket in one number, sorted) and their counts
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.min_value = min_value
+
+    def buckets(self, x):
+        magnitude = np.abs(x)
+        with np.errstate(divide='ignore'):
+            key = np.ceil(np.log(np.maximum(magnitude, self.min_value))/self.log_gamma)
+        key = np.clip(key, self.min_key, self.max_key).astype(np.int64) - self.min_key
+        bucket = np.where(x > 0, self.n_keys + 1 + key, self.n_keys - 1 - key)
+        return np.where(magnitude < self.min_value, self.n_keys, bucket)
+
+    # representative value of buckets
+    def values(self, bucket):
+        positive = bucket > self.n_keys
+        key = np.where(positive, bucket - self.n_keys - 1, self.n_keys - 1 - bucket) + self.min_key
+        value = 2*self.gamma**key/(self.gamma + 1)
+        value = np.where(positive, value, -value)
+        return np.where(bucket == self.n_keys, 0, value)
+
+    def add(self, group, values):
+        rows, cols = np.nonzero(~np.isnan(values))
+        keys = (group[rows].astype(np.int64)*self.n_columns + cols)*self.n_buckets + self.buckets(values[rows, cols])
+        keys, counts = np.unique(keys, return_counts=True)
+        # merge the sorted buckets of the chunk into those of the earlier chunks: counts of buckets that are stored
+        # already are added in place, and new buckets are inserted at their place in the order
+        position = np.searchsorted(self.keys, keys)
+        stored = position < len(self.keys)
+        stored[stored] = self.keys[position[stored]] == keys[stored]
+        self.counts[position[stored]] += counts[stored]
+        self.keys = np.insert(self.keys, position[~stored], keys[~stored])
+        self.counts = np.insert(self.counts, position[~stored], counts[~stored])
+
+    # replace the buckets by the given keys and counts (keys may repeat and need not be sorted)
+    def set_buckets(self, keys, counts):
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+
+    # group, column and bucket of the stored buckets
+    def cells(self):
+        cell = self.keys // self.n_buckets
+        return cell // self.n_columns, cell % self.n_columns, self.keys % self.n_buckets
+
+    # combine groups, as RunningMoments.rollup
+    def rollup(self, group_of, n_groups, keep=None):
+        group, col, bucket = self.cells()
+        new_group = group_of[group]
+        selected = new_group >= 0
+        if keep is not None:
+            selected &= keep[group, col]
+        result = QuantileSketch(n_groups, self.n_columns, self.alpha, self.min_value, self.max_value)
+        result.set_buckets((new_group[selected]*self.n_columns + col[selected])*self.n_buckets + bucket[selected], self.counts[selected])
+        return result
+
+    # multiply the values of a column by a factor for each group (e.g. to normalize them); values are moved to the bucket
+    # of the scaled representative value. Values of groups with a NaN factor are dropped.
+    def scale(self, column, factor):
+        group, col, bucket = self.cells()
+        selected = col == column
+        scaled = self.values(bucket[selected])*factor[group[selected]]
+        valid = ~np.isnan(scaled)
+        keys = np.concatenate([self.keys[~selected], (self.keys[selected] - bucket[selected] + self.buckets(np.nan_to_num(scaled)))[valid]])
+        self.set_buckets(keys, np.concatenate([self.counts[~selected], self.counts[selected][valid]]))
+
+    # the q quantile of every group and column (groups x columns; NaN where there is no value),
+    # interpolated linearly between the two closest ranks as pandas does
+    def quantile(self, q):
+        result = np.full(self.n_groups*self.n_columns, np.nan)
+        if len(self.keys) == 0:
+            return result.reshape(self.n_groups, self.n_columns)
+        cell = self.keys // self.n_buckets
+        cells, first = np.unique(cell, return_index=True)
+        total = np.add.reduceat(self.counts, first)
+        cumulative = np.cumsum(self.counts)
+        before = cumulative[first] - self.counts[first]
+        rank = q*(total - 1)
+        values = self.values(self.keys % self.n_buckets)
+        # value at rank r (0-based) of each cell: the first bucket whose cumulative count is above r
+        lower = values[np.searchsorted(cumulative, before + np.floor(rank), side='right')]
+        upper = values[np.searchsorted(cumulative, before + np.ceil(rank), side='right')]
+        result[cells] = lower + (rank - np.floor(rank))*(upper - lower)
+        return result.reshape(self.n_groups, self.n_columns)
+
+# exact q quantile of every group (values of one column, as pandas computes it) from a second pass over the values:
+# the sketch of the first pass has the exact count of every bucket, so it tells which buckets hold the two ranks the
+# quantile is interpolated between, and where they are in the bucket. Only the values of those buckets are kept.
+class BucketQuantile:
+    def __init__(self, sketch, q):
+        self.sketch = sketch
+        self.n_groups = sketch.n_groups
+        # bucket and position in the bucket of the lower and upper rank of every group (-1: the group has no values)
+        self.bucket = np.full((2, self.n_groups), -1, dtype=np.int64)
+        self.position = np.zeros((2, self.n_groups), dtype=np.int64)
+        self.fraction = np.zeros(self.n_groups)
+        if len(sketch.keys):
+            group = sketch.keys // sketch.n_buckets // sketch.n_columns
+            groups, first = np.unique(group, return_index=True)
+            total = np.add.reduceat(sketch.counts, first)
+            cumulative = np.cumsum(sketch.counts)
+            before = cumulative[first] - sketch.counts[first]
+            rank = q*(total - 1)
+            self.fraction[groups] = rank - np.floor(rank)
+            for i, r in enumerate([np.floor(rank), np.ceil(rank)]):
+                index = np.searchsorted(cumulative, before + r, side='right')
+                self.bucket[i, groups] = sketch.keys[index] % sketch.n_buckets
+                self.position[i, groups] = before + r - (cumulative[index] - sketch.counts[index])
+        # values of the buckets of the ranks, with their group and bucket
+        self.groups, self.buckets, self.values = [], [], []
+
+    # group: group number of each value; values: the same values as were added to the sketch (NaN values are skipped)
+    def add(self, group, values):
+        valid = ~np.isnan(values)
+        group, values = group[valid], values[valid]
+        bucket = self.sketch.buckets(values)
+        selected = (bucket == self.bucket[0, group]) | (bucket == self.bucket[1, group])
+        self.groups.append(group[selected])
+        self.buckets.append(bucket[selected])
+        self.values.append(values[selected])
+
+    # the q quantile of every group (NaN for groups without values)
+    def quantile(self):
+        result = np.full(self.n_groups, np.nan)
+        present = self.bucket[0] >= 0
+        if not present.any():
+            return result
+        group, bucket, values = np.concatenate(self.groups), np.concatenate(self.buckets), np.concatenate(self.values)
+        # sorted by group, bucket and value, so that the values of a bucket of a group are in order
+        order = np.lexsort((values, bucket, group))
+        cell = group[order]*self.sketch.n_buckets + bucket[order]
+        values = values[order]
+        groups = np.flatnonzero(present)
+        lower, upper = [values[np.searchsorted(cell, groups*self.sketch.n_buckets + self.bucket[i, groups]) + self.position[i, groups]] for i in range(2)]
+        result[groups] = lower + self.fraction[groups]*(upper - lower)
+        return result
+
+# mergeable partial summaries of frames by group and column: number of frames, moments and quantile sketch
+class FramePartials:
+    def __init__(self, n_groups, n_columns):
+        self.n_groups = n_groups
+        self.n_columns = n_columns
+        self.frames = np.zeros(n_groups, dtype=np.int64)
+        self.moments = RunningMoments(n_groups, n_columns)
+        self.sketch = QuantileSketch(n_groups, n_columns)
+
+    # sketch_values are added to the sketch instead of values if given (e.g. values before a log transform)
+    def add(self, group, values, sketch_values=None):
+        self.frames += np.bincount(group, minlength=self.n_groups)
+        self.moments.add(group, values)
+        self.sketch.add(group, values if sketch_values is None else sketch_values)
+
+    # combine groups: group_of is the new group of every group (-1: left out), and keep (groups x columns, optional)
+    # tells which columns of a group are included. Frames are counted in the new group even if no column is included.
+    def rollup(self, group_of, n_groups, keep=None):
+        result = FramePartials(n_groups, self.n_columns)
+        selected = group_of >= 0
+        result.frames = np.bincount(group_of[selected], weights=self.frames[selected], minlength=n_groups).astype(np.int64)
+        result.moments = self.moments.rollup(group_of, n_groups, keep)
+        result.sketch = self.sketch.rollup(group_of, n_groups, keep)
+        return result
+
+    # mean, sd, median and IQR (groups x columns each)
+    def statistics(self):
+        return self.moments.means(), self.moments.sds(), self.sketch.quantile(0.5), self.sketch.quantile(0.75) - self.sketch.quantile(0.25)
+
+    # the groups of several partials (with the same columns) one after another
+    @staticmethod
+    def concat(partials):
+        result = FramePartials(sum(part.n_groups for part in partials), partials[0].n_columns)
+        result.frames = np.concatenate([part.frames for part in partials])
+        for name in ['count', 'mean', 'm2']:
+            setattr(result.moments, name, np.concatenate([getattr(part.moments, name) for part in partials]))
+        first = np.cumsum([0] + [part.n_groups for part in partials])
+        result.sketch.keys = np.concatenate([part.sketch.keys + offset*part.n_columns*part.sketch.n_buckets for part, offset in zip(partials, first)])
+        result.sketch.counts = np.concatenate([part.sketch.counts for part in partials])
+        return result
+
+    # save to / load from a .npz file, with other arrays (e.g. the names of the groups and columns)
+    def save(self, path, **info):
+        np.savez(path, frames=self.frames, count=self.moments.count, mean=self.moments.mean, m2=self.moments.m2,
+            sketch_keys=self.sketch.keys, sketch_counts=self.sketch.counts, **info)
+
+    @staticmethod
+    def load(path):
+        with np.load(path, allow_pickle=False) as data:
+            data = dict(data)
+        count = data.pop('count')
+        result = FramePartials(*count.shape)
+        result.moments.count = count
+        result.frames = data.pop('frames')
+        result.moments.mean, result.moments.m2 = data.pop('mean'), data.pop('m2')
+        result.sketch.keys, result.sketch.counts = data.pop('sketch_keys'), data.pop('sketch_counts')
+        return result, data
@@ -1,31 +1,56 @@
 # this script includes functions for transcripts
 import pandas as pd
+import numpy as np
 import sys
 
-def get_transcripts_only(transfile, args):
-	outfile = args.input_folder+'/temp/temp.txt'
-	start = []
-	end = []
+# A transcript that is read and checked once and shared by all programs.
+# Only transcripts without header and 6 columns (filename, start, end, text, speaker, section) will be processed.
+# start and end are float arrays, speaker and task are category codes (the names are in speakers and tasks),
+# and the text of the turns is kept separately.
+class Transcript:
+	def __init__(self, transfile):
+		print("The corresponding transcript file is ", transfile)
+		self.path = transfile
+		df = pd.read_csv(transfile, sep='\t', header=None)
+		# check if the transcript is in the right format
+		if len(df.columns) > 6:
+			sys.exit("The number of columns in the transcript file is more than 6. Please clean the transcripts and try again.")
+		elif (df.iloc[0, 0] =="Audio") or (df.iloc[0, 0] =="File"):
+			sys.exit("Transcript file has a header. Please remove the header and try again.")
+		df = df.reindex(columns=range(6))
 
-	with open(transfile, 'r') as infile, open(outfile, 'w') as outFile:
-		for line in infile:		
-			data = line.rstrip('\n').split('\t')
-			
-			outFile.writelines(data[3]+'\n')
-			start.append(float(data[1]))
-			end.append(float(data[2]))
-	if len(start) != 0:
-		return min(start), max(end) 
-	else:
-		pass
+		self.start = df[1].to_numpy(dtype=np.float64)
+		self.end = df[2].to_numpy(dtype=np.float64)
+		self.text = df[3].astype(str).to_numpy()
+		# speaker and task as strings (missing values become 'nan'), stored as codes
+		speaker = pd.Categorical(df[4].astype(str))
+		task = pd.Categorical(df[5].astype(str))
+		self.speaker = speaker.codes
+		self.speakers = speaker.categories
+		self.task = task.codes
+		self.tasks = task.categories
+
+	def __len__(self):
+		return len(self.start)
+
+	# speaker and task names of all turns, or of the turns in idx (-1 in idx gives NaN)
+	def speaker_names(self, idx=None):
+		return self.names(self.speaker, self.speakers, idx)
+
+	def task_names(self, idx=None):
+		return self.names(self.task, self.tasks, idx)
+
+	def names(self, codes, categories, idx):
+		if idx is not None:
+			codes = np.where(idx >= 0, codes[idx], -1)
+		return pd.Categorical.from_codes(codes, categories)
 
-# check if the transcript is in the right format
-def transcript_check(transfile):
-	print("The corresponding transcript file is ", transfile)
-	df = pd.read_csv(transfile, sep='\t', header=None)
-	if len(df.columns) > 6:
-		sys.exit("The number of columns in the transcript file is more than 6. Please clean the transcripts and try again.")
-	elif (df.iloc[0, 0] =="Audio") or (df.iloc[0, 0] =="File"):
-		sys.exit("Transcript file has a header. Please remove the header and try again.")
+# write the text of the turns to a text file (one turn per line) and return the start and end of the transcript
+def get_transcripts_only(transcript, args):
+	outfile = args.temp_folder+'/temp.txt'
+	with open(outfile, 'w') as outFile:
+		outFile.writelines(text+'\n' for text in transcript.text)
+	if len(transcript) != 0:
+		return transcript.start.min(), transcript.end.max()
 	else:
 		pass
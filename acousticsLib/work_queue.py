@@ -0,0 +1,186 @@
+## this script lets several pipeline runs (on one or more machines sharing the corpus folder) split the audio files
+## of a corpus between them (see -queue). Each run (worker) claims a file by creating a lock file that no other worker
+## can create at the same time, keeps the claim alive while it works on the file (lease), and marks the file as done
+## when its rows are in the worker's own output shard. Claims of workers that stopped (e.g. a crashed machine) expire
+## after the lease time and are taken over by the other workers. merge_shards combines the shards into one output file.
+
+import json, os, socket, threading, time, glob, io
+import pandas as pd
+from acousticsLib.output_sink import make_sink, read_manifest
+
+class WorkQueue:
+    def __init__(self, queue_dir, worker_id=None, lease=600):
+        self.queue_dir = queue_dir
+        self.claim_dir = queue_dir+'/claims'
+        self.done_dir = queue_dir+'/done'
+        os.makedirs(self.claim_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+        self.worker_id = worker_id if worker_id else default_worker_id()
+        # seconds after which a claim that was not renewed can be taken over
+        self.lease = lease
+        # files claimed by this worker
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.heartbeat = None
+
+    def lock_file(self, name):
+        return self.claim_dir+'/'+name+'.lock'
+
+    def is_done(self, name):
+        return os.path.exists(self.done_dir+'/'+name)
+
+    # the worker that marked a file as done
+    def owner(self, name):
+        with open(self.done_dir+'/'+name, 'r') as inFile:
+            return inFile.read().strip()
+
+    def expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.lease
+        except FileNotFoundError:
+            return True
+
+    # try to claim a file; returns False if it is done or another worker holds a claim that did not expire
+    def claim(self, name):
+        if self.is_done(name):
+            return False
+        lock = self.lock_file(name)
+        if not self.create(lock):
+            if not self.expired(lock):
+                return False
+            # take over an expired claim: move it away (only one worker can move it) and claim the file again
+            stale = lock+'.'+self.worker_id
+            try:
+                os.rename(lock, stale)
+            except FileNotFoundError:
+                return False
+            if not self.expired(stale):
+                # another worker took over the claim just before; give it back
+                try:
+                    os.link(stale, lock)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            print("WARNING: the claim on "+name+" expired and is taken over by "+self.worker_id)
+            if not self.create(lock):
+                return False
+        # the file may have been finished between the check and the claim
+        if self.is_done(name):
+            os.remove(lock)
+            return False
+        with self.lock:
+            self.held.add(name)
+        return True
+
+    # create a lock file with the claim information; False if it exists
+    def create(self, path, content=None):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as outFile:
+            if content is None:
+                content = json.dumps({'worker': self.worker_id, 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()})
+            outFile.write(content)
+        return True
+
+    # give up a claim without marking the file as done (e.g. the file failed)
+    # the lock file is only removed if it is still the claim of this worker (it may have expired and been taken over)
+    def release(self, name):
+        with self.lock:
+            self.held.discard(name)
+        try:
+            with open(self.lock_file(name), 'r') as inFile:
+                claim = json.load(inFile)
+            if claim.get('worker') == self.worker_id:
+                os.remove(self.lock_file(name))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    # mark a file as done by this worker (after its rows were written to the shard of this worker)
+    # if another worker finished the same file first (after taking over an expired claim), its rows are kept by the merge
+    def complete(self, name):
+        self.create(self.done_dir+'/'+name, self.worker_id)
+        self.release(name)
+
+    # renew the claims of this worker in the background, every third of the lease
+    def start_heartbeat(self):
+        def renew():
+            while not self.stop.wait(self.lease/3):
+                with self.lock:
+                    held = list(self.held)
+                for name in held:
+                    try:
+                        os.utime(self.lock_file(name))
+                    except FileNotFoundError:
+                        pass
+        self.heartbeat = threading.Thread(target=renew, daemon=True)
+        self.heartbeat.start()
+
+    def stop_heartbeat(self):
+        self.stop.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+
+def default_worker_id():
+    return socket.gethostname().replace('/', '_')+'-'+str(os.getpid())
+
+# output shard of a worker
+def shard_file(out_file, worker_id):
+    return out_file+'.shard-'+worker_id
+
+# combine the output shards of all workers into out_file; for every audio file, only the rows of the worker that
+# marked it as done are kept, so files that were processed twice (after an expired claim) are not duplicated
+def merge_shards(out_file, output_format, queue_dir):
+    if os.path.exists(out_file):
+        raise FileExistsError("The output file "+out_file+" already exists. Please move it before merging the shards.")
+    queue = WorkQueue(queue_dir, worker_id='merge')
+    shards = sorted(path for path in glob.glob(glob.escape(out_file)+'.shard-*') if not path.endswith('.manifest'))
+    sink = make_sink(out_file, output_format)
+    files = 0
+    for shard in shards:
+        worker_id = shard[len(out_file+'.shard-'):]
+        for file, units in shard_units(shard, output_format):
+            if not queue.is_done(file) or queue.owner(file) != worker_id:
+                continue
+            for channel, temp in units:
+                sink.write(file, channel, temp)
+            sink.done(file)
+            files += 1
+    print("Merged ", files, " audio files from ", len(shards), " shards into ", out_file)
+
+# the rows of a shard by audio file: a list of (file, [(channel, rows), ...]) in the order they were written
+def shard_units(shard, output_format):
+    by_file = {}
+    order = []
+    start = None
+    for unit in read_manifest(shard+'.manifest'):
+        if 'file' not in unit:
+            # the position of the shard when the manifest was started: the first unit starts there (after the header)
+            if unit.get('size'):
+                start = unit['size']
+            continue
+        if unit.get('done'):
+            continue
+        if output_format == 'parquet':
+            temp = pd.read_parquet(shard+'/'+unit['part'])
+        else:
+            temp, start = read_tsv_unit(shard, start, unit['size'])
+        if unit['file'] not in by_file:
+            by_file[unit['file']] = []
+            order.append(unit['file'])
+        by_file[unit['file']].append((unit['channel'], temp))
+    return [(file, by_file[file]) for file in order]
+
+# rows of a tsv shard between two positions of the manifest (the first unit starts after the header)
+def read_tsv_unit(shard, start, end):
+    with open(shard, 'rb') as inFile:
+        header = inFile.readline()
+        if start is None:
+            start = len(header)
+        inFile.seek(start)
+        rows = inFile.read(end - start)
+    return pd.read_csv(io.BytesIO(header+rows), sep='\t'), end
@@ -0,0 +1,224 @@
+## this script measures the speed of the pipeline on synthetic corpora (see synthetic_corpus.py).
+## The external programs (SMILExtract, MATLAB, the LDC SAD script and the forced aligner) are replaced by the stub
+## programs in benchmarks/stubs, so the benchmarks run without them and measure the pipeline itself.
+## The results are saved as JSON (with the git commit), and two result files can be compared to find regressions.
+
+## usage:
+## python3 benchmarks/run_benchmarks.py -output results.json -durations 60 600 -turns 20 200 -repeat 3
+## python3 benchmarks/run_benchmarks.py -compare old_results.json new_results.json
+
+import argparse, contextlib, datetime, io, json, os, platform, shutil, subprocess, sys, tempfile, time, wave
+import numpy as np
+import pandas as pd
+
+benchmark_location = os.path.dirname(os.path.abspath(__file__))
+stub_location = benchmark_location+'/stubs'
+sys.path.insert(0, os.path.dirname(benchmark_location))
+
+import acoustic_pipeline
+from acousticsLib import run_programs, covarep_worker
+from acousticsLib.transcript_prep import Transcript
+from acousticsLib.run_programs import run_SpeechQuality, run_SAD, run_openSMILE
+from acousticsLib.audio_prep import AudioSession, process_stereo
+from acousticsLib.data_summary import merge_transcript, summarize_measures, summarize_SAD, transcript_segments, summarize_pauses
+from synthetic_corpus import make_corpus
+
+# make the pipeline run the stub programs instead of the real ones
+def use_stubs():
+    os.environ['PATH'] = stub_location+os.pathsep+os.environ['PATH']
+    run_programs.SAD_location = stub_location+'/perform_sad.py'
+    run_programs.forced_alignment_location = stub_location+'/segment.py'
+    # covarep (MATLAB) runs in this folder
+    run_programs.acoustic_pipeline_location = stub_location
+    covarep_worker.acoustic_pipeline_location = stub_location
+    acoustic_pipeline.acoustic_pipeline_location = stub_location
+    # a fake openSMILE extractor for the in-process backend (-openSMILE_backend stub)
+    run_programs.openSMILE_extractors['stub'] = stub_extractor
+
+# in-process stand-in for openSMILE: random frames (10 ms) with pitch and voicing as the SMILExtract stub
+def stub_extractor(audio_file, config):
+    with wave.open(audio_file, 'rb') as inFile:
+        n_frames = int(inFile.getnframes() / inFile.getframerate() * 100)
+    rng = np.random.default_rng(0)
+    voiced = rng.random(n_frames) < 0.6
+    lld = {'F0final_sma': np.where(voiced, rng.uniform(80, 300, n_frames), 0),
+        'voicingFinalUnclipped_sma': np.where(voiced, rng.uniform(0.6, 1, n_frames), rng.uniform(0, 0.5, n_frames))}
+    for i in range(48):
+        lld['lld_sma['+str(i)+']'] = rng.normal(0, 1, n_frames)
+    lld = pd.DataFrame(lld)
+    for feature in list(lld.columns):
+        lld[feature+'_de'] = rng.normal(0, 1, n_frames)
+    return np.arange(n_frames) * 0.01, lld
+
+# run fn repeat times and return the run times in seconds; setup (not timed) makes the argument of fn for each run
+# the output of the pipeline is hidden while it is timed
+def timed(fn, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn(arg)
+            times.append(time.perf_counter() - start)
+    return times
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=benchmark_location, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=benchmark_location, capture_output=True, text=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+# all benchmarks on one corpus; returns a list of (name, params, times)
+def run_corpus(folder, args):
+    results = []
+    mono, stereo = folder+'/mono.wav', folder+'/stereo.wav'
+    transcript = Transcript(folder+'/mono.txt')
+    scratch = tempfile.mkdtemp(prefix='scratch_', dir=folder)
+    options = argparse.Namespace(turn_level=False, temp_folder=scratch, result_cache=None, openSMILE_config=None, stream_frames=None, corpus_summary=None, split_minutes=None, split_jobs=4, scratch_dir=None, scratch_budget=None, named_pipes=None, SAD_backend='ldc', frame_store=None, openSMILE_backend='subprocess')
+
+    # outputs of the stub programs for the summaries
+    shutil.copy(mono, scratch+'/mono.wav')
+    run_openSMILE(scratch+'/mono.wav', options)
+    run_programs.run_covarep(scratch+'/mono.wav')
+    run_SAD(scratch+'/mono.wav', options)
+    smile_frames = pd.read_csv(scratch+'/mono.csv', sep=';')
+
+    results.append(('run_SpeechQuality', {}, timed(lambda arg: run_SpeechQuality(mono), args.repeat)))
+
+    # split the stereo file and write both channels
+    def split(session):
+        process_stereo(session)
+        for name in session.outputs:
+            session.path(name)
+    def new_session():
+        folder = tempfile.mkdtemp(dir=scratch)
+        return AudioSession(stereo, folder)
+    results.append(('process_stereo', {}, timed(split, args.repeat, new_session)))
+
+    # energy-based SAD in this process (the LDC script is a stub here)
+    options.SAD_backend = 'energy'
+    results.append(('run_SAD', {'backend': 'energy'}, timed(lambda arg: run_SAD(mono, options), args.repeat)))
+    options.SAD_backend = 'ldc'
+
+    results.append(('merge_transcript', {}, timed(lambda df: merge_transcript(transcript, df), args.repeat, lambda: smile_frames.copy())))
+
+    for turn_level in [False, True]:
+        options.turn_level = turn_level
+        results.append(('summarize_measures', {'program': 'openSMILE', 'turn_level': turn_level},
+            timed(lambda arg: summarize_measures(scratch+'/mono.csv', transcript, pd.DataFrame(), pd.DataFrame(), options, openSMILE=True), args.repeat)))
+        results.append(('summarize_measures', {'program': 'covarep', 'turn_level': turn_level},
+            timed(lambda arg: summarize_measures(scratch+'/mono.dat', transcript, pd.DataFrame(), pd.DataFrame(), options, openSMILE=False), args.repeat)))
+    options.turn_level = False
+
+    # summaries from the frame store (converted from the text output before timing)
+    options.frame_store = True
+    summarize_measures(scratch+'/mono.csv', transcript, pd.DataFrame(), pd.DataFrame(), options, openSMILE=True)
+    results.append(('summarize_measures', {'program': 'openSMILE', 'turn_level': False, 'frame_store': True},
+        timed(lambda arg: summarize_measures(scratch+'/mono.csv', transcript, pd.DataFrame(), pd.DataFrame(), options, openSMILE=True), args.repeat)))
+    options.frame_store = None
+
+    results.append(('summarize_SAD', {'source': 'transcript'},
+        timed(lambda arg: summarize_SAD(mono, transcript, pd.DataFrame(), options, 1), args.repeat)))
+    results.append(('summarize_SAD', {'source': 'SAD'},
+        timed(lambda arg: summarize_SAD(scratch+'/mono.wav', None, pd.DataFrame(), options, 1), args.repeat)))
+    # pause measures of a corpus of 10000 copies of the transcript, stacked into one table
+    segments = transcript_segments(transcript, 'mono.wav')
+    corpus_segments = pd.concat([segments.assign(filename=str(i)+'.wav') for i in range(10000)], ignore_index=True)
+    results.append(('summarize_pauses', {'files': 10000},
+        timed(lambda arg: summarize_pauses(corpus_segments), args.repeat)))
+
+    # the whole pipeline with all programs on a fresh copy of the corpus
+    def new_corpus():
+        corpus = tempfile.mkdtemp(prefix='corpus_', dir=scratch)
+        for name in ['mono.wav', 'mono.txt', 'stereo.wav', 'stereo.txt']:
+            shutil.copy(folder+'/'+name, corpus)
+        return corpus
+    def run_main(corpus):
+        options = acoustic_pipeline.make_parser().parse_args(['-output_file', 'output.csv', '-input_folder', corpus,
+            '-openSMILE', 'True', '-covarep', 'True', '-SAD', 'True', '-forced_alignment', 'True', '-jobs', str(args.jobs)])
+        acoustic_pipeline.main(options)
+    results.append(('main', {'jobs': args.jobs, 'stub_delay': args.stub_delay}, timed(run_main, args.repeat, new_corpus)))
+
+    # openSMILE only, as a separate program or in this process (frames handed to the summary without a text file)
+    for backend in ['subprocess', 'stub']:
+        def run_openSMILE_only(corpus):
+            options = acoustic_pipeline.make_parser().parse_args(['-output_file', 'output.csv', '-input_folder', corpus,
+                '-openSMILE', 'True', '-openSMILE_backend', backend, '-jobs', str(args.jobs)])
+            acoustic_pipeline.main(options)
+        results.append(('main', {'jobs': args.jobs, 'openSMILE_backend': backend}, timed(run_openSMILE_only, args.repeat, new_corpus)))
+
+    shutil.rmtree(scratch)
+    return results
+
+# compare two result files; returns the benchmarks that got slower by more than threshold (share of the old median)
+def compare(old_file, new_file, threshold):
+    with open(old_file, 'r') as inFile:
+        old = json.load(inFile)
+    with open(new_file, 'r') as inFile:
+        new = json.load(inFile)
+    old_results = {(result['name'], json.dumps(result['params'], sort_keys=True)): result for result in old['results']}
+    print('old: ', old['commit'], ' new: ', new['commit'])
+    slower = []
+    for result in new['results']:
+        key = (result['name'], json.dumps(result['params'], sort_keys=True))
+        if key not in old_results:
+            continue
+        ratio = result['median'] / old_results[key]['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            slower.append(key)
+        print(result['name'], key[1], ' %.4fs -> %.4fs (x%.2f)%s' % (old_results[key]['median'], result['median'], ratio, flag))
+    return slower
+
+def main(args):
+    if args.compare:
+        slower = compare(args.compare[0], args.compare[1], args.threshold)
+        if slower:
+            sys.exit(str(len(slower))+" benchmarks are slower.")
+        return
+
+    use_stubs()
+    os.environ['ACOUSTIC_STUB_DELAY'] = str(args.stub_delay)
+    commit, dirty = git_commit()
+    output = {'commit': commit, 'dirty': dirty, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+        'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'repeat': args.repeat, 'results': []}
+
+    work_folder = tempfile.mkdtemp(prefix='acoustic_benchmark_')
+    try:
+        for duration in args.durations:
+            for turns in args.turns:
+                print("Benchmarking a corpus of ", duration, " seconds and ", turns, " turns...")
+                # (no '.' in the folder name: the programs name their output files after the path up to the first '.')
+                folder = work_folder+'/'+str(duration).replace('.', '_')+'_'+str(turns)
+                make_corpus(folder, duration, turns, args.seed)
+                for name, params, times in run_corpus(folder, args):
+                    params = dict(params, duration=duration, turns=turns)
+                    output['results'].append({'name': name, 'params': params, 'times': times,
+                        'min': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times))})
+                    print('  ', name, params, ' median %.4fs' % np.median(times))
+                shutil.rmtree(folder)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    with open(args.output, 'w') as outFile:
+        json.dump(output, outFile, indent=1)
+    print("The results are saved in ", args.output)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the speed of the acoustic pipeline on synthetic corpora.')
+    parser.add_argument('-output', type=str, default='benchmark_results.json', help='JSON file for the results')
+    parser.add_argument('-durations', type=float, nargs='*', default=[60, 600], help='Durations of the synthetic audio files in seconds')
+    parser.add_argument('-turns', type=int, nargs='*', default=[20, 200], help='Numbers of turns in the synthetic transcripts')
+    parser.add_argument('-repeat', type=int, default=3, help='Number of times each benchmark runs')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the synthetic corpora')
+    parser.add_argument('-jobs', type=int, default=1, help='-jobs of the pipeline in the end-to-end benchmark')
+    parser.add_argument('-stub_delay', type=float, default=0, help='Seconds every stub program call takes in addition')
+    parser.add_argument('-compare', type=str, nargs=2, help='Compare two result files (old, new) instead of running the benchmarks')
+    parser.add_argument('-threshold', type=float, default=0.1, help='Slowdown (share of the old median time) reported as a regression by -compare')
+    args = parser.parse_args()
+
+    main(args)
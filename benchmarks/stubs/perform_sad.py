@@ -0,0 +1,20 @@
+## stub for the LDC SAD script: writes speech and nonspeech segments (audio_file.lab) to the output folder
+## usage as with perform_sad.py: python3 perform_sad.py --nonspeech 0.15 -L output_folder audio_file
+
+import os, sys
+from stub_common import delay, wav_duration, file_random
+
+args = sys.argv[1:]
+output_folder = args[args.index('-L')+1]
+audio_file = args[-1]
+delay()
+rng = file_random(audio_file)
+duration = wav_duration(audio_file)
+start = 0.0
+segment = 'nonspeech'
+with open(output_folder+'/'+os.path.basename(audio_file).split('.')[0]+'.lab', 'w') as outFile:
+    while start < duration:
+        end = min(duration, start + (rng.uniform(0.3, 1.5) if segment == 'nonspeech' else rng.uniform(0.5, 4)))
+        outFile.write('%.2f %.2f %s\n' % (start, end, segment))
+        start = end
+        segment = 'speech' if segment == 'nonspeech' else 'nonspeech'
@@ -0,0 +1,17 @@
+## stub for the forced aligner: spreads the words of a turn evenly over the turn (word file in seconds,
+## phone file in 100 ns units as HTK)
+## usage as with segment.py: python segment.py wav_file text_file align_file word_file
+
+import sys
+from stub_common import delay, wav_duration
+
+wav_file, text_file, align_file, word_file = sys.argv[1:5]
+delay()
+duration = wav_duration(wav_file)
+with open(text_file, 'r') as inFile:
+    words = inFile.read().split()
+step = duration / max(len(words), 1)
+with open(word_file, 'w') as wordFile, open(align_file, 'w') as alignFile:
+    for i, word in enumerate(words):
+        wordFile.write('%.3f %.3f %s\n' % (i*step, (i+1)*step, word.upper()))
+        alignFile.write('%d %d %s %s\n' % (i*step*10000000, (i+1)*step*10000000, 'AH0', word.upper()))
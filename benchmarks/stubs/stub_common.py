@@ -0,0 +1,29 @@
+## shared helpers of the stub programs, which stand in for SMILExtract, MATLAB (covarep), the LDC SAD script and
+## the forced aligner in the benchmarks. They write output files in the same format as the real programs
+## with random values, so that the summaries of the pipeline have realistic amounts of data to work on.
+## ACOUSTIC_STUB_DELAY (seconds) adds a fixed run time to every call, e.g. to imitate slow programs.
+
+import os, random, time, wave
+
+def delay():
+    time.sleep(float(os.environ.get('ACOUSTIC_STUB_DELAY', '0')))
+
+# duration of a wav file in seconds
+def wav_duration(file):
+    with wave.open(file, 'rb') as inFile:
+        return inFile.getnframes() / inFile.getframerate()
+
+# random generator that gives the same values for the same file
+def file_random(file):
+    return random.Random(os.path.basename(file))
+
+# write one line per 10 ms frame; the values are taken in turn from a pool of random rows (make_row(rng) gives one row)
+def write_frames(outfile, header, n_frames, make_row, rng, sep, frame_prefix=None):
+    rows = [sep.join(make_row(rng)) for i in range(997)]
+    with open(outfile, 'w') as outFile:
+        outFile.write(sep.join(header)+'\n')
+        for i in range(n_frames):
+            if frame_prefix is not None:
+                outFile.write(frame_prefix(i)+rows[i % len(rows)]+'\n')
+            else:
+                outFile.write(rows[i % len(rows)]+'\n')
@@ -0,0 +1,70 @@
+## this script makes a synthetic corpus for the benchmarks: a mono and a stereo wav file (16KHz, 16 bits) and
+## a matching transcript for each (tab-separated, no header: filename, start, end, transcript, speaker, task).
+## The audio is noise with louder "speech" turns, so that the speech quality check and the stereo check have
+## something to measure. The same seed always gives the same corpus.
+
+## usage:
+## python3 benchmarks/synthetic_corpus.py -output_folder /tmp/corpus -duration 600 -turns 200
+
+import argparse, os
+import numpy as np
+from scipy.io import wavfile
+
+words = ['the', 'a', 'and', 'to', 'of', 'I', 'you', 'it', 'that', 'was', 'is', 'in', 'he', 'she', 'we', 'they',
+    'cookie', 'jar', 'boy', 'girl', 'mother', 'water', 'sink', 'stool', 'falling', 'dishes', 'window', 'kitchen']
+
+# start and end times of the turns: turns of random length separated by pauses, covering the whole recording
+def make_turns(duration, turns, rng):
+    # one pause before every turn and one at the end
+    lengths = rng.uniform(0.5, 1.5, size=2*turns+1)
+    bounds = np.cumsum(lengths) / lengths.sum() * duration
+    return np.round(bounds[0:-1:2], 2), np.round(bounds[1::2], 2)
+
+# noise with louder noise during the turns; for stereo files, each speaker is louder on their own channel
+def make_audio(file, duration, starts, ends, speakers, channels, rng, sample_rate=16000):
+    n_frames = int(duration*sample_rate)
+    audio = rng.normal(0, 100, size=(n_frames, channels))
+    for start, end, speaker in zip(starts, ends, speakers):
+        first, last = int(start*sample_rate), int(end*sample_rate)
+        if channels == 1:
+            audio[first:last, 0] += rng.normal(0, 3000, size=last-first)
+        else:
+            audio[first:last, speaker % channels] += rng.normal(0, 3000, size=last-first)
+            audio[first:last, (speaker+1) % channels] += rng.normal(0, 300, size=last-first)
+    if channels > 1:
+        # a small offset on the first channel, so that the pipeline treats the channels as different and splits them
+        audio[:, 0] += 100
+    audio = np.clip(audio, -32768, 32767).astype(np.int16)
+    wavfile.write(file, sample_rate, audio[:, 0] if channels == 1 else audio)
+
+def make_transcript(file, audio_name, starts, ends, speakers, rng):
+    # two speakers and two tasks (first and second half of the recording)
+    with open(file, 'w') as outFile:
+        for i, (start, end, speaker) in enumerate(zip(starts, ends, speakers)):
+            text = ' '.join(rng.choice(words, size=rng.integers(2, 12)))
+            task = 'task1' if i < len(starts)/2 else 'task2'
+            outFile.write('\t'.join([audio_name, str(start), str(end), text, 'speaker'+str(speaker+1), task])+'\n')
+
+# make mono.wav, stereo.wav and their transcripts in output_folder; returns the paths of the audio files
+def make_corpus(output_folder, duration=60, turns=20, seed=0):
+    os.makedirs(output_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for name, channels in [('mono', 1), ('stereo', 2)]:
+        starts, ends = make_turns(duration, turns, rng)
+        speakers = np.arange(turns) % 2
+        audio_file = output_folder+'/'+name+'.wav'
+        make_audio(audio_file, duration, starts, ends, speakers, channels, rng)
+        make_transcript(output_folder+'/'+name+'.txt', name+'.wav', starts, ends, speakers, rng)
+        files.append(audio_file)
+    return files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make a synthetic corpus for the benchmarks.')
+    parser.add_argument('-output_folder', type=str, required=True, help='Folder for the audio files and transcripts')
+    parser.add_argument('-duration', type=float, default=60, help='Duration of each audio file in seconds')
+    parser.add_argument('-turns', type=int, default=20, help='Number of turns in each transcript')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the random generator')
+    args = parser.parse_args()
+
+    make_corpus(args.output_folder, args.duration, args.turns, args.seed)
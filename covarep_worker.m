@@ -0,0 +1,26 @@
+% This script keeps one MATLAB session open and runs feature_extraction2 on every file path it reads from stdin.
+% It is started by acousticsLib/covarep_worker.py. It prints COVAREP_READY once the paths are loaded and
+% COVAREP_DONE after each file, or COVAREP_FAILED and the error message if covarep raised an error on the file
+% (the session goes on with the next file). An empty line, "exit" or the end of stdin closes the session.
+
+addpath(genpath('/usr/local/covarep'));
+addpath(genpath('/usr/local/sap-voicebox'));
+
+disp('COVAREP_READY')
+while true
+    try
+        file = input('', 's');
+    catch
+        break
+    end
+    if isempty(file) || strcmp(file, 'exit')
+        break
+    end
+    try
+        feature_extraction2(file);
+        disp(['COVAREP_DONE ' file])
+    catch err
+        disp(['COVAREP_FAILED ' file ' ' strrep(err.message, newline, ' ')])
+    end
+end
+exit
@@ -3,8 +3,11 @@
 
 function feature_extraction2(file,sample_rate)
 
-addpath(genpath('/usr/local/covarep'));
-addpath(genpath('/usr/local/sap-voicebox'));
+% the paths are already loaded when this function is called from covarep_worker.m
+if isempty(which('pitch_srh'))
+    addpath(genpath('/usr/local/covarep'));
+    addpath(genpath('/usr/local/sap-voicebox'));
+end
 
 %% Initial settings
 if nargin < 2
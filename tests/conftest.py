@@ -0,0 +1,6 @@
+## shared setup of the tests: the tests import the pipeline modules from the repository folder,
+## as the benchmarks do (see benchmarks/run_benchmarks.py)
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
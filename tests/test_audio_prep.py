@@ -0,0 +1,28 @@
+## tests of the audio preprocessing (acousticsLib/audio_prep.py)
+
+import shutil, wave
+import numpy as np
+import pytest
+from acousticsLib.audio_prep import AudioSession
+
+# write a mono wav file with 24-bit samples (wave writes any sample width; scipy cannot memory-map it)
+def write_24bit(path, samples, sample_rate=16000):
+    data = np.asarray(samples, dtype='<i4').view(np.uint8).reshape(-1, 4)[:, :3]
+    with wave.open(path, 'wb') as outFile:
+        outFile.setnchannels(1)
+        outFile.setsampwidth(3)
+        outFile.setframerate(sample_rate)
+        outFile.writeframes(data.tobytes())
+
+@pytest.mark.skipif(shutil.which('sox') is None, reason="the sox program is needed to decode 24-bit wav files")
+def test_24bit_wav_is_decoded(tmp_path):
+    samples = np.array([0, 4194304, -4194304, 8388607, -8388608, 12345], dtype=np.int32)
+    audio_file = str(tmp_path/'file24.wav')
+    write_24bit(audio_file, np.repeat(samples, 100))
+    session = AudioSession(audio_file, str(tmp_path))
+    assert session.sample_rate == 16000
+    assert session.channels == 1
+    assert not session.pcm
+    # decoded to 16 bits (sox may dither the lowest bit)
+    assert session.samples.dtype == np.int16
+    np.testing.assert_allclose(session.samples, np.repeat(samples, 100)/256, atol=2)
@@ -0,0 +1,58 @@
+## tests of the long-lived covarep sessions (acousticsLib/covarep_worker.py), with a stub program in place of MATLAB
+
+import sys
+import pytest
+from acousticsLib.covarep_worker import CovarepPool, CovarepError
+
+# speaks the protocol of covarep_worker.m; the file name says how it answers, and every start is logged in starts.log
+stub = '''
+import sys, time
+with open('starts.log', 'a') as outFile:
+    outFile.write('start\\n')
+print('COVAREP_READY', flush=True)
+for line in sys.stdin:
+    file = line.strip()
+    if file == 'exit':
+        break
+    if file.startswith('fail'):
+        print('COVAREP_FAILED '+file+' Index exceeds matrix dimensions.', flush=True)
+    elif file.startswith('hang'):
+        time.sleep(60)
+    elif file.startswith('die'):
+        sys.exit(1)
+    else:
+        print('COVAREP_DONE '+file, flush=True)
+'''
+
+@pytest.fixture
+def pool(tmp_path):
+    (tmp_path/'stub_matlab.py').write_text(stub)
+    pool = CovarepPool(1, [sys.executable, 'stub_matlab.py'], str(tmp_path), timeout=2)
+    yield pool
+    pool.close()
+
+def starts(tmp_path):
+    return len((tmp_path/'starts.log').read_text().split())
+
+# files are analysed one after another by the same session
+def test_done(pool, tmp_path):
+    pool.run('a.wav')
+    pool.run('b.wav')
+    assert starts(tmp_path) == 1
+
+# an error of covarep fails the file only; the session goes on with the next file
+def test_failed(pool, tmp_path):
+    with pytest.raises(CovarepError, match='Index exceeds'):
+        pool.run('fail.wav')
+    pool.run('a.wav')
+    assert starts(tmp_path) == 1
+
+# a session that does not answer in time, or exits, is stopped and a new one is started for the next file
+@pytest.mark.parametrize('file', ['hang.wav', 'die.wav'])
+def test_restarted(pool, tmp_path, file):
+    pool.run('a.wav')
+    with pytest.raises(RuntimeError, match='covarep crashed') as err:
+        pool.run(file)
+    assert not isinstance(err.value, CovarepError)
+    pool.run('b.wav')
+    assert starts(tmp_path) == 2
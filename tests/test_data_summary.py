@@ -0,0 +1,50 @@
+## tests of the summaries of the program outputs (acousticsLib/data_summary.py)
+
+import argparse
+import numpy as np
+import pandas as pd
+import pytest
+from acousticsLib.transcript_prep import Transcript
+from acousticsLib.data_summary import summarize_measures
+
+# openSMILE frames (10 ms) in the layout of the output file: pitch, voicing, other features, then their deltas
+def make_frames(n_frames, seed=0):
+    rng = np.random.default_rng(seed)
+    voiced = rng.random(n_frames) < 0.6
+    frames = {'name': ['unknown']*n_frames, 'frameTime': np.round(np.arange(n_frames)*0.01, 2),
+        'F0final_sma': np.where(voiced, rng.uniform(80, 300, n_frames), 0),
+        'voicingFinalUnclipped_sma': np.where(voiced, rng.uniform(0.6, 1, n_frames), rng.uniform(0, 0.5, n_frames))}
+    for i in range(4):
+        frames['lld_sma['+str(i)+']'] = rng.normal(i, 1, n_frames)
+    for feature in list(frames)[2:]:
+        frames[feature+'_de'] = rng.normal(0, 1, n_frames)
+    return pd.DataFrame(frames)
+
+# a transcript of two speakers and two tasks, with pauses between the turns
+def make_transcript(path, duration, turns=40):
+    bounds = np.linspace(0, duration, 2*turns + 1)
+    with open(path, 'w') as outFile:
+        for i in range(turns):
+            outFile.write('\t'.join(['file.wav', str(round(bounds[2*i] + 0.3, 2)), str(round(bounds[2*i + 1], 2)), 'turn '+str(i),
+                'speaker'+str(i % 2 + 1), 'task'+str(2*i//turns + 1)])+'\n')
+    return Transcript(path)
+
+def summarize(frames, transcript, stream_frames, turn_level):
+    args = argparse.Namespace(stream_frames=stream_frames, turn_level=turn_level, corpus_summary=None, frame_store=None, openSMILE_backend='subprocess')
+    df = summarize_measures('file.csv', transcript, pd.DataFrame(), pd.DataFrame(), args, openSMILE=True, frames=frames.copy())
+    return df.sort_values(['speaker', 'task'] + (['transcript'] if turn_level else []), kind='stable').reset_index(drop=True)
+
+# the streaming summary (in chunks) matches the summary of all frames in memory: means and sds exactly,
+# medians and IQRs within the error of the quantile sketch
+@pytest.mark.parametrize('turn_level', [False, True])
+def test_stream_matches_in_memory(tmp_path, turn_level):
+    frames = make_frames(30000)
+    transcript = make_transcript(str(tmp_path/'file.txt'), 300)
+    expected = summarize(frames, transcript, None, turn_level)
+    streamed = summarize(frames, transcript, 7000, turn_level)
+    assert len(streamed) == len(expected)
+    for column in expected.columns:
+        if column.endswith('_mean') or column.endswith('_sd'):
+            np.testing.assert_allclose(streamed[column].astype(float), expected[column].astype(float), rtol=1e-9, atol=1e-9, err_msg=column)
+        elif column.endswith('_median'):
+            np.testing.assert_allclose(streamed[column].astype(float), expected[column].astype(float), rtol=0.02, atol=0.05, err_msg=column)
@@ -0,0 +1,52 @@
+## tests of the in-process openSMILE backend (-openSMILE_backend), with a fake extractor in place of openSMILE
+
+import argparse, os
+import numpy as np
+import pandas as pd
+from acousticsLib import run_programs
+from acousticsLib.frame_store import FrameStore
+from acousticsLib.transcript_prep import Transcript
+from acousticsLib.data_summary import summarize_measures
+from acoustic_pipeline import run_openSMILE_stage
+
+# frames of a fake openSMILE: pitch and voicing vary, the other features (and their deltas) are constant
+def fake_extractor(calls, n_frames=2000):
+    def extract(audio_file, config):
+        calls.append((audio_file, config))
+        rng = np.random.default_rng(0)
+        voiced = rng.random(n_frames) < 0.6
+        lld = pd.DataFrame({'F0final_sma': np.where(voiced, rng.uniform(80, 300, n_frames), 0),
+            'voicingFinalUnclipped_sma': np.where(voiced, rng.uniform(0.6, 1, n_frames), rng.uniform(0, 0.5, n_frames)),
+            'pcm_RMSenergy_sma': np.full(n_frames, 3.0)})
+        for feature in list(lld.columns):
+            lld[feature+'_de'] = np.full(n_frames, -1.0) if feature == 'pcm_RMSenergy_sma' else rng.normal(0, 1, n_frames)
+        return np.arange(n_frames) * 0.01, lld
+    return extract
+
+# the frames of a registered extractor are saved as a frame store and reach the summary, directly or from the store
+def test_fake_extractor(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setitem(run_programs.openSMILE_extractors, 'fake', fake_extractor(calls))
+    input_folder, temp_folder = tmp_path/'input', tmp_path/'scratch'
+    input_folder.mkdir()
+    temp_folder.mkdir()
+    args = argparse.Namespace(temp_folder=str(temp_folder), input_folder=str(input_folder), openSMILE_config=None,
+        openSMILE_backend=run_programs.openSMILE_backend('fake'), result_cache=None, stream_frames=None, turn_level=False,
+        corpus_summary=None, frame_store=None)
+    audio_file = str(input_folder/'file.wav')
+    frames = run_openSMILE_stage(audio_file, args)
+    assert calls == [(audio_file, run_programs.openSMILE_default_config_location)]
+    assert list(frames.columns[:2]) == ['name', 'frameTime']
+    assert os.path.exists(str(input_folder/'file.csv.frames'))
+    stored = FrameStore(str(input_folder/'file.csv.frames'), True).frame()
+    np.testing.assert_allclose(stored.iloc[:, 1:].to_numpy(), frames.iloc[:, 1:].to_numpy(), rtol=1e-6)
+
+    (input_folder/'file.txt').write_text('file.wav\t0.5\t19.5\thello\tspeaker1\ttask1\n')
+    transcript = Transcript(str(input_folder/'file.txt'))
+    summaries = [summarize_measures(str(input_folder/'file.csv'), transcript, pd.DataFrame(), pd.DataFrame(), args, openSMILE=True, frames=given)
+        for given in [frames, None]]
+    for df in summaries:
+        assert df['pcm_RMSenergy_sma_mean'].tolist() == [3.0]
+        assert df['pcm_RMSenergy_sma_de_mean'].tolist() == [-1.0]
+        assert df['F0final_sma_mean'].notna().all()
+    pd.testing.assert_frame_equal(summaries[0], summaries[1], rtol=1e-5)
@@ -0,0 +1,65 @@
+## tests of the stage graph of one audio file (acousticsLib/stage_scheduler.py)
+
+import threading, time
+import pytest
+from acousticsLib.stage_scheduler import Stage, StageScheduler
+
+# a stage that records when it starts and ends in events
+def recorded(events, name, duration=0.05):
+    def run():
+        events.append(('start', name))
+        time.sleep(duration)
+        events.append(('end', name))
+        return name
+    return run
+
+# a stage starts only after the stages it depends on are done; independent stages run at the same time
+def test_after():
+    events = []
+    stages = [Stage('align', recorded(events, 'align'), after=['sad']), Stage('sad', recorded(events, 'sad')),
+        Stage('smile', recorded(events, 'smile'))]
+    results = StageScheduler(cpu_budget=4).run(stages)
+    assert results == {'align': 'align', 'sad': 'sad', 'smile': 'smile'}
+    assert events.index(('end', 'sad')) < events.index(('start', 'align'))
+    assert events.index(('start', 'smile')) < events.index(('end', 'sad'))
+
+# a chain of stages runs in the order of its dependencies, not in the order the stages are given
+def test_after_chain():
+    order = []
+    stages = [Stage(str(i), lambda i=i: order.append(i), after=[str(i - 1)] if i else []) for i in reversed(range(5))]
+    StageScheduler(cpu_budget=4).run(stages)
+    assert order == list(range(5))
+
+def test_unknown_stage():
+    with pytest.raises(ValueError, match='unknown stage: missing'):
+        StageScheduler().run([Stage('align', lambda: None, after=['missing'])])
+
+def test_cycle():
+    with pytest.raises(ValueError, match='depend on each other'):
+        StageScheduler().run([Stage('a', lambda: None, after=['b']), Stage('b', lambda: None, after=['a'])])
+
+# at most tool_limits[tool] stages of a tool run at the same time
+def test_tool_limit():
+    running = []
+    peak = []
+    lock = threading.Lock()
+    def run():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+    stages = [Stage('covarep'+str(i), run, tool='covarep') for i in range(4)]
+    StageScheduler(cpu_budget=8, tool_limits={'covarep': 1}).run(stages)
+    assert max(peak) == 1
+
+# the error of a stage reaches the caller, and the stages that depend on it do not run
+def test_error():
+    events = []
+    def fail():
+        raise SystemExit('bad transcript')
+    stages = [Stage('transcript', fail), Stage('align', recorded(events, 'align'), after=['transcript'])]
+    with pytest.raises(SystemExit, match='bad transcript'):
+        StageScheduler().run(stages)
+    assert events == []
@@ -0,0 +1,114 @@
+## tests of the work queue, the output shards of the workers and their merge (acousticsLib/work_queue.py)
+
+import multiprocessing, os, time
+import pandas as pd
+import pytest
+from acousticsLib.output_sink import make_sink
+from acousticsLib.work_queue import WorkQueue, shard_file, merge_shards
+
+# the rows of one channel of an audio file, as a worker writes them
+def make_rows(name, channel, worker_id):
+    return pd.DataFrame({'filename': [name]*2, 'channel': [channel]*2, 'worker': [worker_id]*2, 'value': [1.0, 2.0]})
+
+# process files as run_queue does: claim a file, write its channels to the shard of the worker, and mark it as done
+def work(queue_dir, out_file, output_format, worker_id, files):
+    queue = WorkQueue(queue_dir, worker_id)
+    sink = make_sink(shard_file(out_file, worker_id), output_format, True)
+    for name in files:
+        if not queue.claim(name):
+            continue
+        if sink.is_done(name):
+            queue.complete(name)
+            continue
+        for channel in ['firstCH', 'secondCH']:
+            sink.write(name, channel, make_rows(name, channel, worker_id))
+        sink.done(name)
+        queue.complete(name)
+
+def read_output(out_file, output_format):
+    if output_format == 'parquet':
+        return pd.read_parquet(out_file)
+    return pd.read_csv(out_file, sep='\t')
+
+# the manifest of a shard starts with the position of the shard; the merge skips it, also after a worker was started again
+@pytest.mark.parametrize('output_format', ['tsv', 'parquet'])
+def test_merge_restarted_worker(tmp_path, output_format):
+    queue_dir, out_file = str(tmp_path/'queue'), str(tmp_path/'out')
+    files = ['file'+str(i)+'.wav' for i in range(4)]
+    work(queue_dir, out_file, output_format, 'A', files[:2])
+    work(queue_dir, out_file, output_format, 'A', files)
+    merge_shards(out_file, output_format, queue_dir)
+    merged = read_output(out_file, output_format)
+    assert merged.groupby('filename').size().to_dict() == dict((name, 4) for name in files)
+    assert set(merged['worker']) == {'A'}
+
+# several workers (processes) share one queue: every file is processed by one worker, and is in the merged output once
+@pytest.mark.parametrize('output_format', ['tsv', 'parquet'])
+def test_workers_share_queue(tmp_path, output_format):
+    queue_dir, out_file = str(tmp_path/'queue'), str(tmp_path/'out')
+    files = ['file'+str(i)+'.wav' for i in range(20)]
+    workers = [multiprocessing.Process(target=work, args=(queue_dir, out_file, output_format, worker_id, files)) for worker_id in ['A', 'B', 'C']]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    merge_shards(out_file, output_format, queue_dir)
+    merged = read_output(out_file, output_format)
+    assert sorted(set(merged['filename'])) == sorted(files)
+    assert (merged.groupby(['filename', 'channel']).size() == 2).all()
+    assert (merged.groupby('filename')['worker'].nunique() == 1).all()
+    queue = WorkQueue(queue_dir, 'check')
+    assert all(queue.owner(name) == worker for name, worker in zip(merged['filename'], merged['worker']))
+
+# a claim that was not renewed for the lease time is taken over by another worker; the first worker cannot release it
+def test_expired_claim_taken_over(tmp_path):
+    queue_dir = str(tmp_path/'queue')
+    first, second = WorkQueue(queue_dir, 'A', lease=60), WorkQueue(queue_dir, 'B', lease=60)
+    assert first.claim('file.wav')
+    assert not second.claim('file.wav')
+    # the first worker stopped renewing its claim
+    stale = time.time() - 120
+    os.utime(first.lock_file('file.wav'), (stale, stale))
+    assert second.claim('file.wav')
+    first.release('file.wav')
+    assert os.path.exists(second.lock_file('file.wav'))
+    second.complete('file.wav')
+    assert second.owner('file.wav') == 'B'
+    assert not os.path.exists(second.lock_file('file.wav'))
+    assert not first.claim('file.wav')
+
+# the heartbeat keeps a claim alive beyond the lease; once it stops, the claim expires
+def test_heartbeat_renews_claim(tmp_path):
+    queue_dir = str(tmp_path/'queue')
+    first, second = WorkQueue(queue_dir, 'A', lease=1), WorkQueue(queue_dir, 'B', lease=1)
+    assert first.claim('file.wav')
+    first.start_heartbeat()
+    try:
+        time.sleep(1.5)
+        assert not second.claim('file.wav')
+    finally:
+        first.stop_heartbeat()
+    time.sleep(1.5)
+    assert second.claim('file.wav')
+
+# a file processed twice (the first worker went on after its claim was taken over) is merged from the worker that finished it
+@pytest.mark.parametrize('output_format', ['tsv', 'parquet'])
+def test_merge_keeps_owner_rows(tmp_path, output_format):
+    queue_dir, out_file = str(tmp_path/'queue'), str(tmp_path/'out')
+    first = WorkQueue(queue_dir, 'A', lease=60)
+    sink = make_sink(shard_file(out_file, 'A'), output_format, True)
+    assert first.claim('file.wav')
+    sink.write('file.wav', 'firstCH', make_rows('file.wav', 'firstCH', 'A'))
+    # older than the default lease of the second worker
+    stale = time.time() - 3600
+    os.utime(first.lock_file('file.wav'), (stale, stale))
+    work(queue_dir, out_file, output_format, 'B', ['file.wav', 'other.wav'])
+    # the first worker finishes the file after the second one
+    sink.write('file.wav', 'secondCH', make_rows('file.wav', 'secondCH', 'A'))
+    sink.done('file.wav')
+    first.complete('file.wav')
+    merge_shards(out_file, output_format, queue_dir)
+    merged = read_output(out_file, output_format)
+    assert set(merged['worker']) == {'B'}
+    assert merged.groupby('filename').size().to_dict() == {'file.wav': 4, 'other.wav': 4}